@@ -3,15 +3,34 @@
 __version__ = '0.1.0'
 __author__ = 'Porntip Chaibamrung'
 
+import datetime
 import os
 
+import click
 from flask import Flask
 from flask_restful import Api
 from flask_pymongo import PyMongo
 
 from instance.config import app_config
-from instance.resources import AddSong, ListSong, ListSongByLevel, SearchSong, RateSong, ListRating, GetStatRating
+from instance.resources import AddSong, ListSong, ListSongByLevel, SearchSong, SuggestSong, SongStats, SimilarSong, \
+    SongItem, RateSong, ListRating, GetStatRating, GetStatRatings, ExportData, AdmissionStats, SlowQueryStats, \
+    CoalescingStats, DeleteJobs, DeleteJob
 from instance.song import Song, create_from_file
+from instance.rating import Rating
+from instance.suggest import SuggestIndex
+from instance.similar import SimilarIndex
+from instance.admission import AdmissionController
+from instance.compression import ResponseCompressor
+from instance.count_cache import CountCache
+from instance.profiling import RequestProfiler, SlowQueryRecorder
+from instance.storage import create_storage
+from instance.archive import RatingArchive
+from instance.export import EXPORT_COLLECTIONS, EXPORT_FORMATS, iter_export, parse_date
+from instance.song_stats import SongStatsSnapshot, numpy
+from instance.single_flight import SingleFlight
+from instance.song_ids import SongIdIndex
+from instance.delete_jobs import RatingDeleteJobs
+from instance.catalog import CatalogWriter, load_catalog, save_catalog
 
 
 def create_app(config_name=None):
@@ -41,7 +60,50 @@ def create_app(config_name=None):
         app.config["MONGO_DBNAME"] = "songs_db"
         app.config["MONGO_URI"] = "mongodb://localhost:27017/songs_db"
 
-    app.config['mongodb'] = PyMongo(app)
+    event_listeners = []
+    if app.config['SLOW_QUERY_ENABLED']:
+        app.config['slow_query_recorder'] = SlowQueryRecorder(
+            threshold_ms=app.config['SLOW_QUERY_THRESHOLD_MS'],
+            max_records=app.config['SLOW_QUERY_MAX_RECORDS']
+        )
+        event_listeners.append(app.config['slow_query_recorder'])
+
+    if app.config['STORAGE_BACKEND'] == 'mongo':
+        app.config['mongodb'] = PyMongo(app, event_listeners=event_listeners)
+        app.config['rating_shard_mongodbs'] = [PyMongo(app, uri=uri, event_listeners=event_listeners)
+                                               for uri in app.config['RATING_SHARD_URIS']]
+
+    app.config['storage'] = create_storage(app)
+    app.config['suggest_index'] = SuggestIndex()
+    app.config['similar_index'] = SimilarIndex()
+    app.config['song_count_cache'] = CountCache(ttl=app.config['SONG_COUNT_CACHE_TTL'])
+    if numpy is not None:
+        app.config['song_stats'] = SongStatsSnapshot()
+    if app.config['SINGLE_FLIGHT_ENABLED']:
+        app.config['single_flight'] = SingleFlight(ttl=app.config['SINGLE_FLIGHT_TTL'])
+    app.config['delete_jobs'] = RatingDeleteJobs(flask_app=app, batch_size=app.config['DELETE_RATING_BATCH_SIZE'],
+                                                 pause=app.config['DELETE_RATING_BATCH_PAUSE'],
+                                                 lease=app.config['DELETE_JOB_LEASE'],
+                                                 rescan_delay=app.config['DELETE_JOB_RESCAN_DELAY'])
+    if app.config['SONG_ID_INDEX_ENABLED']:
+        app.config['song_id_index'] = SongIdIndex(exact_max=app.config['SONG_ID_EXACT_MAX'],
+                                                  error_rate=app.config['SONG_ID_BLOOM_ERROR_RATE'],
+                                                  refresh_interval=app.config['SONG_ID_REFRESH_INTERVAL'])
+
+    if app.config['ADMISSION_ENABLED']:
+        app.config['admission_controller'] = AdmissionController(
+            limits=app.config['ADMISSION_LIMITS'],
+            max_in_flight=app.config['ADMISSION_MAX_IN_FLIGHT'],
+            low_priority_share=app.config['ADMISSION_LOW_PRIORITY_SHARE'],
+            default_max_wait=app.config['ADMISSION_MAX_WAIT']
+        )
+
+    if app.config['COMPRESS_ENABLED']:
+        ResponseCompressor(
+            min_size=app.config['COMPRESS_MIN_SIZE'],
+            levels=app.config['COMPRESS_LEVELS'],
+            cache_size=app.config['COMPRESS_CACHE_SIZE']
+        ).init_app(app)
 
     # ensure the instance folder exists
     try:
@@ -49,14 +111,48 @@ def create_app(config_name=None):
     except OSError:
         pass
 
+    if app.config['PROFILE_ENABLED'] or app.config['PROFILE_SECRET']:
+        app.config['request_profiler'] = RequestProfiler(
+            profile_dir=app.config['PROFILE_DIR'] or os.path.join(app.instance_path, 'profiles'),
+            secret=app.config['PROFILE_SECRET'],
+            is_enabled=app.config['PROFILE_ENABLED']
+        )
+
+    def get_catalog_path():
+        return app.config['CATALOG_SNAPSHOT_PATH'] or os.path.join(app.instance_path, 'catalog', 'songs.snapshot')
+
     with app.app_context():
         dbnames_list = Song().get_dbnames()
+        Song().create_indexes()
+        Rating().create_indexes()
 
         # Import data from a file if songs collection does not exist in the database
         if len(dbnames_list) == 0:
             SITE_ROOT = os.path.realpath(os.path.dirname(__file__))
             json_url = os.path.join(SITE_ROOT, "data/songs.json")
-            create_from_file(file_path=json_url)
+            create_from_file(file_path=json_url, upsert=True, update_indexes=False)
+
+        # Read songs and rating counts once for all in-memory indexes, from catalog snapshot file if it is up to date
+        snapshot, songs, rating_counts, source = load_catalog(
+            file_path=get_catalog_path(), delta_margin=app.config['CATALOG_SNAPSHOT_DELTA_MARGIN'],
+            batch_size=app.config['EXPORT_BATCH_SIZE'])
+        app.logger.debug('Loaded %s songs from %s', len(songs) + (snapshot.count if snapshot else 0), source)
+
+        # Build in-memory indexes: suggestion prefixes, similar songs, song ids and columnar statistic snapshot
+        try:
+            Song().build_indexes(songs=songs, rating_counts=rating_counts, snapshot=snapshot)
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+
+        # Resume delete jobs of stopped processes, the worker thread checks them again whenever it is idle
+        app.config['delete_jobs'].resume()
+
+    if app.config['CATALOG_SNAPSHOT_INTERVAL']:
+        app.config['catalog_writer'] = CatalogWriter(flask_app=app, file_path=get_catalog_path(),
+                                                     interval=app.config['CATALOG_SNAPSHOT_INTERVAL'],
+                                                     batch_size=app.config['EXPORT_BATCH_SIZE'])
+        app.config['catalog_writer'].start_worker()
 
     # Define end points
     api = Api(app)
@@ -66,10 +162,99 @@ def create_app(config_name=None):
                      resource_class_kwargs={'config_name': config_name})
     api.add_resource(SearchSong, "/songs/search", endpoint="search_songs",
                      resource_class_kwargs={'config_name': config_name})
+    api.add_resource(SongStats, "/songs/stats", endpoint="song_stats",
+                     resource_class_kwargs={'config_name': config_name})
+    api.add_resource(SongItem, "/songs/<string:song_id>", endpoint="song",
+                     resource_class_kwargs={'config_name': config_name})
+    api.add_resource(SimilarSong, "/songs/<string:song_id>/similar", endpoint="similar_songs",
+                     resource_class_kwargs={'config_name': config_name})
+    api.add_resource(SuggestSong, "/songs/suggest", endpoint="suggest_songs",
+                     resource_class_kwargs={'config_name': config_name})
     api.add_resource(RateSong, "/songs/rating", endpoint="rate_songs",
                      resource_class_kwargs={'config_name': config_name})
     api.add_resource(ListRating, "/rating", endpoint="ratings", resource_class_kwargs={'config_name': config_name})
     api.add_resource(GetStatRating, "/songs/avg/rating/<string:song_id>", endpoint="get_stat_rating",
                      resource_class_kwargs={'config_name': config_name})
+    api.add_resource(GetStatRatings, "/songs/avg/rating", endpoint="get_stat_ratings",
+                     resource_class_kwargs={'config_name': config_name})
+    api.add_resource(ExportData, "/export/<string:collection>", endpoint="export_data",
+                     resource_class_kwargs={'config_name': config_name})
+    api.add_resource(AdmissionStats, "/admin/admission", endpoint="admission_stats",
+                     resource_class_kwargs={'config_name': config_name})
+    api.add_resource(SlowQueryStats, "/admin/slow_queries", endpoint="slow_queries",
+                     resource_class_kwargs={'config_name': config_name})
+    api.add_resource(DeleteJobs, "/admin/jobs", endpoint="delete_jobs",
+                     resource_class_kwargs={'config_name': config_name})
+    api.add_resource(DeleteJob, "/admin/jobs/<string:job_id>", endpoint="delete_job",
+                     resource_class_kwargs={'config_name': config_name})
+    api.add_resource(CoalescingStats, "/admin/coalescing", endpoint="coalescing_stats",
+                     resource_class_kwargs={'config_name': config_name})
+
+    @app.cli.command('import-songs')
+    @click.argument('file_path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--batch-size', type=int, default=None, help='Number of upserts per bulk write')
+    def import_songs_command(file_path, batch_size):
+        """Upsert songs from JSON file. Safe to run again with the same file."""
+        create_from_file(file_path=file_path, upsert=True, batch_size=batch_size, update_indexes=False)
+        click.echo('Imported songs from {}'.format(file_path))
+
+    def get_rating_archive():
+        archive_dir = app.config['RATING_ARCHIVE_DIR'] or os.path.join(app.instance_path, 'archive', 'ratings')
+        return RatingArchive(archive_dir=archive_dir)
+
+    @app.cli.command('snapshot-catalog')
+    @click.option('--output', type=click.Path(dir_okay=False), default=None,
+                  help='Snapshot file, default is CATALOG_SNAPSHOT_PATH')
+    def snapshot_catalog_command(output):
+        """Write snapshot file of songs catalog for fast startup of workers."""
+        file_path = output or get_catalog_path()
+        count = save_catalog(file_path=file_path, batch_size=app.config['EXPORT_BATCH_SIZE'])
+        click.echo('Saved {} songs to {}'.format(count, file_path))
+
+    @app.cli.command('archive-ratings')
+    @click.option('--days', type=int, default=None, help='Archive ratings older than this number of days')
+    @click.option('--max-batches', type=int, default=None, help='Stop after this number of batches')
+    def archive_ratings_command(days, max_batches):
+        """Move old ratings to compressed files partitioned by creation date."""
+        if days is None:
+            days = app.config['RATING_ARCHIVE_DAYS']
+        before = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        result = get_rating_archive().archive(before=before,
+                                              batch_size=app.config['RATING_ARCHIVE_BATCH_SIZE'],
+                                              pause=app.config['RATING_ARCHIVE_BATCH_PAUSE'],
+                                              max_batches=max_batches)
+        click.echo('Archived {} ratings created before {} to {} files'.format(
+            result['archived'], before.isoformat(), len(result['files'])))
+
+    @app.cli.command('restore-ratings')
+    @click.option('--start', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+    @click.option('--end', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+    def restore_ratings_command(start, end):
+        """Insert archived ratings created between start and end date back to ratings collection."""
+        restored = get_rating_archive().restore(start=start.date() if start else None,
+                                                end=end.date() if end else None)
+        click.echo('Restored {} ratings'.format(restored))
+
+    @app.cli.command('export')
+    @click.argument('collection', type=click.Choice(EXPORT_COLLECTIONS))
+    @click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)), default='csv')
+    @click.option('--fields', default=None, help='Comma separated field names')
+    @click.option('--start', default=None, help='First creation date (YYYY-MM-DD)')
+    @click.option('--end', default=None, help='End of creation date, excluded (YYYY-MM-DD)')
+    @click.option('--output', type=click.File('wb'), default='-', help='Output file, default is standard output')
+    def export_command(collection, export_format, fields, start, end, output):
+        """Export songs or ratings as CSV, Arrow IPC stream or Parquet."""
+        if fields is not None:
+            fields = [field.strip() for field in fields.split(',') if field.strip() != '']
+        dates = {}
+        for name, value in (('start', start), ('end', end)):
+            try:
+                dates[name] = parse_date(value)
+            except ValueError as e:
+                raise click.BadParameter('{}'.format(e), param_hint='--{}'.format(name))
+        for chunk in iter_export(collection=collection, export_format=export_format, fields=fields,
+                                 start=dates['start'], end=dates['end'],
+                                 batch_size=app.config['EXPORT_BATCH_SIZE']):
+            output.write(chunk)
 
     return app
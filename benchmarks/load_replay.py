@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+"""
+Replay a weighted mix of the Postman collection requests against a running instance.
+
+Example:
+
+    python -m benchmarks.load_replay --base-url http://127.0.0.1:5000 --duration 30 --concurrency 16
+    python -m benchmarks.load_replay --rate 200 --weights "Rate song=5,Songs=2" --output run2.json --compare run1.json
+"""
+
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+
+SITE_ROOT = os.path.realpath(os.path.join(os.path.dirname(__file__), os.pardir))
+DEFAULT_COLLECTION = os.path.join(SITE_ROOT, "postman", "FlaskAPI.postman_collection.json")
+DEFAULT_DATA_DIR = os.path.join(SITE_ROOT, "api", "data")
+
+OBJECT_ID_PATTERN = re.compile(r'\b[0-9a-f]{24}\b')
+PERCENTILES = (50, 90, 95, 99)
+
+
+def load_collection(file_path=None):
+    """
+    Load requests from Postman collection. Both v1 ('requests' list) and v2 ('item' tree) formats are supported.
+
+    :param file_path: full file path to Postman collection
+    :return: list: list of dictionary with 'name', 'method', 'url', 'headers' and 'body' keys
+    """
+    with open(file_path) as json_file:
+        collection = json.load(json_file)
+
+    output = []
+    for one_request in collection.get('requests', []):
+        headers = {}
+        for line in (one_request.get('headers') or '').splitlines():
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip()] = value.strip()
+        output.append({
+            'name': one_request['name'],
+            'method': one_request['method'],
+            'url': one_request['url'],
+            'headers': headers,
+            'body': one_request.get('rawModeData') if one_request.get('dataMode') == 'raw' else None
+        })
+
+    def walk(items):
+        for item in items:
+            if 'item' in item:
+                walk(item['item'])
+                continue
+            one_request = item['request']
+            url = one_request['url']
+            output.append({
+                'name': item['name'],
+                'method': one_request['method'],
+                'url': url['raw'] if isinstance(url, dict) else url,
+                'headers': {h['key']: h['value'] for h in one_request.get('header', [])},
+                'body': one_request.get('body', {}).get('raw')
+            })
+
+    walk(collection.get('item', []))
+    return output
+
+
+def load_fixtures(data_dir=None):
+    """
+    Load JSON fixtures used for request bodies.
+
+    :param data_dir: directory of JSON fixture files
+    :return: data_dict: dictionary of list of rows with file name without extension as key
+    """
+    output = {}
+    for file_path in sorted(glob.glob(os.path.join(data_dir, '*.json'))):
+        with open(file_path) as json_file:
+            output[os.path.splitext(os.path.basename(file_path))[0]] = json.load(json_file)
+    return output
+
+
+def parse_weights(value=None):
+    """
+    Parse weights of requests from "<request name>=<weight>,..." string.
+
+    :param value: string of weights
+    :return: data_dict: dictionary of weight with request name as key
+    """
+    output = {}
+    for one_item in (value or '').split(','):
+        if one_item.strip() == '':
+            continue
+        name, weight = one_item.rsplit('=', 1)
+        output[name.strip()] = float(weight)
+    return output
+
+
+def get_percentile(sorted_values=None, percentile=None):
+    """
+    Get percentile of sorted values with nearest-rank method.
+
+    :param sorted_values: sorted list of values
+    :param percentile: percentile between 0 and 100
+    :return: value at the percentile or None if there is no value
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(percentile / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class LoadReplay(object):
+    """
+    Class object for replaying weighted requests and collecting latency per request name.
+
+    In closed loop mode every worker sends the next request when the previous one is done.
+    In open loop mode (rate is given) requests are sent at Poisson arrival times and latency
+    is measured from the scheduled time, so a slow server is not hidden by fewer requests.
+    """
+
+    def __init__(self, base_url=None, requests_list=None, fixtures=None, weights=None, seed=None, timeout=10,
+                 run_tag=None):
+        """
+        Initiate replay
+
+        :param base_url: base URL of the running instance replacing host of collection URLs
+        :param requests_list: list of requests, see load_collection() function
+        :param fixtures: dictionary of fixtures, see load_fixtures() function
+        :param weights: dictionary of weight with request name as key. Default weight is 1
+        :param seed: seed of random generator so runs replay the same sequence
+        :param timeout: request timeout in seconds
+        :param run_tag: tag added to artist and title of added songs, default is the start time of the replay,
+                        so songs of an earlier run with the same seed are not rejected as duplicates
+        """
+        self._base_url = urlsplit(base_url)
+        self._requests = requests_list
+        self._fixtures = fixtures or {}
+        self._weights = [(weights or {}).get(r['name'], 1.0) for r in requests_list]
+        self._random = random.Random(seed)
+        self._timeout = timeout
+        self._song_ids = []
+        self._run_tag = run_tag or '{:x}'.format(int(time.time()))
+        self._song_counter = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._results = {}
+
+    def get_session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def get_url(self, url=None):
+        parts = urlsplit(url)
+        return urlunsplit((self._base_url.scheme, self._base_url.netloc, parts.path, parts.query, parts.fragment))
+
+    def load_song_ids(self, total=100):
+        """
+        Fetch ids of existing songs from the instance to replace stale ids of the collection.
+
+        :param total: maximum number of fetched ids
+        :return:
+        """
+        response = self.get_session().get(self.get_url('/songs?limit={}&page=1&count=false'.format(total)),
+                                          timeout=self._timeout)
+        response.raise_for_status()
+        self._song_ids = [song['_id'] for song in response.json()['result']]
+
+    def prepare(self, one_request=None, rand=None):
+        """
+        Prepare request with song ids and bodies taken from fixtures.
+
+        :param one_request: dictionary of request, see load_collection() function
+        :param rand: random generator
+        :return: tuple of method, url, headers and body
+        """
+        url = self.get_url(one_request['url'])
+        body = one_request['body']
+
+        if self._song_ids:
+            url = OBJECT_ID_PATTERN.sub(lambda m: rand.choice(self._song_ids), url)
+
+        if body is not None:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+
+            if isinstance(data, dict):
+                if 'rating' in data:
+                    ratings = self._fixtures.get('stat_rating_songs') or [data]
+                    data['rating'] = rand.choice(ratings)['rating']
+                    if self._song_ids:
+                        data['song_id'] = rand.choice(self._song_ids)
+                elif 'artist' in data:
+                    if self._fixtures.get('songs'):
+                        data = dict(rand.choice(self._fixtures['songs']))
+                    data.update(self.get_song_names(data))
+                body = json.dumps(data)
+
+        return one_request['method'], url, one_request['headers'], body
+
+    def get_song_names(self, data=None):
+        """
+        Get unique artist and title of added song, so the request is not rejected by the natural-key unique index.
+
+        :param data: dictionary of song data
+        :return: data_dict: dictionary with 'artist' and 'title' keys
+        """
+        with self._lock:
+            self._song_counter += 1
+            suffix = ' #{}-{}'.format(self._run_tag, self._song_counter)
+        return {'artist': '{}{}'.format(data.get('artist', ''), suffix),
+                'title': '{}{}'.format(data.get('title', ''), suffix)}
+
+    def record(self, name=None, latency=None, status_code=None, error=None):
+        with self._lock:
+            result = self._results.setdefault(name, {'latencies': [], 'status_codes': {}, 'exceptions': 0})
+            result['latencies'].append(latency)
+            if error is not None:
+                result['exceptions'] += 1
+            else:
+                result['status_codes'][status_code] = result['status_codes'].get(status_code, 0) + 1
+
+    def send(self, index=None, scheduled_time=None, rand_seed=None):
+        """
+        Send one request and record its latency.
+
+        :param index: index of request in request list
+        :param scheduled_time: monotonic time the request should have been sent, default is now
+        :param rand_seed: seed of random generator used for preparing the request
+        :return:
+        """
+        one_request = self._requests[index]
+        method, url, headers, body = self.prepare(one_request, random.Random(rand_seed))
+        if scheduled_time is None:
+            scheduled_time = time.monotonic()
+
+        status_code = None
+        error = None
+        try:
+            response = self.get_session().request(method, url, headers=headers, data=body, timeout=self._timeout)
+            status_code = response.status_code
+        except requests.RequestException as e:
+            error = e
+        self.record(one_request['name'], time.monotonic() - scheduled_time, status_code, error)
+
+    def next_request(self):
+        with self._lock:
+            index = self._random.choices(range(len(self._requests)), weights=self._weights)[0]
+            return index, self._random.random()
+
+    def run_closed_loop(self, concurrency=None, duration=None, total_requests=None):
+        end_time = time.monotonic() + duration if duration else None
+        counter = {'sent': 0}
+
+        def worker():
+            while True:
+                with self._lock:
+                    if total_requests is not None and counter['sent'] >= total_requests:
+                        return
+                    counter['sent'] += 1
+                if end_time is not None and time.monotonic() >= end_time:
+                    return
+                index, rand_seed = self.next_request()
+                self.send(index=index, rand_seed=rand_seed)
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def run_open_loop(self, rate=None, concurrency=None, duration=None, total_requests=None):
+        start_time = time.monotonic()
+        scheduled_time = start_time
+        sent = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                if total_requests is not None and sent >= total_requests:
+                    break
+                scheduled_time += self._random.expovariate(rate)
+                if duration and scheduled_time - start_time >= duration:
+                    break
+
+                delay = scheduled_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                index, rand_seed = self.next_request()
+                executor.submit(self.send, index, scheduled_time, rand_seed)
+                sent += 1
+
+    def run(self, concurrency=8, rate=None, duration=None, total_requests=None):
+        """
+        Run replay. Either duration or total_requests must be given.
+
+        :param concurrency: number of workers (closed loop) or maximum number of in-flight requests (open loop)
+        :param rate: number of arrivals per second. Closed loop mode is used if None
+        :param duration: number of seconds of the run
+        :param total_requests: number of sent requests
+        :return: data_dict: report, see get_report() function
+        """
+        if not duration and total_requests is None:
+            raise ValueError("Require duration or total number of requests")
+
+        self._results = {}
+        start_time = time.monotonic()
+        if rate:
+            self.run_open_loop(rate=rate, concurrency=concurrency, duration=duration, total_requests=total_requests)
+        else:
+            self.run_closed_loop(concurrency=concurrency, duration=duration, total_requests=total_requests)
+        return self.get_report(elapsed=time.monotonic() - start_time)
+
+    def get_report(self, elapsed=None):
+        """
+        Get latency percentiles, throughput and error rates per request name.
+
+        :param elapsed: number of seconds of the run
+        :return: data_dict: dictionary of report data with request name as key, 'ALL' key for all requests
+        """
+        output = {}
+        all_result = {'latencies': [], 'status_codes': {}, 'exceptions': 0}
+        for name, result in list(self._results.items()) + [('ALL', all_result)]:
+            if name != 'ALL':
+                all_result['latencies'].extend(result['latencies'])
+                all_result['exceptions'] += result['exceptions']
+                for status_code, count in result['status_codes'].items():
+                    all_result['status_codes'][status_code] = all_result['status_codes'].get(status_code, 0) + count
+
+            latencies = sorted(result['latencies'])
+            total = len(latencies)
+            errors = result['exceptions'] + sum(count for status_code, count in result['status_codes'].items()
+                                                if status_code >= 500)
+            client_errors = sum(count for status_code, count in result['status_codes'].items()
+                                if 400 <= status_code < 500)
+            report = {
+                'total': total,
+                'throughput': total / elapsed if elapsed else None,
+                'error_rate': errors / total if total else None,
+                'client_error_rate': client_errors / total if total else None,
+                'status_codes': {str(k): v for k, v in sorted(result['status_codes'].items())},
+                'exceptions': result['exceptions'],
+                'max_ms': latencies[-1] * 1000 if latencies else None
+            }
+            for percentile in PERCENTILES:
+                value = get_percentile(latencies, percentile)
+                report['p{}_ms'.format(percentile)] = value * 1000 if value is not None else None
+            output[name] = report
+        return output
+
+
+def print_report(report=None, previous=None):
+    """
+    Print report table, with change of p50/p99 latency and throughput compared to previous report if given.
+
+    :param report: dictionary of report data, see get_report() function in LoadReplay class
+    :param previous: dictionary of report data of previous run
+    :return:
+    """
+    columns = ['total', 'throughput', 'error_rate', 'client_error_rate']
+    columns += ['p{}_ms'.format(p) for p in PERCENTILES] + ['max_ms']
+    print('{:<36}'.format('request') + ''.join('{:>18}'.format(c) for c in columns))
+    for name, result in sorted(report.items(), key=lambda item: item[0] == 'ALL'):
+        values = []
+        for column in columns:
+            value = result[column]
+            values.append('{:>18}'.format('-' if value is None else '{:.2f}'.format(value)))
+        print('{:<36}'.format(name[:35]) + ''.join(values))
+
+        old_result = (previous or {}).get(name)
+        if old_result:
+            changes = []
+            for column in ('throughput', 'p50_ms', 'p99_ms'):
+                if result[column] and old_result.get(column):
+                    changes.append('{} {:+.1f}%'.format(column, (result[column] / old_result[column] - 1) * 100))
+            print('{:<36}{}'.format('  vs previous', ', '.join(changes)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay Postman collection requests against a running instance')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--collection', default=DEFAULT_COLLECTION)
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--weights', default='', help='"<request name>=<weight>,..." default weight is 1')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=None, help='arrivals per second, enables open loop mode')
+    parser.add_argument('--duration', type=float, default=None, help='seconds of the run')
+    parser.add_argument('--requests', type=int, default=None, help='number of sent requests')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--output', default=None, help='save report with run settings to JSON file')
+    parser.add_argument('--compare', default=None, help='JSON report of previous run to compare with')
+    args = parser.parse_args(argv)
+
+    if args.duration is None and args.requests is None:
+        args.duration = 10
+
+    replay = LoadReplay(base_url=args.base_url, requests_list=load_collection(args.collection),
+                        fixtures=load_fixtures(args.data_dir), weights=parse_weights(args.weights),
+                        seed=args.seed, timeout=args.timeout)
+    replay.load_song_ids()
+    report = replay.run(concurrency=args.concurrency, rate=args.rate, duration=args.duration,
+                        total_requests=args.requests)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as json_file:
+            previous = json.load(json_file)['report']
+    print_report(report, previous)
+
+    if args.output:
+        settings = {k: v for k, v in vars(args).items() if k not in ('output', 'compare')}
+        with open(args.output, 'w') as json_file:
+            json.dump({'timestamp': datetime.datetime.utcnow().isoformat(), 'settings': settings, 'report': report},
+                      json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import math
+import threading
+import time
+
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+app = current_app
+
+PRIORITY_HIGH = 'high'
+PRIORITY_LOW = 'low'
+
+
+def get_admission_controller():
+    """
+    Get admission controller object of the current app
+
+    :return: AdmissionController object or None if admission control is disabled
+    """
+    return app.config.get('admission_controller', None)
+
+
+class TokenBucket(object):
+    """
+    Class object of token bucket rate limiter
+
+    """
+
+    def __init__(self, rate=None, burst=None):
+        """
+        Initiate full bucket
+
+        :param rate: number of tokens added per second
+        :param burst: maximum number of tokens in the bucket. Default is the rate value
+        """
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Take one token from the bucket.
+
+        :return: wait_time: 0 if token is taken otherwise number of seconds until next token is available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+class AdmissionController(object):
+    """
+    Class object for admitting or shedding requests of each end point inside a worker process.
+
+    Every end point may have a token bucket rate limit and its own cap of in-flight requests.
+    All end points share the worker's in-flight budget, low priority end points can only use
+    a share of it so high priority ones (catalog reads) keep flowing while writes are shed.
+    """
+
+    def __init__(self, limits=None, max_in_flight=64, low_priority_share=0.5, default_max_wait=0.5):
+        """
+        Initiate controller
+
+        :param limits: dictionary of end point settings with end point name as key. Possible settings are
+                       'priority' ('high' or 'low'), 'rate', 'burst', 'max_in_flight' and 'max_wait'
+        :param max_in_flight: maximum number of concurrent requests of the worker
+        :param low_priority_share: fraction of max_in_flight that low priority end points can use
+        :param default_max_wait: number of seconds a request can wait for a free slot before it is shed
+        """
+        self._limits = limits or {}
+        self._max_in_flight = max_in_flight
+        self._low_max_in_flight = max(1, int(max_in_flight * low_priority_share))
+        self._default_max_wait = default_max_wait
+        self._buckets = {}
+        self._in_flight = 0
+        self._endpoint_in_flight = {}
+        self._stats = {}
+        self._condition = threading.Condition()
+
+        for endpoint, setting in self._limits.items():
+            if setting.get('rate') is not None:
+                self._buckets[endpoint] = TokenBucket(rate=setting['rate'], burst=setting.get('burst'))
+
+    def _get_stat(self, endpoint=None):
+        if endpoint not in self._stats:
+            self._stats[endpoint] = {
+                'admitted': 0,
+                'shed_rate_limit': 0,
+                'shed_overload': 0,
+                'total_wait_time': 0.0,
+                'max_wait_time': 0.0
+            }
+        return self._stats[endpoint]
+
+    def _has_slot(self, endpoint=None, setting=None):
+        if setting.get('priority', PRIORITY_HIGH) == PRIORITY_LOW:
+            limit = self._low_max_in_flight
+        else:
+            limit = self._max_in_flight
+        if self._in_flight >= limit:
+            return False
+
+        endpoint_limit = setting.get('max_in_flight')
+        if endpoint_limit is not None and self._endpoint_in_flight.get(endpoint, 0) >= endpoint_limit:
+            return False
+        return True
+
+    def admit(self, endpoint=None):
+        """
+        Admit a request of given end point or raise HTTP error if it has to be shed.
+        Admitted request must be released with release() function.
+
+        :param endpoint: string of end point name
+        :return: endpoint: string of admitted end point name
+        """
+        setting = self._limits.get(endpoint, {})
+
+        bucket = self._buckets.get(endpoint)
+        if bucket is not None:
+            retry_after = bucket.take()
+            if retry_after > 0:
+                with self._condition:
+                    self._get_stat(endpoint)['shed_rate_limit'] += 1
+                error = TooManyRequests(retry_after=int(math.ceil(retry_after)))
+                error.data = {'error_message': 'Too many requests'}
+                raise error
+
+        max_wait = setting.get('max_wait', self._default_max_wait)
+        started = time.monotonic()
+        with self._condition:
+            stat = self._get_stat(endpoint)
+            admitted = self._condition.wait_for(lambda: self._has_slot(endpoint, setting), timeout=max_wait)
+            wait_time = time.monotonic() - started
+            stat['total_wait_time'] += wait_time
+            stat['max_wait_time'] = max(stat['max_wait_time'], wait_time)
+
+            if not admitted:
+                stat['shed_overload'] += 1
+                error = ServiceUnavailable(retry_after=1)
+                error.data = {'error_message': 'Server is overloaded'}
+                raise error
+
+            stat['admitted'] += 1
+            self._in_flight += 1
+            self._endpoint_in_flight[endpoint] = self._endpoint_in_flight.get(endpoint, 0) + 1
+
+        return endpoint
+
+    def release(self, endpoint=None):
+        """
+        Release in-flight slot of admitted request.
+
+        :param endpoint: string of end point name returned by admit() function
+        :return:
+        """
+        with self._condition:
+            self._in_flight -= 1
+            self._endpoint_in_flight[endpoint] -= 1
+            self._condition.notify_all()
+
+    def get_stats(self):
+        """
+        Get admission statistic data of all end points.
+
+        :return: data_dict: dictionary with following keys:
+                 'in_flight': number of in-flight requests of the worker
+                 'endpoints': dictionary of end point statistic data with end point name as key
+        """
+        with self._condition:
+            endpoints = {}
+            for endpoint, stat in self._stats.items():
+                waited = stat['admitted'] + stat['shed_overload']
+                endpoints[endpoint] = {
+                    'priority': self._limits.get(endpoint, {}).get('priority', PRIORITY_HIGH),
+                    'in_flight': self._endpoint_in_flight.get(endpoint, 0),
+                    'admitted': stat['admitted'],
+                    'shed_rate_limit': stat['shed_rate_limit'],
+                    'shed_overload': stat['shed_overload'],
+                    'avg_wait_ms': (stat['total_wait_time'] / waited * 1000) if waited else 0.0,
+                    'max_wait_ms': stat['max_wait_time'] * 1000
+                }
+            return {'in_flight': self._in_flight, 'endpoints': endpoints}
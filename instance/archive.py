@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import datetime
+import glob
+import gzip
+import os
+import time
+
+from bson import json_util
+from flask import current_app
+from pymongo.errors import DuplicateKeyError
+
+from instance.storage import get_rating_summary, get_storage
+
+app = current_app
+
+PARTITION_PREFIX = 'date='
+FILE_SUFFIX = '.json.gz'
+
+
+def write_columns(file_path=None, documents=None):
+    """
+    Write documents to gzip compressed file of columns.
+    File content is {"count": <number of rows>, "columns": {<field name>: [<values>]}} in MongoDB extended JSON.
+
+    :param file_path: full file path
+    :param documents: list of documents
+    :return:
+    """
+    fields = []
+    for document in documents:
+        for field in document:
+            if field not in fields:
+                fields.append(field)
+
+    columns = {field: [document.get(field) for document in documents] for field in fields}
+    temp_path = file_path + '.tmp'
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as archive_file:
+        archive_file.write(json_util.dumps({'count': len(documents), 'columns': columns}))
+    os.replace(temp_path, file_path)
+
+
+def read_columns(file_path=None, fields=None):
+    """
+    Read columns from file written by write_columns() function.
+
+    :param file_path: full file path
+    :param fields: list of field names for reading, all fields if None
+    :return: data_dict: dictionary of list of values with field name as key
+    """
+    with gzip.open(file_path, 'rt', encoding='utf-8') as archive_file:
+        data = json_util.loads(archive_file.read())
+
+    columns = data['columns']
+    if fields is None:
+        return columns
+    return {field: columns.get(field, [None] * data['count']) for field in fields}
+
+
+def get_batch_summaries(documents=None):
+    """
+    Get rating summary of every song of a batch of ratings.
+
+    :param documents: list of rating documents
+    :return: data_dict: dictionary of summary with song object id as key, see get_rating_summary() function
+    """
+    values = {}
+    for document in documents:
+        if document.get('rating') is not None:
+            values.setdefault(document['song_id'], []).append(document['rating'])
+    return {song_id: get_rating_summary(song_values) for song_id, song_values in values.items()}
+
+
+def get_batch_key(document=None):
+    """
+    Get key of archive batch from its last rating. Keys increase with archive order (creation date and id).
+
+    :param document: rating document
+    :return: string of batch key
+    """
+    return '{:%Y-%m-%dT%H:%M:%S.%f}-{}'.format(document['creation_date'], document['_id'])
+
+
+class RatingArchive(object):
+    """
+    Class object for moving old ratings to compressed columnar files partitioned by creation date.
+
+    Files are written as <archive dir>/date=YYYY-MM-DD/part-<first id>-<last id>.json.gz and rating count,
+    sum, minimum and maximum of every song are added to its rating summary before the ratings are deleted,
+    so rating statistic data of songs does not change. A failed run can be repeated: the same batch is
+    written to the same file again and is not added twice to the summaries. Ratings are only deduplicated
+    within a partition, since a batch of a repeated run is written to the partitions of the first run.
+    """
+
+    def __init__(self, archive_dir=None):
+        """
+        Initiate archive
+
+        :param archive_dir: root directory of archive files
+        """
+        self._archive_dir = archive_dir
+
+    def get_partition_dir(self, date=None):
+        return os.path.join(self._archive_dir, '{}{}'.format(PARTITION_PREFIX, date.strftime('%Y-%m-%d')))
+
+    def write_batch(self, documents=None):
+        """
+        Write batch of ratings to partition files of their creation date.
+
+        :param documents: list of rating documents ordered by creation date
+        :return: list: list of written file paths
+        """
+        partitions = {}
+        for document in documents:
+            partitions.setdefault(document['creation_date'].date(), []).append(document)
+
+        file_paths = []
+        for date, partition_documents in sorted(partitions.items()):
+            partition_dir = self.get_partition_dir(date)
+            os.makedirs(partition_dir, exist_ok=True)
+            file_name = 'part-{}-{}{}'.format(partition_documents[0]['_id'], partition_documents[-1]['_id'],
+                                              FILE_SUFFIX)
+            file_path = os.path.join(partition_dir, file_name)
+            write_columns(file_path=file_path, documents=partition_documents)
+            file_paths.append(file_path)
+        return file_paths
+
+    def archive(self, before=None, batch_size=1000, pause=0.0, max_batches=None):
+        """
+        Move ratings created before given date to archive files in batches.
+
+        :param before: datetime object of archive horizon
+        :param batch_size: number of ratings per batch
+        :param pause: number of seconds to sleep between batches to reduce load of the database
+        :param max_batches: maximum number of batches of this run, no limit if None
+        :return: data_dict: dictionary with 'archived' number of ratings and 'files' list of written files
+        """
+        storage = get_storage()
+        result = {'archived': 0, 'files': []}
+        batch_count = 0
+        while max_batches is None or batch_count < max_batches:
+            documents = storage.find_old_ratings(before=before, limit=batch_size)
+            if not documents:
+                break
+
+            result['files'].extend(self.write_batch(documents))
+            storage.add_rating_summaries(summaries=get_batch_summaries(documents),
+                                         batch_key=get_batch_key(documents[-1]))
+            deleted_count = storage.delete_ratings(rating_ids=[document['_id'] for document in documents],
+                                                   song_ids=[document['song_id'] for document in documents])
+            result['archived'] += deleted_count
+            batch_count += 1
+            app.logger.debug('Archived %s ratings before %s', result['archived'], before)
+
+            if len(documents) < batch_size or deleted_count == 0:
+                break
+            if pause:
+                time.sleep(pause)
+
+        return result
+
+    def list_files(self, start=None, end=None):
+        """
+        List archive files of partitions between start and end date.
+
+        :param start: date object of first partition, no limit if None
+        :param end: date object of last partition, no limit if None
+        :return: list: list of file paths ordered by date
+        """
+        output = []
+        for partition_dir in sorted(glob.glob(os.path.join(self._archive_dir, PARTITION_PREFIX + '*'))):
+            date = datetime.datetime.strptime(os.path.basename(partition_dir)[len(PARTITION_PREFIX):], '%Y-%m-%d')
+            date = date.date()
+            if (start is not None and date < start) or (end is not None and date > end):
+                continue
+            output.extend(sorted(glob.glob(os.path.join(partition_dir, '*' + FILE_SUFFIX))))
+        return output
+
+    def iter_partition_files(self, start=None, end=None):
+        """
+        List archive files with set of ids of read ratings of their partition, see iter_file() function.
+
+        :param start: date object of first partition, no limit if None
+        :param end: date object of last partition, no limit if None
+        :return: generator of tuple of file path and set of ids shared by files of the same partition
+        """
+        partition_dir = None
+        seen = None
+        for file_path in self.list_files(start=start, end=end):
+            if os.path.dirname(file_path) != partition_dir:
+                partition_dir = os.path.dirname(file_path)
+                seen = set()
+            yield file_path, seen
+
+    def iter_ratings(self, start=None, end=None, song_ids=None):
+        """
+        Scan archived ratings.
+
+        :param start: date object of first partition, no limit if None
+        :param end: date object of last partition, no limit if None
+        :param song_ids: list of song object id for filtering, all songs if None
+        :return: generator of rating documents
+        """
+        if song_ids is not None:
+            song_ids = set(song_ids)
+
+        for file_path, seen in self.iter_partition_files(start=start, end=end):
+            for document in self.iter_file(file_path=file_path, seen=seen):
+                if song_ids is None or document.get('song_id') in song_ids:
+                    yield document
+
+    def iter_file(self, file_path=None, seen=None):
+        """
+        Read ratings of an archive file.
+
+        :param file_path: full file path
+        :param seen: set of ids of already read ratings, which are skipped. Ids of read ratings are added to it
+        :return: generator of rating documents
+        """
+        columns = read_columns(file_path=file_path)
+        fields = list(columns)
+        for values in zip(*[columns[field] for field in fields]):
+            document = dict(zip(fields, values))
+            if document['_id'] in seen:
+                continue
+            seen.add(document['_id'])
+            yield document
+
+    def restore(self, start=None, end=None):
+        """
+        Insert archived ratings back to ratings collection. Ratings which already exist and ratings of deleted
+        songs are skipped. Files of restored partitions are removed and summaries of their ratings are
+        subtracted from rating summaries.
+
+        :param start: date object of first partition, no limit if None
+        :param end: date object of last partition, no limit if None
+        :return: restored: number of restored ratings
+        """
+        storage = get_storage()
+        restored = 0
+        song_exists = {}
+        for file_path, seen in self.iter_partition_files(start=start, end=end):
+            documents = list(self.iter_file(file_path=file_path, seen=seen))
+            for document in documents:
+                song_id = document['song_id']
+                if song_id not in song_exists:
+                    song_exists[song_id] = storage.has_song(song_id=song_id)
+                if not song_exists[song_id]:
+                    continue
+                try:
+                    storage.insert_rating(data=document)
+                    restored += 1
+                except DuplicateKeyError:
+                    pass
+
+            storage.subtract_rating_summaries(summaries=get_batch_summaries(documents))
+            os.remove(file_path)
+            partition_dir = os.path.dirname(file_path)
+            if not os.listdir(partition_dir):
+                os.rmdir(partition_dir)
+        return restored
@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import datetime
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+import bson
+from flask import current_app
+
+from instance.similar import SimilarIndex
+from instance.storage import get_storage
+from instance.suggest import SuggestIndex
+
+app = current_app
+
+SNAPSHOT_MAGIC = b'SONGCAT1'
+SNAPSHOT_VERSION = 3
+# Fields of songs kept in snapshot, other fields are not used by in-memory indexes
+SNAPSHOT_FIELDS = ('artist', 'title', 'level', 'difficulty', 'released')
+STRING_FIELDS = ('artist', 'title', 'released')
+
+# Header: magic, version, number of songs, creation time (unix seconds), string table size,
+# change counter of songs (see get_songs_version() function of storage), number of suggestion keys
+# and number of songs with level and difficulty
+_HEADER = struct.Struct('<8sIIdQQII')
+_MISSING_STRING = 0xFFFFFFFF
+# Released date is kept as number of days since 1970-01-01, missing date has the value of NumPy NaT
+_MISSING_DAYS = -2 ** 63
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def get_padded(size=None):
+    return (size + 7) // 8 * 8
+
+
+def get_layout(count=None, suggest_count=0, similar_count=0):
+    """
+    Get byte offset of every array of snapshot file with given number of songs and index entries.
+    Arrays follow the header, each one starts at multiple of 8 bytes:
+    ids (12 bytes per song), level and difficulty (float64, NaN if missing), released date (int64 days),
+    (offset, length) uint32 pairs of artist, title and released in string table, number of ratings (uint32),
+    built suggestion index: (offset, length) uint32 pairs of keys in string table and song positions (uint32)
+    sorted by key and song id, and built similar index: song positions (uint32) sorted by level, difficulty
+    and song id.
+
+    :param count: number of songs
+    :param suggest_count: number of suggestion keys
+    :param similar_count: number of songs with level and difficulty
+    :return: data_dict: dictionary of offset with array name as key, 'strings' is offset of string table
+    """
+    layout = {}
+    offset = get_padded(_HEADER.size)
+    for name, item_size in (('ids', 12 * count), ('level', 8 * count), ('difficulty', 8 * count),
+                            ('released_days', 8 * count), ('artist', 8 * count), ('title', 8 * count),
+                            ('released', 8 * count), ('ratings', 4 * count), ('suggest_keys', 8 * suggest_count),
+                            ('suggest_songs', 4 * suggest_count), ('similar', 4 * similar_count)):
+        layout[name] = offset
+        offset += get_padded(item_size)
+    layout['strings'] = offset
+    return layout
+
+
+def get_number(value=None):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return math.nan
+    return float(value)
+
+
+def get_days(value=None):
+    """
+    Get released date as number of days since 1970-01-01.
+
+    :param value: string of released date in 'YYYY-MM-DD' format
+    :return: number of days, _MISSING_DAYS if the value is not a valid date
+    """
+    try:
+        return (datetime.datetime.strptime(str(value), '%Y-%m-%d') - _EPOCH).days
+    except ValueError:
+        return _MISSING_DAYS
+
+
+def get_level(value=None):
+    return int(value) if value.is_integer() else value
+
+
+def write_snapshot(file_path=None, documents=None, created=None, songs_version=0, rating_counts=None):
+    """
+    Write songs and their built suggestion and similar index entries to snapshot file.
+    The file is replaced atomically, so readers keep their mapping of old file.
+
+    :param file_path: full file path
+    :param documents: iterable of song documents with '_id' and SNAPSHOT_FIELDS fields
+    :param created: datetime object of reading the songs, default is now
+    :param songs_version: change counter of songs read before the songs
+    :param rating_counts: dictionary of number of ratings created before 'created' with song object id as key
+    :return: count: number of written songs
+    """
+    if created is None:
+        created = datetime.datetime.utcnow()
+    documents = list(documents)
+    rating_counts = rating_counts or {}
+    count = len(documents)
+
+    ids = bytearray()
+    numbers = {'level': [], 'difficulty': []}
+    released_days = []
+    string_refs = {field: [] for field in STRING_FIELDS}
+    strings = bytearray()
+    ratings = []
+    suggest_entries = []
+    similar_entries = []
+    for index, document in enumerate(documents):
+        song_id = bson.ObjectId(str(document['_id']))
+        ids += song_id.binary
+        ratings.append(rating_counts.get(song_id, 0))
+        for field in numbers:
+            numbers[field].append(get_number(document.get(field)))
+        released_days.append(get_days(document.get('released')))
+        for field in STRING_FIELDS:
+            value = document.get(field)
+            if value is None:
+                string_refs[field].extend((_MISSING_STRING, 0))
+                continue
+            data = str(value).encode('utf-8')
+            string_refs[field].extend((len(strings), len(data)))
+            strings += data
+
+        for key in SuggestIndex.get_keys(artist=document.get('artist'), title=document.get('title')):
+            suggest_entries.append((key, str(song_id), index))
+        point = SimilarIndex.get_point(document)
+        if point is not None:
+            similar_entries.append((point[0], point[1], str(song_id), index))
+
+    # Keys shared by many songs are written once to the string table
+    suggest_entries.sort()
+    key_refs = {}
+    suggest_keys = []
+    for key, song_id, index in suggest_entries:
+        if key not in key_refs:
+            data = key.encode('utf-8')
+            key_refs[key] = (len(strings), len(data))
+            strings += data
+        suggest_keys.extend(key_refs[key])
+    similar_entries.sort()
+
+    layout = get_layout(count, len(suggest_entries), len(similar_entries))
+    header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, count, (created - _EPOCH).total_seconds(),
+                          len(strings), songs_version, len(suggest_entries), len(similar_entries))
+
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(header)
+        parts = [('ids', bytes(ids))]
+        parts.extend((field, struct.pack('<{}d'.format(count), *numbers[field])) for field in numbers)
+        parts.append(('released_days', struct.pack('<{}q'.format(count), *released_days)))
+        parts.extend((field, struct.pack('<{}I'.format(2 * count), *string_refs[field])) for field in STRING_FIELDS)
+        parts.append(('ratings', struct.pack('<{}I'.format(count), *ratings)))
+        parts.append(('suggest_keys', struct.pack('<{}I'.format(len(suggest_keys)), *suggest_keys)))
+        parts.append(('suggest_songs', struct.pack('<{}I'.format(len(suggest_entries)),
+                                                   *[entry[2] for entry in suggest_entries])))
+        parts.append(('similar', struct.pack('<{}I'.format(len(similar_entries)),
+                                             *[entry[3] for entry in similar_entries])))
+        parts.append(('strings', bytes(strings)))
+        for name, data in parts:
+            snapshot_file.write(b'\0' * (layout[name] - snapshot_file.tell()))
+            snapshot_file.write(data)
+    os.replace(temp_path, file_path)
+    return count
+
+
+class CatalogSnapshot(object):
+    """
+    Class object for reading snapshot file written by write_snapshot() function.
+
+    The file is memory mapped read-only and its arrays are read in place, a song is decoded only
+    when it is read. Workers fill their in-memory indexes from the sorted index entries and copy the
+    statistic columns as whole arrays, so startup saves the scan of the songs collection, the count of
+    ratings and the tokenizing and sorting of songs, not the memory of the indexes.
+    """
+
+    def __init__(self, file_path=None):
+        """
+        Open and validate snapshot file
+
+        :param file_path: full file path
+        """
+        with open(file_path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if len(self._mmap) < _HEADER.size:
+                raise ValueError("Invalid catalog snapshot: {}".format(file_path))
+            magic, version, count, created, strings_size, songs_version, suggest_count, similar_count = \
+                _HEADER.unpack_from(self._mmap, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError("Invalid catalog snapshot: {}".format(file_path))
+            layout = get_layout(count, suggest_count, similar_count)
+            if len(self._mmap) != layout['strings'] + strings_size:
+                raise ValueError("Invalid catalog snapshot size: {}".format(file_path))
+        except ValueError:
+            self._mmap.close()
+            raise
+
+        self.count = count
+        self.created = _EPOCH + datetime.timedelta(seconds=created)
+        self.songs_version = songs_version
+        self._layout = layout
+        self._song_ids = None
+        self._view = view = memoryview(self._mmap)
+        self._ids = view[layout['ids']:layout['ids'] + 12 * count]
+        self._numbers = {field: view[layout[field]:layout[field] + 8 * count].cast('d')
+                         for field in ('level', 'difficulty')}
+        self._released_days = view[layout['released_days']:layout['released_days'] + 8 * count].cast('q')
+        self._string_refs = {field: view[layout[field]:layout[field] + 8 * count].cast('I')
+                             for field in STRING_FIELDS}
+        self._string_refs['suggest_keys'] = view[layout['suggest_keys']:
+                                                 layout['suggest_keys'] + 8 * suggest_count].cast('I')
+        self._ratings = view[layout['ratings']:layout['ratings'] + 4 * count].cast('I')
+        self._suggest_songs = view[layout['suggest_songs']:layout['suggest_songs'] + 4 * suggest_count].cast('I')
+        self._similar = view[layout['similar']:layout['similar'] + 4 * similar_count].cast('I')
+        self._strings = view[layout['strings']:]
+
+    def __len__(self):
+        return self.count
+
+    def get_string(self, field=None, index=None):
+        offset = self._string_refs[field][2 * index]
+        if offset == _MISSING_STRING:
+            return None
+        length = self._string_refs[field][2 * index + 1]
+        return bytes(self._strings[offset:offset + length]).decode('utf-8')
+
+    def get_document(self, index=None):
+        """
+        Decode a song.
+
+        :param index: position of the song in snapshot
+        :return: data_dict: song document with '_id' and SNAPSHOT_FIELDS fields, missing fields are None
+        """
+        document = {'_id': bson.ObjectId(bytes(self._ids[12 * index:12 * index + 12]))}
+        for field in ('level', 'difficulty'):
+            value = self._numbers[field][index]
+            if math.isnan(value):
+                document[field] = None
+            elif field == 'level':
+                document[field] = get_level(value)
+            else:
+                document[field] = value
+        for field in STRING_FIELDS:
+            document[field] = self.get_string(field, index)
+        return document
+
+    def iter_documents(self):
+        """
+        Decode all songs
+
+        :return: generator of song documents
+        """
+        for index in range(self.count):
+            yield self.get_document(index)
+
+    def get_song_ids(self):
+        """
+        Get ids of all songs, in order of songs in snapshot.
+
+        :return: list: list of song object id string
+        """
+        if self._song_ids is None:
+            ids = self._ids.hex()
+            self._song_ids = [ids[offset:offset + 24] for offset in range(0, len(ids), 24)]
+        return self._song_ids
+
+    def get_suggest_entries(self):
+        """
+        Get entries of suggestion index, see build() function of SuggestIndex class.
+
+        :return: list: list of tuple of lookup key and song id string sorted by key and song id
+        """
+        song_ids = self.get_song_ids()
+        return [(self.get_string('suggest_keys', position), song_ids[index])
+                for position, index in enumerate(self._suggest_songs)]
+
+    def get_similar_levels(self):
+        """
+        Get entries of similar song index, see build() function of SimilarIndex class.
+
+        :return: data_dict: dictionary of list of tuple of difficulty and song id string sorted by difficulty
+                 and song id, with level as key
+        """
+        song_ids = self.get_song_ids()
+        levels = {}
+        for index in self._similar:
+            level = get_level(self._numbers['level'][index])
+            levels.setdefault(level, []).append((self._numbers['difficulty'][index], song_ids[index]))
+        return levels
+
+    def get_stats_columns(self):
+        """
+        Get statistic columns of all songs, see build() function of SongStatsSnapshot class.
+        The columns are views of the mapped file and are valid until the snapshot is closed.
+
+        :return: tuple of level (float64), difficulty (float64) and released days (int64) memoryview objects
+        """
+        return self._numbers['level'], self._numbers['difficulty'], self._released_days
+
+    def get_rating_counts(self):
+        """
+        Get number of ratings created before the snapshot.
+
+        :return: data_dict: dictionary of number of ratings with song object id as key, songs without rating
+                 are not included
+        """
+        output = {}
+        for index, total in enumerate(self._ratings):
+            if total:
+                output[bson.ObjectId(bytes(self._ids[12 * index:12 * index + 12]))] = total
+        return output
+
+    def close(self):
+        views = [self._ids, self._ratings, self._released_days, self._suggest_songs, self._similar, self._strings]
+        views += list(self._numbers.values())
+        for view in views + list(self._string_refs.values()):
+            view.release()
+        self._view.release()
+        self._mmap.close()
+
+
+def get_string_keys(data_dict=None):
+    return {str(key): value for key, value in data_dict.items()}
+
+
+def load_catalog(file_path=None, delta_margin=300, batch_size=1000):
+    """
+    Load songs and their number of ratings for building in-memory indexes, from snapshot file plus songs and
+    ratings created after it, or from the database if there is no usable snapshot. Songs updated or deleted
+    after the snapshot are not seen by the delta, so the snapshot is used only if the change counter of songs
+    is the same as in the snapshot and the number of songs matches the database.
+
+    :param file_path: full file path of snapshot, snapshot is not used if None
+    :param delta_margin: seconds before snapshot creation time from which songs are read again
+    :param batch_size: number of songs per batch when reading the database
+    :return: tuple of open CatalogSnapshot object or None, list of song documents which are not in the snapshot
+             (all songs if there is no snapshot), dictionary of number of ratings with song id string as key
+             and 'snapshot' or 'database' source. The caller closes the snapshot.
+    """
+    storage = get_storage()
+    fields = list(SNAPSHOT_FIELDS)
+
+    if file_path is not None and os.path.exists(file_path):
+        try:
+            snapshot = CatalogSnapshot(file_path)
+        except (OSError, ValueError) as e:
+            app.logger.warning('Catalog snapshot is not used: %s', e)
+            snapshot = None
+
+        if snapshot is not None:
+            is_used = False
+            try:
+                if snapshot.songs_version == storage.get_songs_version():
+                    song_ids = set(snapshot.get_song_ids())
+                    start = snapshot.created - datetime.timedelta(seconds=delta_margin)
+                    documents = []
+                    for batch in storage.iter_batches(collection='songs', fields=fields, start=start,
+                                                      batch_size=batch_size):
+                        documents.extend(document for document in batch if str(document['_id']) not in song_ids)
+
+                    if snapshot.count + len(documents) == storage.count_songs():
+                        # Ratings are counted before and after exact creation time of the snapshot
+                        rating_counts = snapshot.get_rating_counts()
+                        for song_id, total in storage.count_ratings_by_song(start=snapshot.created).items():
+                            rating_counts[song_id] = rating_counts.get(song_id, 0) + total
+                        app.logger.debug('Catalog loaded from snapshot with %s songs and %s songs of delta',
+                                         snapshot.count, len(documents))
+                        is_used = True
+                        return snapshot, documents, get_string_keys(rating_counts), 'snapshot'
+                app.logger.warning('Catalog snapshot is out of date: %s', file_path)
+            finally:
+                if not is_used:
+                    snapshot.close()
+
+    documents = []
+    for batch in storage.iter_batches(collection='songs', fields=fields, batch_size=batch_size):
+        documents.extend(batch)
+    return None, documents, get_string_keys(storage.count_ratings_by_song()), 'database'
+
+
+def save_catalog(file_path=None, batch_size=1000):
+    """
+    Write snapshot file of all songs in the database with their number of ratings.
+
+    :param file_path: full file path
+    :param batch_size: number of songs per batch when reading the database
+    :return: count: number of written songs
+    """
+    storage = get_storage()
+    created = datetime.datetime.utcnow()
+    # Read before the songs, so a change made while reading them makes the snapshot out of date
+    songs_version = storage.get_songs_version()
+    documents = []
+    for batch in storage.iter_batches(collection='songs', fields=list(SNAPSHOT_FIELDS), batch_size=batch_size):
+        documents.extend(batch)
+    return write_snapshot(file_path=file_path, documents=documents, created=created, songs_version=songs_version,
+                          rating_counts=storage.count_ratings_by_song(end=created))
+
+
+class CatalogWriter(object):
+    """
+    Class object for writing catalog snapshot periodically from one process.
+
+    Every worker process runs a writer thread which wakes up every interval seconds. A round is run only by
+    the process holding the exclusive lock of <snapshot file>.lock, which is released when the round ends or
+    its process stops, and the snapshot is written only if it is older than interval seconds. Other processes
+    skip the round, so the database is read by one process per interval.
+    """
+
+    def __init__(self, flask_app=None, file_path=None, interval=600, batch_size=1000):
+        """
+        Initiate writer
+
+        :param flask_app: Flask app object, used for app context of the writer thread
+        :param file_path: full file path of snapshot
+        :param interval: number of seconds between snapshots
+        :param batch_size: number of songs per batch when reading the database
+        """
+        self._app = flask_app
+        self._file_path = file_path
+        self._interval = interval
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run_worker, name='catalog-writer', daemon=True)
+                self._thread.start()
+
+    def get_age(self):
+        """
+        Get age of snapshot file.
+
+        :return: number of seconds since the snapshot file was written, None if there is no file
+        """
+        try:
+            return time.time() - os.path.getmtime(self._file_path)
+        except OSError:
+            return None
+
+    def write(self):
+        """
+        Write snapshot if it is out of date and no other process is writing it.
+
+        :return: count: number of written songs or None if the snapshot is not written
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self._file_path)), exist_ok=True)
+        with open(self._file_path + '.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                # Checked under the lock, so a process waking up after other one wrote the snapshot skips it
+                age = self.get_age()
+                if age is not None and age < self._interval:
+                    return None
+                count = save_catalog(file_path=self._file_path, batch_size=self._batch_size)
+                app.logger.debug('Catalog snapshot written with %s songs', count)
+                return count
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def run_worker(self):
+        while True:
+            with self._app.app_context():
+                try:
+                    self.write()
+                except Exception:
+                    app.logger.exception('Catalog snapshot is not written: %s', self._file_path)
+            time.sleep(self._interval)
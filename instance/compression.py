@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import collections
+import hashlib
+import threading
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class _GzipCompressor(object):
+    def __init__(self, level=6):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class _BrotliCompressor(object):
+    def __init__(self, level=5):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+class _ZstdCompressor(object):
+    def __init__(self, level=3):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+def get_compressors():
+    """
+    Get available compressors in order of server preference
+
+    :return: ordered dictionary of compressor class with content encoding as key
+    """
+    compressors = collections.OrderedDict()
+    if zstandard is not None:
+        compressors['zstd'] = _ZstdCompressor
+    if brotli is not None:
+        compressors['br'] = _BrotliCompressor
+    compressors['gzip'] = _GzipCompressor
+    return compressors
+
+
+class ResponseCompressor(object):
+    """
+    Class object for compressing responses with encoding negotiated from Accept-Encoding header.
+
+    Compressed bodies of GET responses are kept in a small LRU cache keyed by body digest,
+    so hot responses are not compressed again on every request.
+    """
+
+    def __init__(self, min_size=1024, levels=None, cache_size=128):
+        """
+        Initiate compressor
+
+        :param min_size: minimum body size in bytes for compressing
+        :param levels: dictionary of compression level with content encoding as key
+        :param cache_size: maximum number of cached compressed bodies. 0 disables the cache
+        """
+        self._min_size = min_size
+        self._levels = levels or {}
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._compressors = get_compressors()
+
+    def init_app(self, app=None):
+        """
+        Register compressor to the app
+
+        :param app: app object
+        :return:
+        """
+        app.after_request(self.compress_response)
+
+    def get_encoding(self):
+        """
+        Get best content encoding accepted by the client.
+
+        :return: string of content encoding or None if client does not accept any available encoding
+        """
+        return request.accept_encodings.best_match(list(self._compressors.keys()))
+
+    def get_compressor(self, encoding=None):
+        """
+        Get new compressor object of given content encoding.
+
+        :param encoding: string of content encoding
+        :return: compressor object with compress() and flush() function
+        """
+        level = self._levels.get(encoding)
+        if level is None:
+            return self._compressors[encoding]()
+        return self._compressors[encoding](level=level)
+
+    def compress_data(self, data=None, encoding=None):
+        """
+        Compress data, reusing cached result of the same data if exists.
+
+        :param data: bytes for compressing
+        :param encoding: string of content encoding
+        :return: bytes of compressed data
+        """
+        if self._cache_size <= 0 or request.method != 'GET':
+            compressor = self.get_compressor(encoding)
+            return compressor.compress(data) + compressor.flush()
+
+        key = (encoding, hashlib.sha1(data).digest())
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        compressor = self.get_compressor(encoding)
+        compressed = compressor.compress(data) + compressor.flush()
+
+        with self._lock:
+            self._cache[key] = compressed
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return compressed
+
+    def compress_stream(self, iterable=None, encoding=None):
+        """
+        Compress chunks of streamed response.
+
+        :param iterable: iterable of response chunks
+        :param encoding: string of content encoding
+        :return: generator of compressed chunks
+        """
+        compressor = self.get_compressor(encoding)
+        for chunk in iterable:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+
+    def compress_response(self, response=None):
+        """
+        Compress response body if the client accepts it and the body is large enough.
+
+        :param response: response object
+        :return: response: response object
+        """
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return response
+        if response.direct_passthrough or 'Content-Encoding' in response.headers:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self.get_encoding()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self.compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self._min_size:
+                return response
+            response.set_data(self.compress_data(data, encoding))
+
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -3,6 +3,85 @@ class BaseConfig(object):
     TESTING = False
     MONGO_DBNAME = 'songs_db'
     MONGO_URI = 'mongodb://localhost:27017/songs_db'
+    # Storage of songs and ratings. Possible values are 'mongo' and 'memory' (in-process, for tests and benchmarks)
+    STORAGE_BACKEND = 'mongo'
+    # Ratings are spread over these Mongo deployments by hash of song id, ratings are kept in MONGO_URI if empty.
+    # Changing the list changes the shard of songs, existing ratings must be moved first.
+    RATING_SHARD_URIS = []
+    # Fields identifying a song, backed by a unique index and used as filter for upserts
+    SONG_NATURAL_KEY = ('artist', 'title', 'released')
+    # Number of upsert operations sent per bulk_write call when importing
+    IMPORT_BATCH_SIZE = 1000
+    # Admission control of end points inside each worker process
+    ADMISSION_ENABLED = True
+    ADMISSION_MAX_IN_FLIGHT = 64
+    # Fraction of ADMISSION_MAX_IN_FLIGHT usable by low priority end points
+    ADMISSION_LOW_PRIORITY_SHARE = 0.5
+    # Seconds a request can wait for a free slot before it is shed with 503
+    ADMISSION_MAX_WAIT = 0.5
+    # Settings per end point name: 'priority', 'rate', 'burst', 'max_in_flight' and 'max_wait'
+    ADMISSION_LIMITS = {
+        'songs_add': {'priority': 'low', 'rate': 50, 'burst': 100, 'max_wait': 0.05},
+        'rate_songs': {'priority': 'low', 'rate': 200, 'burst': 400, 'max_wait': 0.05},
+        'song': {'priority': 'low', 'rate': 20, 'burst': 40, 'max_wait': 0.05}
+    }
+    # Seconds a filtered count of songs is cached, writes of the same worker drop the cache
+    SONG_COUNT_CACHE_TTL = 60
+    # Maximum number of song ids in one request of rating statistic data
+    RATING_STAT_MAX_IDS = 100
+    # Coalescing of identical concurrent reads of rating statistic and song search,
+    # results are kept for SINGLE_FLIGHT_TTL seconds if greater than 0
+    SINGLE_FLIGHT_ENABLED = True
+    SINGLE_FLIGHT_TTL = 0
+    # In-memory index of song ids for rejecting ratings of unknown songs, catalogs larger than
+    # SONG_ID_EXACT_MAX are kept in a Bloom filter with SONG_ID_BLOOM_ERROR_RATE false positive rate
+    SONG_ID_INDEX_ENABLED = True
+    SONG_ID_EXACT_MAX = 100000
+    SONG_ID_BLOOM_ERROR_RATE = 0.001
+    # Seconds between reads of songs deleted by other worker processes
+    SONG_ID_REFRESH_INTERVAL = 5
+    # Profiling of requests with cProfile, all requests are profiled if PROFILE_ENABLED is True.
+    # Otherwise only requests with valid X-Profile-Signature header signed with PROFILE_SECRET are profiled
+    PROFILE_ENABLED = False
+    PROFILE_SECRET = None
+    # Directory of saved profiles, default is 'profiles' inside instance folder
+    PROFILE_DIR = None
+    # Recording of database queries slower than SLOW_QUERY_THRESHOLD_MS
+    SLOW_QUERY_ENABLED = True
+    SLOW_QUERY_THRESHOLD_MS = 100
+    SLOW_QUERY_MAX_RECORDS = 20
+    # Archival of old ratings to compressed files, default directory is 'archive/ratings' inside instance folder
+    RATING_ARCHIVE_DIR = None
+    # Ratings older than this number of days are archived
+    RATING_ARCHIVE_DAYS = 365
+    RATING_ARCHIVE_BATCH_SIZE = 1000
+    # Seconds to sleep between archive batches
+    RATING_ARCHIVE_BATCH_PAUSE = 0.1
+    # Ratings of a deleted song are deleted in background in batches of this size
+    DELETE_RATING_BATCH_SIZE = 1000
+    # Seconds to sleep between delete batches
+    DELETE_RATING_BATCH_PAUSE = 0.1
+    # Running delete jobs without progress for this number of seconds are resumed by other worker process
+    DELETE_JOB_LEASE = 60
+    # Seconds after a song is deleted before its delete job looks for ratings again, which other worker processes
+    # accepted until they refreshed their song id index. Must be longer than SONG_ID_REFRESH_INTERVAL
+    DELETE_JOB_RESCAN_DELAY = 30
+    # Snapshot file of songs catalog read at startup instead of the songs collection, written every
+    # CATALOG_SNAPSHOT_INTERVAL seconds by one worker process or by 'flask snapshot-catalog' command.
+    # Default is 'catalog/songs.snapshot' inside instance folder
+    CATALOG_SNAPSHOT_PATH = None
+    # Seconds between snapshots written by worker processes, 0 disables the writer thread
+    CATALOG_SNAPSHOT_INTERVAL = 600
+    # Songs created this number of seconds before the snapshot are read again from the database
+    CATALOG_SNAPSHOT_DELTA_MARGIN = 300
+    # Number of documents read per batch when exporting
+    EXPORT_BATCH_SIZE = 1000
+    # Compression of responses, brotli and zstd are used only if their packages are installed
+    COMPRESS_ENABLED = True
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_LEVELS = {'gzip': 6, 'br': 5, 'zstd': 3}
+    # Number of compressed GET response bodies kept in memory
+    COMPRESS_CACHE_SIZE = 128
 
 
 class DevelopmentConfig(BaseConfig):
@@ -15,6 +94,11 @@ class TestingConfig(BaseConfig):
     TESTING = True
     MONGO_DBNAME = 'test_songs_db'
     MONGO_URI = 'mongodb://localhost:27017/test_songs_db'
+    STORAGE_BACKEND = 'memory'
+    # Two in-memory stand-ins of rating shards
+    RATING_SHARD_URIS = ['mongodb://localhost:27017/test_ratings_0', 'mongodb://localhost:27017/test_ratings_1']
+    DELETE_JOB_RESCAN_DELAY = 0
+    CATALOG_SNAPSHOT_INTERVAL = 0
 
 
 class ProductionConfig(BaseConfig):
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import threading
+import time
+
+from flask import current_app
+
+app = current_app
+
+
+def get_count_cache():
+    """
+    Get count cache object of the current app
+
+    :return: CountCache object or None if the app does not have one
+    """
+    return app.config.get('song_count_cache', None)
+
+
+class CountCache(object):
+    """
+    Class object for caching number of documents per query filter.
+
+    Entries expire after given time to live and are all dropped when the collection is written,
+    writes from other worker processes are only seen after expiry.
+    """
+
+    def __init__(self, ttl=60, max_size=1024):
+        """
+        Initiate empty cache
+
+        :param ttl: number of seconds a count is kept
+        :param max_size: maximum number of cached filters
+        """
+        self._ttl = ttl
+        self._max_size = max_size
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(query_filter=None):
+        """
+        Get hashable cache key of query filter.
+
+        :param query_filter: dictionary of query filter
+        :return: string of cache key
+        """
+        return repr(sorted((query_filter or {}).items()))
+
+    def get(self, query_filter=None):
+        """
+        Get cached count of query filter.
+
+        :param query_filter: dictionary of query filter
+        :return: count: number of documents or None if not cached
+        """
+        key = self.get_key(query_filter)
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is None:
+                return None
+            count, expire_time = entry
+            if expire_time < time.monotonic():
+                del self._counts[key]
+                return None
+            return count
+
+    def set(self, query_filter=None, count=None):
+        """
+        Cache count of query filter.
+
+        :param query_filter: dictionary of query filter
+        :param count: number of documents
+        :return:
+        """
+        key = self.get_key(query_filter)
+        with self._lock:
+            if len(self._counts) >= self._max_size:
+                self._counts.clear()
+            self._counts[key] = (count, time.monotonic() + self._ttl)
+
+    def invalidate(self):
+        """
+        Drop all cached counts
+
+        :return:
+        """
+        with self._lock:
+            self._counts.clear()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import datetime
+import queue
+import threading
+import time
+
+import bson
+from flask import current_app
+
+from instance.storage import get_storage
+from instance.single_flight import get_single_flight
+
+app = current_app
+
+
+def get_delete_jobs():
+    """
+    Get rating delete job queue of the current app
+
+    :return: RatingDeleteJobs object or None if the app does not have one
+    """
+    return app.config.get('delete_jobs', None)
+
+
+class RatingDeleteJobs(object):
+    """
+    Class object for deleting ratings of deleted songs in background.
+
+    One worker thread runs the jobs in order. Ratings are found by index of song id and deleted in
+    batches with a pause between batches, so a song with many ratings does not block requests or
+    load the database with one large delete. Jobs are kept in 'jobs' collection, so every worker process
+    sees them. A running job updates its heartbeat date after every batch; queued jobs and running jobs
+    without heartbeat for lease seconds (their process stopped) are resumed by resume(), which the worker
+    thread calls whenever it is idle. Other worker processes accept ratings of the song until they refresh
+    their song id index, so ratings are looked up again rescan_delay seconds after the job was submitted.
+    A job can be run again for the same song, it deletes only the remaining ratings.
+    """
+
+    def __init__(self, flask_app=None, batch_size=1000, pause=0.1, max_jobs=100, lease=60, rescan_delay=0):
+        """
+        Initiate empty job queue
+
+        :param flask_app: Flask app object, used for app context of the worker thread
+        :param batch_size: number of ratings per delete
+        :param pause: number of seconds to sleep between batches
+        :param max_jobs: maximum number of listed jobs
+        :param lease: number of seconds without heartbeat after which a running job is resumed
+        :param rescan_delay: number of seconds after submitting a job when ratings are looked up again
+        """
+        self._app = flask_app
+        self._batch_size = batch_size
+        self._pause = pause
+        self._max_jobs = max_jobs
+        self._lease = lease
+        self._rescan_delay = rescan_delay
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def get_output(document=None):
+        return {
+            'job_id': str(document['_id']),
+            'song_id': str(document['song_id']),
+            'status': document['status'],
+            'deleted': document.get('deleted', 0),
+            'batches': document.get('batches', 0),
+            'error_message': document.get('error_message'),
+            'creation_date': document['creation_date'],
+            'finished_date': document.get('finished_date')
+        }
+
+    def start_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run_worker, name='rating-delete-jobs', daemon=True)
+                self._thread.start()
+
+    def submit(self, song_id=None):
+        """
+        Queue deleting ratings of a song.
+
+        :param song_id: string of song object id
+        :return: data_dict: dictionary of job data, see get_job()
+        """
+        document = {
+            'song_id': bson.ObjectId(str(song_id)),
+            'status': 'queued',
+            'deleted': 0,
+            'batches': 0,
+            'error_message': None,
+            'creation_date': datetime.datetime.utcnow(),
+            'heartbeat_date': None,
+            'finished_date': None
+        }
+        document['_id'] = get_storage().insert_job(data=document)
+
+        self.start_worker()
+        self._queue.put(document['_id'])
+        return self.get_output(document)
+
+    def resume(self):
+        """
+        Queue jobs which are not finished, including running jobs of stopped processes, and start the
+        worker thread. Jobs still running in other process are skipped when they are claimed.
+
+        :return: count: number of queued jobs
+        """
+        jobs = get_storage().find_jobs(statuses=['queued', 'running'])
+        for document in reversed(jobs):
+            self._queue.put(document['_id'])
+        self.start_worker()
+        return len(jobs)
+
+    def run_worker(self):
+        while True:
+            try:
+                job_id = self._queue.get(timeout=self._lease)
+            except queue.Empty:
+                with self._app.app_context():
+                    self.resume()
+                continue
+            try:
+                with self._app.app_context():
+                    self.run_job(job_id)
+            finally:
+                self._queue.task_done()
+
+    def run_job(self, job_id=None):
+        """
+        Delete ratings of the job song in batches.
+
+        :param job_id: object id of job
+        :return:
+        """
+        storage = get_storage()
+        expired_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=self._lease)
+        job = storage.claim_job(job_id=job_id, expired_before=expired_before)
+        if job is None:
+            return
+
+        song_id = job['song_id']
+        try:
+            self.delete_ratings(job_id=job_id, song_id=song_id)
+            if self._rescan_delay:
+                rescan_date = job['creation_date'] + datetime.timedelta(seconds=self._rescan_delay)
+                wait = (rescan_date - datetime.datetime.utcnow()).total_seconds()
+                if wait > 0:
+                    storage.update_job(job_id=job_id, data={'heartbeat_date': datetime.datetime.utcnow()})
+                    time.sleep(min(wait, self._rescan_delay))
+                self.delete_ratings(job_id=job_id, song_id=song_id)
+
+            # Drop statistic data of the song which may still be kept, with summary of its archived ratings
+            storage.delete_rating_summary(song_id=song_id)
+            single_flight = get_single_flight()
+            if single_flight is not None:
+                single_flight.invalidate(name='rating_stat', arguments=str(song_id))
+            status = 'done'
+            error_message = None
+        except Exception as e:
+            app.logger.error('Deleting ratings of song %s failed: %s', song_id, e)
+            status = 'failed'
+            error_message = '{}'.format(e)
+
+        storage.update_job(job_id=job_id, data={'status': status, 'error_message': error_message,
+                                                'finished_date': datetime.datetime.utcnow()})
+
+    def delete_ratings(self, job_id=None, song_id=None):
+        """
+        Delete ratings of a song in batches and update progress of the job.
+
+        :param job_id: object id of job
+        :param song_id: object id of song
+        :return:
+        """
+        storage = get_storage()
+        while True:
+            rating_ids = storage.find_song_rating_ids(song_id=song_id, limit=self._batch_size)
+            if not rating_ids:
+                break
+
+            deleted_count = storage.delete_ratings(rating_ids=rating_ids, song_ids=[song_id] * len(rating_ids))
+            storage.update_job(job_id=job_id, data={'heartbeat_date': datetime.datetime.utcnow()},
+                               increments={'deleted': deleted_count, 'batches': 1})
+            app.logger.debug('Deleted %s ratings of song %s', deleted_count, song_id)
+
+            if len(rating_ids) < self._batch_size:
+                break
+            if self._pause:
+                time.sleep(self._pause)
+
+    def get_job(self, job_id=None):
+        """
+        Get progress of a job.
+
+        :param job_id: string of job id
+        :return: data_dict: dictionary with following keys or None if the job is not found:
+                 'job_id': string of job id
+                 'song_id': string of song object id
+                 'status': 'queued', 'running', 'done' or 'failed'
+                 'deleted': number of deleted ratings
+                 'batches': number of finished batches
+                 'error_message': error message of failed job
+                 'creation_date': datetime object of submitting the job
+                 'finished_date': datetime object of finishing the job
+        """
+        if not bson.ObjectId.is_valid(job_id):
+            return None
+        document = get_storage().find_job(job_id=bson.ObjectId(job_id))
+        return None if document is None else self.get_output(document)
+
+    def list_jobs(self):
+        """
+        List latest jobs
+
+        :return: list: list of dictionary of job data ordered by creation date, at most max_jobs jobs
+        """
+        jobs = get_storage().find_jobs(limit=self._max_jobs)
+        return [self.get_output(document) for document in reversed(jobs)]
+
+    def join(self):
+        """
+        Wait until all queued jobs are finished
+
+        :return:
+        """
+        self._queue.join()
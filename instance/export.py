@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import csv
+import datetime
+import io
+
+import bson
+
+from instance.storage import get_storage
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_COLLECTIONS = ('songs', 'ratings')
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet'
+}
+
+# Column types of known fields, other fields are exported as strings
+EXPORT_FIELDS = {
+    'songs': (
+        ('_id', 'string'),
+        ('artist', 'string'),
+        ('title', 'string'),
+        ('difficulty', 'float64'),
+        ('level', 'int64'),
+        ('released', 'string')
+    ),
+    'ratings': (
+        ('_id', 'string'),
+        ('song_id', 'string'),
+        ('rating', 'int64'),
+        ('creation_date', 'timestamp')
+    )
+}
+
+
+def get_fields(collection=None, fields=None):
+    """
+    Get exported fields and their column types.
+
+    :param collection: 'songs' or 'ratings'
+    :param fields: list of field names, all known fields of the collection if None
+    :return: list: list of tuple of field name and column type
+    """
+    types = dict(EXPORT_FIELDS[collection])
+    if fields is None:
+        return list(EXPORT_FIELDS[collection])
+    return [(field, types.get(field, 'string')) for field in fields]
+
+
+def get_value(value=None, column_type=None):
+    """
+    Convert document value to exported value.
+
+    :param value: document value
+    :param column_type: column type, see EXPORT_FIELDS
+    :return: converted value
+    """
+    if value is None:
+        return None
+    if isinstance(value, bson.ObjectId):
+        return str(value)
+    if column_type == 'string':
+        return value if isinstance(value, str) else str(value)
+    if column_type == 'float64':
+        return float(value)
+    if column_type == 'int64':
+        return int(value)
+    return value
+
+
+class _ChunkWriter(object):
+    """
+    File-like object keeping written bytes until they are taken, used for streaming Arrow and Parquet output.
+
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_csv(batches=None, fields=None):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow([field for field, column_type in fields])
+    for batch in batches:
+        for document in batch:
+            row = []
+            for field, column_type in fields:
+                value = get_value(document.get(field), column_type)
+                if isinstance(value, datetime.datetime):
+                    value = value.isoformat()
+                row.append(value)
+            writer.writerow(row)
+        yield output.getvalue().encode('utf-8')
+        output.seek(0)
+        output.truncate(0)
+
+
+def get_arrow_schema(fields=None):
+    types = {
+        'string': pyarrow.string(),
+        'float64': pyarrow.float64(),
+        'int64': pyarrow.int64(),
+        'timestamp': pyarrow.timestamp('ms')
+    }
+    return pyarrow.schema([(field, types[column_type]) for field, column_type in fields])
+
+
+def get_arrow_batch(batch=None, fields=None, schema=None):
+    columns = [[get_value(document.get(field), column_type) for document in batch] for field, column_type in fields]
+    return pyarrow.record_batch(columns, schema=schema)
+
+
+def iter_arrow(batches=None, fields=None):
+    schema = get_arrow_schema(fields)
+    sink = _ChunkWriter()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(get_arrow_batch(batch, fields, schema))
+            yield sink.take()
+    yield sink.take()
+
+
+def iter_parquet(batches=None, fields=None):
+    schema = get_arrow_schema(fields)
+    sink = _ChunkWriter()
+    with pyarrow.parquet.ParquetWriter(sink, schema, compression='snappy') as writer:
+        for batch in batches:
+            writer.write_batch(get_arrow_batch(batch, fields, schema))
+            yield sink.take()
+    yield sink.take()
+
+
+def parse_date(value=None):
+    """
+    Parse date from 'YYYY-MM-DD' or ISO 8601 date time string.
+    Date time with time zone is converted to UTC, since creation dates are stored as naive UTC date time.
+
+    :param value: string of date
+    :return: naive datetime object or None if value is None or empty string
+    """
+    if value is None or value == '':
+        return None
+    try:
+        date = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError("Invalid date: {}".format(value))
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def iter_export(collection=None, export_format='csv', fields=None, start=None, end=None, batch_size=1000):
+    """
+    Export songs or ratings as stream of CSV, Arrow IPC stream or Parquet bytes.
+    Documents are read in batches so memory use does not grow with the collection size.
+
+    :param collection: 'songs' or 'ratings'
+    :param export_format: 'csv', 'arrow' or 'parquet'. 'arrow' and 'parquet' require pyarrow package
+    :param fields: list of exported field names, all known fields of the collection if None
+    :param start: datetime object of first creation date, no limit if None
+    :param end: datetime object of end of creation date (excluded), no limit if None
+    :param batch_size: number of documents per batch
+    :return: generator of bytes
+    """
+    if collection not in EXPORT_COLLECTIONS:
+        raise ValueError("Unknown collection: {}".format(collection))
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: {}".format(export_format))
+    if export_format != 'csv' and pyarrow is None:
+        raise ValueError("pyarrow package is required for {} format".format(export_format))
+
+    fields = get_fields(collection, fields)
+    batches = get_storage().iter_batches(collection=collection, fields=[field for field, column_type in fields],
+                                         start=start, end=end, batch_size=batch_size)
+
+    if export_format == 'csv':
+        return iter_csv(batches, fields)
+    if export_format == 'arrow':
+        return iter_arrow(batches, fields)
+    return iter_parquet(batches, fields)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import cProfile
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+from bson import json_util
+from flask import current_app, request
+from pymongo import monitoring
+
+app = current_app
+
+PROFILE_HEADER = 'X-Profile-Signature'
+
+EXPLAINABLE_COMMANDS = ('find', 'aggregate', 'count', 'distinct', 'update', 'delete', 'findAndModify')
+
+# Fields added by the driver which cannot be sent inside explain command
+DRIVER_FIELDS = ('lsid', 'txnNumber', 'autocommit', 'startTransaction', 'apiVersion', 'apiStrict',
+                 'apiDeprecationErrors', 'readConcern', 'writeConcern')
+
+
+def get_profile_signature(secret=None, path=None, timestamp=None):
+    """
+    Get signature of profiling request header.
+
+    :param secret: string of PROFILE_SECRET config
+    :param path: string of request path
+    :param timestamp: integer of unix time
+    :return: string of header value in '<timestamp>:<hex digest>' format
+    """
+    message = '{}:{}'.format(timestamp, path).encode('utf-8')
+    digest = hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+    return '{}:{}'.format(timestamp, digest)
+
+
+def get_slow_query_recorder():
+    """
+    Get slow query recorder object of the current app
+
+    :return: SlowQueryRecorder object or None if slow query recording is disabled
+    """
+    return app.config.get('slow_query_recorder', None)
+
+
+class RequestProfiler(object):
+    """
+    Class object for profiling single requests with cProfile.
+
+    A request is profiled if PROFILE_ENABLED config is True or the request has a valid
+    signature header signed with PROFILE_SECRET config (see get_profile_signature() function).
+    """
+
+    def __init__(self, profile_dir=None, secret=None, is_enabled=False, max_age=300):
+        """
+        Initiate profiler
+
+        :param profile_dir: directory of saved profile files
+        :param secret: string of secret for signing profiling header
+        :param is_enabled: if True, all requests are profiled
+        :param max_age: number of seconds a signature is valid
+        """
+        self._profile_dir = profile_dir
+        self._secret = secret
+        self._is_enabled = is_enabled
+        self._max_age = max_age
+
+    def is_requested(self):
+        """
+        Check whether current request should be profiled.
+
+        :return: True if current request should be profiled
+        """
+        if self._is_enabled:
+            return True
+
+        signature = request.headers.get(PROFILE_HEADER, None)
+        if signature is None or not self._secret:
+            return False
+
+        timestamp = signature.split(':', 1)[0]
+        if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > self._max_age:
+            return False
+
+        expected = get_profile_signature(secret=self._secret, path=request.path, timestamp=timestamp)
+        return hmac.compare_digest(signature, expected)
+
+    def run(self, func=None, *args, **kwargs):
+        """
+        Call function under profiler and save the profile to profile directory.
+
+        :param func: function for calling
+        :return: returned value of the function
+        """
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            os.makedirs(self._profile_dir, exist_ok=True)
+            file_name = '{}-{}-{}.prof'.format(
+                datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), request.endpoint, threading.get_ident())
+            file_path = os.path.join(self._profile_dir, file_name)
+            profiler.dump_stats(file_path)
+            app.logger.info('Saved profile of %s to %s', request.path, file_path)
+
+
+class SlowQueryRecorder(monitoring.CommandListener):
+    """
+    Class object for recording slowest database queries.
+
+    It listens to commands sent by the Mongo clients, keeps the slowest queries exceeding
+    the threshold and runs explain with 'executionStats' verbosity on them when they are reported.
+    Queries are recorded with the server address, so explain of a query is run by the client
+    connected to the server (rating shard) which executed it.
+    """
+
+    def __init__(self, threshold_ms=100, max_records=20):
+        """
+        Initiate recorder
+
+        :param threshold_ms: minimum duration of recorded query in milliseconds
+        :param max_records: maximum number of kept queries
+        """
+        self._threshold_micros = threshold_ms * 1000
+        self._max_records = max_records
+        self._pending = {}
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name not in EXPLAINABLE_COMMANDS:
+            return
+
+        command = {}
+        for key, value in event.command.items():
+            if key.startswith('$') or key in DRIVER_FIELDS:
+                continue
+            command[key] = value
+
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (event.connection_id, event.database_name,
+                                                                      command)
+
+    def succeeded(self, event):
+        with self._lock:
+            pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None or event.duration_micros < self._threshold_micros:
+            return
+
+        address, database_name, command = pending
+        key = (address, database_name, json_util.dumps(command, sort_keys=True))
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                record = {
+                    'address': address,
+                    'database': database_name,
+                    'command_name': event.command_name,
+                    'command': command,
+                    'count': 0,
+                    'max_duration_ms': 0.0,
+                    'explain': None
+                }
+                self._records[key] = record
+            record['count'] += 1
+            record['max_duration_ms'] = max(record['max_duration_ms'], event.duration_micros / 1000.0)
+
+            if len(self._records) > self._max_records:
+                fastest_key = min(self._records, key=lambda k: self._records[k]['max_duration_ms'])
+                del self._records[fastest_key]
+
+    def failed(self, event):
+        with self._lock:
+            self._pending.pop((event.connection_id, event.request_id), None)
+
+    @staticmethod
+    def find_execution_stats(explain_dict=None):
+        """
+        Find 'executionStats' section of explain output, which is nested in aggregation stages.
+
+        :param explain_dict: dictionary of explain output
+        :return: dictionary of execution stats or None if not found
+        """
+        if isinstance(explain_dict, dict):
+            if 'executionStats' in explain_dict:
+                return explain_dict['executionStats']
+            values = explain_dict.values()
+        elif isinstance(explain_dict, list):
+            values = explain_dict
+        else:
+            return None
+
+        for value in values:
+            stats = SlowQueryRecorder.find_execution_stats(value)
+            if stats is not None:
+                return stats
+        return None
+
+    def explain(self, mongo=None, record=None):
+        """
+        Run explain of recorded query.
+
+        :param mongo: PyMongo object
+        :param record: dictionary of recorded query
+        :return: data_dict: dictionary with 'execution_time_ms', 'keys_examined', 'docs_examined',
+                 'returned' and 'winning_stage' keys
+        """
+        result = mongo.cx[record['database']].command('explain', record['command'], verbosity='executionStats')
+        stats = self.find_execution_stats(result) or {}
+        winning_plan = stats.get('executionStages', {})
+        return {
+            'execution_time_ms': stats.get('executionTimeMillis'),
+            'keys_examined': stats.get('totalKeysExamined'),
+            'docs_examined': stats.get('totalDocsExamined'),
+            'returned': stats.get('nReturned'),
+            'winning_stage': winning_plan.get('stage')
+        }
+
+    @staticmethod
+    def find_client(mongos=None, address=None):
+        """
+        Find client connected to a server.
+
+        :param mongos: list of PyMongo object
+        :param address: tuple of host and port of the server
+        :return: PyMongo object or None if no client is connected to the server
+        """
+        for mongo in mongos:
+            if address in mongo.cx.nodes:
+                return mongo
+        return None
+
+    def get_records(self, mongos=None):
+        """
+        Get recorded queries ordered from the slowest, with explain data.
+
+        :param mongos: list of PyMongo object of every database (main and rating shards) for running explain.
+                       Explain is skipped if None
+        :return: list: list of dictionary of recorded query
+        """
+        with self._lock:
+            records = sorted(self._records.values(), key=lambda r: r['max_duration_ms'], reverse=True)
+
+        output = []
+        for record in records:
+            if mongos is not None and record['explain'] is None:
+                mongo = self.find_client(mongos=mongos, address=record['address'])
+                if mongo is None:
+                    app.logger.warning('Cannot explain query %s: no client of server %s', record['command'],
+                                       record['address'])
+                else:
+                    try:
+                        record['explain'] = self.explain(mongo=mongo, record=record)
+                    except Exception as e:
+                        app.logger.warning('Cannot explain query %s: %s', record['command'], e)
+
+            output.append({
+                'server': '{}:{}'.format(*record['address']),
+                'database': record['database'],
+                'command_name': record['command_name'],
+                'command': json.loads(json_util.dumps(record['command'])),
+                'count': record['count'],
+                'max_duration_ms': record['max_duration_ms'],
+                'explain': record['explain']
+            })
+        return output
@@ -9,6 +9,10 @@ import datetime
 
 from flask import current_app, json
 from instance.song import get_dict_data
+from instance.suggest import get_suggest_index
+from instance.storage import get_storage
+from instance.single_flight import coalesced, get_single_flight
+from instance.song_ids import get_song_id_index
 
 app = current_app
 
@@ -42,18 +46,19 @@ class Rating(object):
 
     """
 
-    _mongo = None
+    _storage = None
 
     def __init__(self):
         """
-        Initiate PyMongo object for the class
+        Initiate storage object for the class (see STORAGE_BACKEND config)
         """
-        self._mongo = app.config['mongodb']
+        self._storage = get_storage()
 
-    def create(self, **kwargs):
+    def create(self, check_song=False, **kwargs):
         """
         Create rating object is ratings collection.
 
+        :param check_song: reject rating of unknown song if True
         :param kwargs: dictionary of rating data
         :return: res_dict: dictionary of created object id. created_id is the key
         """
@@ -72,10 +77,24 @@ class Rating(object):
         kwargs['rating'] = int(rating_value)
 
         kwargs['song_id'] = bson.ObjectId(str(song_id))
+
+        song_id_index = get_song_id_index()
+        if check_song and song_id_index is not None and not song_id_index.contains(kwargs['song_id']):
+            raise ValueError("Song not found: {}".format(song_id))
+
         kwargs['creation_date'] = datetime.datetime.utcnow()
 
-        created_id = self._mongo.db.ratings.insert_one(kwargs).inserted_id
+        created_id = self._storage.insert_rating(data=kwargs)
         created_id = str(created_id)
+
+        suggest_index = get_suggest_index()
+        if suggest_index is not None:
+            suggest_index.add_rating(song_id=kwargs['song_id'])
+
+        single_flight = get_single_flight()
+        if single_flight is not None:
+            single_flight.invalidate(name='rating_stat', arguments=str(kwargs['song_id']))
+
         return {"created_id": str(created_id)}
 
     def validate_rating_value(self, rating_value=None):
@@ -99,20 +118,45 @@ class Rating(object):
         :return: data_dict: dictionary with 'total' and 'output' key. Row data can be found in 'output' key.
         """
 
-        cursor = self._mongo.db.ratings.find()
-        # app.logger.debug('cursor: %s', cursor)
+        output = []
+        for document in self._storage.find_ratings():
+            app.logger.debug('document: %s', document)
+            output.append(get_dict_data(document))
 
-        total_found = cursor.count()
+        total_found = len(output)
         app.logger.debug('total_found: %s', total_found)
 
-        output = []
-        if total_found > 0:
-            for document in cursor:
-                app.logger.debug('document: %s', document)
-                output.append(get_dict_data(document))
-
         return {'total': total_found, 'output': output}
 
+    def create_indexes(self):
+        """
+        Create indexes of ratings collection on song id and creation date
+
+        :return:
+        """
+        self._storage.create_rating_indexes()
+
+    def count_by_song(self):
+        """
+        Count number of ratings of every rated song.
+
+        :return: data_dict: dictionary of number of ratings with song id string as key
+        """
+        output = {}
+        for song_id, total in self._storage.count_ratings_by_song().items():
+            output[str(song_id)] = total
+        return output
+
+    def has_ratings(self, song_id=None):
+        """
+        Check if a song has ratings, ratings of deleted songs are kept until their delete job is finished.
+
+        :param song_id: string of song id
+        :return: status: True if the song has at least one rating
+        """
+        return len(self._storage.find_song_rating_ids(song_id=bson.ObjectId(str(song_id)), limit=1)) > 0
+
+    @coalesced(name='rating_stat', get_key=lambda song_id=None: str(song_id).lower())
     def get_stat(self, song_id=None):
         """
         Get statistic data for selected song id.
@@ -124,35 +168,29 @@ class Rating(object):
                  'max_value': maximum level value of the song
         """
 
-        song_id = bson.ObjectId(str(song_id))
+        # Output of get_stats() is keyed by normalized (lowercase) id
+        return self.get_stats([song_id])[str(bson.ObjectId(str(song_id)))]
+
+    def get_stats(self, song_ids=None):
+        """
+        Get statistic data for many song ids with one aggregation.
 
-        cursor = self._mongo.db.ratings.aggregate([
-            {'$match': {"song_id": song_id}},
-            {
-                '$group': {
-                    '_id': None,
-                    "avg_level": {'$avg': '$rating'},
-                    "min_value": {'$min': '$rating'},
-                    "max_value": {'$max': '$rating'}
-                }
-            }
-        ])
-        # app.logger.debug('== get_stat cursor: %s', cursor)
-
-        avg_value = None
-        min_value = None
-        max_value = None
-        for document in cursor:
-            # app.logger.debug('== get_stat document: %s', document)
-            avg_value = document["avg_level"]
-            min_value = document["min_value"]
-            max_value = document["max_value"]
-
-        return {
-            "avg_value": avg_value,
-            "min_value": min_value,
-            "max_value": max_value
-        }
+        :param song_ids: list of string of song id
+        :return: data_dict: dictionary of statistic data with song id as key, see get_stat() function.
+                 Values are None for songs without rating.
+        """
+        object_ids = [bson.ObjectId(str(song_id)) for song_id in song_ids]
+        stats = self._storage.get_rating_stats(song_ids=object_ids)
+
+        output = {}
+        for song_id in object_ids:
+            output[str(song_id)] = stats.get(song_id, {
+                "avg_value": None,
+                "min_value": None,
+                "max_value": None
+            })
+
+        return output
 
     def find_update(self, song_id=None, rating_value=None):
         """
@@ -169,35 +207,26 @@ class Rating(object):
             raise ValueError("Empty string of song ID found")
 
         song_id = bson.ObjectId(str(song_id))
-        cursor = self._mongo.db.ratings.find({"_id": song_id})
-        # app.logger.debug('== cursor: %s', len(cursor))
+        document = self._storage.find_rating(rating_id=song_id, song_id=song_id)
+        # app.logger.debug('== document: %s', document)
 
         rating = None
-        for document in cursor:
-            # app.logger.debug('== add_rating document: %s', document)
-            if 'rating' in document:
-                rating = document['rating']
-                if rating is None:
-                    rating = 0
-                rating += rating_value
+        if document is not None and 'rating' in document:
+            rating = document['rating']
+            if rating is None:
+                rating = 0
+            rating += rating_value
 
         if rating is None:
             rating = rating_value
 
         app.logger.debug('rating: %s', rating)
 
-        updated = self._mongo.db.ratings.update_one(
-            {'_id': song_id},
-            {
-                '$set': {'rating': rating},
-                '$currentDate': {'lastModified': True}
-            }
-        )
-        # app.logger.debug('updated: %s', updated)
-        app.logger.debug('updated: %s', updated.modified_count)
-
-        songs = self._mongo.db.ratings.find_one({"_id": song_id})
+        modified_count = self._storage.update_rating(rating_id=song_id, rating=rating, song_id=song_id)
+        app.logger.debug('updated: %s', modified_count)
+
+        songs = self._storage.find_rating(rating_id=song_id, song_id=song_id)
         app.logger.debug('songs: %s', songs)
         item_dict = get_dict_data(songs)
 
-        return {"status": updated.modified_count, "output": item_dict}
+        return {"status": modified_count, "output": item_dict}
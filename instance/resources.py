@@ -3,11 +3,23 @@
 __version__ = '0.1.0'
 __author__ = 'Porntip Chaibamrung'
 
+import functools
+import math
 import re
-from flask import jsonify, current_app
+import bson
+from flask import jsonify, current_app, Response, stream_with_context
 from flask_restful import request, abort, Resource
+from pymongo.errors import DuplicateKeyError
 from instance.song import Song
 from instance.rating import Rating
+from instance.suggest import get_suggest_index
+from instance.similar import get_similar_index
+from instance.admission import get_admission_controller
+from instance.profiling import get_slow_query_recorder
+from instance.export import EXPORT_FORMATS, iter_export, parse_date
+from instance.song_stats import get_song_stats, DEFAULT_PERCENTILES
+from instance.single_flight import get_single_flight
+from instance.delete_jobs import get_delete_jobs
 
 app = current_app
 
@@ -24,6 +36,40 @@ class BaseResource(Resource):
         if config_name == 'testing':
             self._is_test_mode = 1
 
+    def dispatch_request(self, *args, **kwargs):
+        """
+        Dispatch request through admission control of the end point (see ADMISSION_* config)
+
+        """
+        controller = get_admission_controller()
+        if controller is None:
+            return self.run_request(*args, **kwargs)
+
+        endpoint = controller.admit(request.endpoint)
+        try:
+            response = self.run_request(*args, **kwargs)
+        except BaseException:
+            controller.release(endpoint)
+            raise
+
+        if isinstance(response, Response) and response.is_streamed:
+            # Body of streamed response is generated after the handler returns, keep the slot until it is closed
+            response.call_on_close(functools.partial(controller.release, endpoint))
+        else:
+            controller.release(endpoint)
+        return response
+
+    def run_request(self, *args, **kwargs):
+        """
+        Run handler function of the request, under profiler if profiling is requested (see PROFILE_* config)
+
+        """
+        profiler = app.config.get('request_profiler', None)
+        if profiler is not None and profiler.is_requested():
+            return profiler.run(super(BaseResource, self).dispatch_request, *args, **kwargs)
+
+        return super(BaseResource, self).dispatch_request(*args, **kwargs)
+
 
 class AddSong(BaseResource):
     """
@@ -40,7 +86,10 @@ class AddSong(BaseResource):
         data = request.get_json()
         app.logger.debug('Post JSON data from request: %s', data)
 
-        created_id = Song().create(**data)
+        try:
+            created_id = Song().create(**data)
+        except DuplicateKeyError:
+            abort(409, error_message='Song already exists')
         return {"created_id": created_id}
 
     @staticmethod
@@ -57,11 +106,12 @@ class ListSong(BaseResource):
     def get(self):
         """
         Main function to fetch list of song by 'limit' and 'page' parameter.
-        If no parameter given then list all songs
+        If no parameter given then list all songs.
+        Songs can be filtered by 'level' and 'message' parameter, 'count=false' skips counting total.
 
         :return: data_dict: dictionary with following keys:
                  'result':  rows data
-                 'total': total number of found items
+                 'total': total number of songs matching the filter, None if counting is skipped
         """
 
         args = request.args  # retrieve args from query string
@@ -69,6 +119,9 @@ class ListSong(BaseResource):
 
         page_size = args.get("limit", None)
         page_number = args.get("page", None)
+        level = args.get("level", None)
+        message = args.get("message", None)
+        is_count = args.get("count", "true").lower() not in ('0', 'false', 'no')
 
         show_all = 1
         if page_size is not None:
@@ -86,12 +139,29 @@ class ListSong(BaseResource):
         if page_number <= 0:
             page_number = 1
 
+        if level is not None:
+            is_match = re.match(r'^\d+$', level)
+            if not is_match:
+                abort(404, error_message='Except numeric value for level parameter')
+
+        if message == '':
+            message = None
+
+        song = Song()
+        query_filter = song.get_filter(level_value=level, key_search=message)
+
         if show_all:
-            output = Song().list_all()
+            output = song.list_all(query_filter=query_filter)
         else:
-            output = Song().list(page_size=page_size, page_number=page_number)
+            output = song.list(page_size=page_size, page_number=page_number, query_filter=query_filter)
 
-        return jsonify({'result': output, 'total': len(output)})
+        total = None
+        if show_all:
+            total = len(output)
+        elif is_count:
+            total = song.count(query_filter=query_filter)
+
+        return jsonify({'result': output, 'total': total})
 
     @staticmethod
     def post():
@@ -121,7 +191,7 @@ class ListSongByLevel(BaseResource):
         if level is None:
             abort(404, error_message='Missing level parameter')
 
-        is_match = re.match('\d', level)
+        is_match = re.match(r'^\d+$', level)
         if not is_match:
             abort(404, error_message='Except numeric value for level parameter')
 
@@ -172,6 +242,168 @@ class SearchSong(BaseResource):
         abort(404, error_message='Operation is not allowed')
 
 
+class SuggestSong(BaseResource):
+    """
+    Class object for suggesting songs by prefix of artist or title end point
+
+    """
+
+    def get(self):
+        """
+        Main function to suggest songs by 'prefix' and 'limit' parameter.
+        Songs are served from in-memory suggestion index and ranked by number of ratings.
+
+        :return: data_dict: dictionary with following keys:
+                 'total': total number of suggested songs
+                 'result': list of dictionary of song data
+        """
+        args = request.args
+        prefix = args.get("prefix", None)
+        limit = args.get("limit", None)
+
+        if prefix is None or prefix == '':
+            abort(404, error_message='Missing prefix parameter')
+
+        if limit is None or limit == '':
+            limit = 10
+        else:
+            is_match = re.match(r'^\d+$', limit)
+            if not is_match:
+                abort(404, error_message='Except numeric value for limit parameter')
+            limit = int(limit)
+
+        output = get_suggest_index().suggest(prefix=prefix, limit=limit)
+        return jsonify({'total': len(output), 'result': output})
+
+    @staticmethod
+    def post():
+        abort(404, error_message='Operation is not allowed')
+
+
+class SongItem(BaseResource):
+    """
+    Class object for deleting a song end point
+
+    """
+
+    def delete(self, song_id):
+        """
+        Main function to delete a song. Ratings of the song are deleted by background job,
+        its progress is returned by /admin/jobs/<job_id> end point. Deleting a song which is already
+        deleted but still has ratings runs a new job for the remaining ratings.
+
+        :param song_id: string of song object id
+        :return: data_dict: dictionary with 'deleted' status and 'job' data of deleting ratings
+        """
+        if not bson.ObjectId.is_valid(song_id):
+            abort(404, error_message='Invalid song id: {}'.format(song_id))
+
+        is_deleted = Song().delete(song_id=song_id)
+        if not is_deleted and not Rating().has_ratings(song_id=song_id):
+            abort(404, error_message='Song not found: {}'.format(song_id))
+
+        job = get_delete_jobs().submit(song_id=song_id)
+        response = jsonify({'deleted': is_deleted, 'job': job})
+        response.status_code = 202
+        return response
+
+    @staticmethod
+    def get():
+        abort(404, error_message='Operation is not allowed')
+
+    @staticmethod
+    def post():
+        abort(404, error_message='Operation is not allowed')
+
+
+class SimilarSong(BaseResource):
+    """
+    Class object for listing songs similar to a song end point
+
+    """
+
+    def get(self, song_id):
+        """
+        Main function to get 'k' songs nearest to the song in level and difficulty.
+        Songs are served from in-memory index sorted by difficulty of every level.
+
+        :param song_id: string of song object id
+        :return: data_dict: dictionary with following keys:
+                 'total': total number of similar songs
+                 'result': list of dictionary of song data with 'distance' to the song
+        """
+        k = request.args.get("k", None)
+
+        if k is None or k == '':
+            k = 10
+        else:
+            is_match = re.match(r'^\d+$', k)
+            if not is_match:
+                abort(404, error_message='Except numeric value for k parameter')
+            k = min(int(k), 100)
+
+        output = get_similar_index().get_similar(song_id=song_id, k=k)
+        if output is None:
+            abort(404, error_message='Song not found: {}'.format(song_id))
+
+        return jsonify({'total': len(output), 'result': output})
+
+    @staticmethod
+    def post():
+        abort(404, error_message='Operation is not allowed')
+
+
+class SongStats(BaseResource):
+    """
+    Class object for distribution of song difficulty by level end point
+
+    """
+
+    def get(self):
+        """
+        Main function to get difficulty percentiles and histograms of every level, correlation between
+        level and difficulty and number of songs released per year.
+        Optional 'percentiles' parameter is comma separated list of values between 0 and 100 and
+        optional 'bins' parameter is number of histogram bins.
+
+        :return: data_dict: dictionary of statistic data, see SongStatsSnapshot.get_stats()
+        """
+        song_stats = get_song_stats()
+        if song_stats is None:
+            abort(404, error_message='numpy package is required for song statistic')
+
+        args = request.args
+        percentiles = args.get("percentiles", None)
+        bins = args.get("bins", None)
+
+        if percentiles is None or percentiles == '':
+            percentiles = DEFAULT_PERCENTILES
+        else:
+            try:
+                percentiles = [float(value) for value in percentiles.split(',')]
+            except ValueError:
+                abort(404, error_message='Except comma separated numeric values for percentiles parameter')
+            # float() accepts 'nan' and 'inf', which pass the range check
+            if not all(math.isfinite(value) for value in percentiles):
+                abort(404, error_message='Except finite values for percentiles parameter')
+            if any(value < 0 or value > 100 for value in percentiles):
+                abort(404, error_message='Except percentiles between 0 and 100')
+
+        if bins is None or bins == '':
+            bins = 10
+        else:
+            is_match = re.match(r'^\d+$', bins)
+            if not is_match or int(bins) == 0:
+                abort(404, error_message='Except positive numeric value for bins parameter')
+            bins = int(bins)
+
+        return jsonify(song_stats.get_stats(percentiles=percentiles, bins=bins))
+
+    @staticmethod
+    def post():
+        abort(404, error_message='Operation is not allowed')
+
+
 class RateSong(BaseResource):
     """
     Class object for rating a song's end point.
@@ -203,7 +435,7 @@ class RateSong(BaseResource):
                 'song_id': song_id,
                 'rating': rating
             }
-            result = Rating().create(**req_dict)
+            result = Rating().create(check_song=True, **req_dict)
         except Exception as e:
             app.logger.debug('Error: %s', e)
             abort(404, error_message='{}'.format(e))
@@ -256,3 +488,231 @@ class GetStatRating(BaseResource):
     @staticmethod
     def post():
         abort(404, error_message='Operation is not allowed')
+
+
+class GetStatRatings(BaseResource):
+    """
+    Class object for getting statistic data of many song ids in one request.
+
+    """
+
+    def get_song_ids(self, ids=None):
+        """
+        Validate list of song ids from request.
+
+        :param ids: list of string of song id
+        :return: list: list of unique song ids
+        """
+        if not ids:
+            abort(404, error_message='Missing ids parameter')
+
+        song_ids = []
+        for song_id in ids:
+            song_id = str(song_id).strip()
+            if not bson.ObjectId.is_valid(song_id):
+                abort(404, error_message='Invalid song id: {}'.format(song_id))
+            song_id = str(bson.ObjectId(song_id))
+            if song_id not in song_ids:
+                song_ids.append(song_id)
+
+        max_ids = app.config['RATING_STAT_MAX_IDS']
+        if len(song_ids) > max_ids:
+            abort(404, error_message='Too many song ids. Maximum is {}'.format(max_ids))
+
+        return song_ids
+
+    def get(self):
+        """
+        Main function to get statistic data of song ids from comma separated 'ids' parameter.
+
+        :return: data_dict: dictionary with following keys:
+                 'total': total number of song ids
+                 'result': see get_stats() function in Rating class
+        """
+        ids = request.args.get("ids", '')
+        song_ids = self.get_song_ids([song_id for song_id in ids.split(',') if song_id != ''])
+
+        result = Rating().get_stats(song_ids)
+        return jsonify({'total': len(result), 'result': result})
+
+    def post(self):
+        """
+        Main function to get statistic data of song ids from 'ids' list in JSON body.
+
+        :return: see get() function
+        """
+        data = request.get_json() or {}
+        ids = data.get("ids", None)
+        if ids is not None and not isinstance(ids, list):
+            abort(404, error_message='Except list of song ids for ids parameter')
+
+        song_ids = self.get_song_ids(ids)
+
+        result = Rating().get_stats(song_ids)
+        return jsonify({'total': len(result), 'result': result})
+
+
+class ExportData(BaseResource):
+    """
+    Class object for exporting songs or ratings for analytics end point.
+
+    """
+
+    def get(self, collection):
+        """
+        Main function to stream all songs or ratings as CSV, Arrow IPC stream or Parquet.
+        Parameters are 'format' (csv, arrow or parquet), 'fields' (comma separated field names)
+        and 'start'/'end' creation date (YYYY-MM-DD, end is excluded).
+
+        :param collection: 'songs' or 'ratings'
+        :return: streamed response of exported data
+        """
+        args = request.args
+        export_format = args.get("format", "csv")
+        fields = args.get("fields", None)
+        if fields is not None:
+            fields = [field.strip() for field in fields.split(',') if field.strip() != '']
+
+        try:
+            start = parse_date(args.get("start", None))
+            end = parse_date(args.get("end", None))
+        except ValueError as e:
+            abort(404, error_message='{}'.format(e))
+
+        try:
+            output = iter_export(collection=collection, export_format=export_format, fields=fields,
+                                 start=start, end=end, batch_size=app.config['EXPORT_BATCH_SIZE'])
+        except ValueError as e:
+            abort(404, error_message='{}'.format(e))
+
+        file_name = '{}.{}'.format(collection, export_format)
+        return Response(stream_with_context(output), mimetype=EXPORT_FORMATS[export_format],
+                        headers={'Content-Disposition': 'attachment; filename={}'.format(file_name)})
+
+    @staticmethod
+    def post():
+        abort(404, error_message='Operation is not allowed')
+
+
+class AdmissionStats(BaseResource):
+    """
+    Class object for getting admission control statistic data of the worker.
+
+    """
+
+    def get(self):
+        """
+        Main function to get number of admitted and shed requests and queue wait time of each end point.
+
+        :return: see get_stats() function in AdmissionController class
+        """
+        controller = get_admission_controller()
+        if controller is None:
+            abort(404, error_message='Admission control is disabled')
+
+        return jsonify(controller.get_stats())
+
+    @staticmethod
+    def post():
+        abort(404, error_message='Operation is not allowed')
+
+
+class DeleteJobs(BaseResource):
+    """
+    Class object for listing background delete jobs of the worker.
+
+    """
+
+    def get(self):
+        """
+        Main function to list kept delete jobs.
+
+        :return: data_dict: dictionary with following keys:
+                 'total': total number of jobs
+                 'result': list of dictionary of job data, see get_job() function in RatingDeleteJobs class
+        """
+        output = get_delete_jobs().list_jobs()
+        return jsonify({'total': len(output), 'result': output})
+
+    @staticmethod
+    def post():
+        abort(404, error_message='Operation is not allowed')
+
+
+class DeleteJob(BaseResource):
+    """
+    Class object for getting progress of background delete job.
+
+    """
+
+    def get(self, job_id):
+        """
+        Main function to get progress of a job.
+
+        :param job_id: string of job id
+        :return: see get_job() function in RatingDeleteJobs class
+        """
+        job = get_delete_jobs().get_job(job_id=job_id)
+        if job is None:
+            abort(404, error_message='Job not found: {}'.format(job_id))
+
+        return jsonify(job)
+
+    @staticmethod
+    def post():
+        abort(404, error_message='Operation is not allowed')
+
+
+class CoalescingStats(BaseResource):
+    """
+    Class object for getting number of coalesced reads of the worker.
+
+    """
+
+    def get(self):
+        """
+        Main function to get number of executed, coalesced and cached reads.
+
+        :return: see get_stats() function in SingleFlight class
+        """
+        single_flight = get_single_flight()
+        if single_flight is None:
+            abort(404, error_message='Coalescing is disabled')
+
+        return jsonify(single_flight.get_stats())
+
+    @staticmethod
+    def post():
+        abort(404, error_message='Operation is not allowed')
+
+
+class SlowQueryStats(BaseResource):
+    """
+    Class object for getting slowest database queries of the worker.
+
+    """
+
+    def get(self):
+        """
+        Main function to list recorded slow queries ordered from the slowest.
+        Explain data is collected unless 'explain=false' is given.
+
+        :return: data_dict: dictionary with following keys:
+                 'total': total number of recorded queries
+                 'result': see get_records() function in SlowQueryRecorder class
+        """
+        recorder = get_slow_query_recorder()
+        if recorder is None:
+            abort(404, error_message='Slow query recording is disabled')
+
+        is_explain = request.args.get("explain", "true").lower() not in ('0', 'false', 'no')
+        mongos = None
+        if is_explain and app.config.get('mongodb', None) is not None:
+            mongos = [app.config['mongodb']] + app.config.get('rating_shard_mongodbs', [])
+
+        output = recorder.get_records(mongos=mongos)
+        return jsonify({'total': len(output), 'result': output})
+
+    @staticmethod
+    def post():
+        abort(404, error_message='Operation is not allowed')
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import bisect
+import heapq
+import math
+import threading
+
+from flask import current_app
+
+app = current_app
+
+
+def get_similar_index():
+    """
+    Get similar song index object of the current app
+
+    :return: SimilarIndex object or None if the app does not have one
+    """
+    return app.config.get('similar_index', None)
+
+
+class SimilarIndex(object):
+    """
+    Class object for finding songs nearest in level and difficulty.
+
+    Songs of every level are kept in a list of (difficulty, song id) sorted by difficulty.
+    A lookup bisects each level list and walks outwards from the nearest positions, taking the
+    closest candidate of all levels from a heap, so only about k entries are visited.
+    """
+
+    def __init__(self):
+        """
+        Initiate empty index
+        """
+        self._levels = {}
+        self._songs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_point(document=None):
+        """
+        Get level and difficulty of a song.
+
+        :param document: dictionary of song data
+        :return: tuple of level and difficulty or None if one of them is not a number
+        """
+        level = document.get('level')
+        difficulty = document.get('difficulty')
+        for value in (level, difficulty):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return None
+        return level, float(difficulty)
+
+    def build(self, songs=None, levels=None):
+        """
+        Rebuild index from song documents.
+
+        :param songs: iterable of song documents with 'artist', 'title', 'level' and 'difficulty' fields
+        :param levels: dictionary of list of tuple of difficulty and song id string sorted by difficulty and
+                       song id with level as key, e.g. read from catalog snapshot. Built from songs if None
+        :return: total: number of indexed songs
+        """
+        is_sorted = levels is not None
+        if levels is None:
+            levels = {}
+        song_dict = {}
+        for document in songs or []:
+            point = self.get_point(document)
+            if point is None:
+                continue
+            song_id = str(document['_id'])
+            song_dict[song_id] = {'artist': document.get('artist'), 'title': document.get('title'),
+                                  'level': point[0], 'difficulty': point[1]}
+            if not is_sorted:
+                levels.setdefault(point[0], []).append((point[1], song_id))
+
+        if not is_sorted:
+            for entries in levels.values():
+                entries.sort()
+        with self._lock:
+            self._levels = levels
+            self._songs = song_dict
+
+        app.logger.debug('Similar index built with %s songs', len(song_dict))
+        return len(song_dict)
+
+    def add(self, song_id=None, data=None):
+        """
+        Add a song to the index or update it if exists.
+
+        :param song_id: string of song object id
+        :param data: dictionary of song data
+        :return:
+        """
+        song_id = str(song_id)
+        self.remove(song_id=song_id)
+
+        point = self.get_point(data)
+        if point is None:
+            return
+        with self._lock:
+            self._songs[song_id] = {'artist': data.get('artist'), 'title': data.get('title'),
+                                    'level': point[0], 'difficulty': point[1]}
+            bisect.insort(self._levels.setdefault(point[0], []), (point[1], song_id))
+
+    def remove(self, song_id=None):
+        """
+        Remove a song from the index.
+
+        :param song_id: string of song object id
+        :return: status: True if the song was found in the index
+        """
+        song_id = str(song_id)
+        with self._lock:
+            song = self._songs.pop(song_id, None)
+            if song is None:
+                return False
+
+            entries = self._levels[song['level']]
+            position = bisect.bisect_left(entries, (song['difficulty'], song_id))
+            if position < len(entries) and entries[position] == (song['difficulty'], song_id):
+                del entries[position]
+            if not entries:
+                del self._levels[song['level']]
+        return True
+
+    def get_similar(self, song_id=None, k=10):
+        """
+        Get songs nearest to given song by Euclidean distance of level and difficulty.
+
+        :param song_id: string of song object id
+        :param k: maximum number of returned songs
+        :return: list: list of dictionary data of a song ordered by distance, None if the song is not indexed
+        """
+        song_id = str(song_id)
+        with self._lock:
+            song = self._songs.get(song_id)
+            if song is None:
+                return None
+
+            # Heap item: (distance, level, position, step), step -1 walks to lower and 1 to higher difficulty
+            heap = []
+
+            def push(level, position, step):
+                entries = self._levels[level]
+                if 0 <= position < len(entries):
+                    distance = math.hypot(level - song['level'], entries[position][0] - song['difficulty'])
+                    heapq.heappush(heap, (distance, level, position, step))
+
+            for level, entries in self._levels.items():
+                position = bisect.bisect_left(entries, (song['difficulty'],))
+                push(level, position - 1, -1)
+                push(level, position, 1)
+
+            output = []
+            while heap and len(output) < k:
+                distance, level, position, step = heapq.heappop(heap)
+                push(level, position + step, step)
+
+                similar_id = self._levels[level][position][1]
+                if similar_id == song_id:
+                    continue
+                similar_song = self._songs[similar_id]
+                output.append({
+                    '_id': similar_id,
+                    'artist': similar_song['artist'],
+                    'title': similar_song['title'],
+                    'level': similar_song['level'],
+                    'difficulty': similar_song['difficulty'],
+                    'distance': distance
+                })
+
+        return output
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import asyncio
+import functools
+import threading
+import time
+
+from flask import current_app, has_app_context
+
+app = current_app
+
+
+def get_single_flight():
+    """
+    Get single flight object of the current app
+
+    :return: SingleFlight object or None if the app does not have one
+    """
+    if not has_app_context():
+        return None
+    return app.config.get('single_flight', None)
+
+
+class _Call(object):
+    """
+    Class object of one in-flight call shared by callers with the same key.
+
+    """
+
+    def __init__(self, generation=None):
+        self.event = threading.Event()
+        self.generation = generation
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Class object for coalescing identical concurrent calls.
+
+    The first caller of a key runs the function, callers arriving while it runs wait and get the same
+    result or exception. With ttl greater than zero the result is also kept for ttl seconds.
+    Results are shared between callers, so they must not be modified.
+    """
+
+    def __init__(self, ttl=0.0, max_size=1024):
+        """
+        Initiate single flight group
+
+        :param ttl: number of seconds a result is kept after the call, results are not kept if 0
+        :param max_size: maximum number of kept results
+        """
+        self._ttl = ttl
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._results = {}
+        self._tasks = {}
+        self._generations = {}
+        self._stats = {'calls': 0, 'executed': 0, 'coalesced': 0, 'cached': 0}
+
+    def get_cached(self, key=None):
+        entry = self._results.get(key)
+        if entry is None:
+            return False, None
+        result, expire_time = entry
+        if expire_time < time.monotonic():
+            del self._results[key]
+            return False, None
+        return True, result
+
+    def do(self, key=None, func=None, *args, **kwargs):
+        """
+        Run function once for all concurrent callers of the same key.
+
+        :param key: hashable key, tuple of name and normalized arguments
+        :param func: function to run
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        :return: result of the function
+        """
+        with self._lock:
+            self._stats['calls'] += 1
+            is_cached, result = self.get_cached(key)
+            if is_cached:
+                self._stats['cached'] += 1
+                return result
+
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call(generation=self._generations.get(key[0], 0))
+                self._calls[key] = call
+                self._stats['executed'] += 1
+            else:
+                self._stats['coalesced'] += 1
+
+        if not is_leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if self._ttl and call.error is None and call.generation == self._generations.get(key[0], 0):
+                    if len(self._results) >= self._max_size:
+                        self._results.clear()
+                    self._results[key] = (call.result, time.monotonic() + self._ttl)
+            call.event.set()
+
+        return call.result
+
+    async def do_async(self, key=None, func=None, *args, **kwargs):
+        """
+        Coroutine version of do() for async views. Blocking function is run in the default executor
+        (with the current app context), callers of the same key in the event loop await one future
+        and calls from other threads are coalesced by do().
+
+        :param key: hashable key, tuple of name and normalized arguments
+        :param func: blocking function to run
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        :return: result of the function
+        """
+        loop = asyncio.get_running_loop()
+        task_key = (id(loop), key)
+        with self._lock:
+            future = self._tasks.get(task_key)
+            if future is not None:
+                self._stats['calls'] += 1
+                self._stats['coalesced'] += 1
+
+        if future is None:
+            run = functools.partial(self.do, key, func, *args, **kwargs)
+            if has_app_context():
+                run = functools.partial(self.run_in_app_context, app._get_current_object(), run)
+            future = loop.run_in_executor(None, run)
+            with self._lock:
+                self._tasks[task_key] = future
+            future.add_done_callback(lambda done: self.remove_task(task_key, done))
+
+        return await asyncio.shield(future)
+
+    @staticmethod
+    def run_in_app_context(flask_app=None, func=None):
+        with flask_app.app_context():
+            return func()
+
+    def remove_task(self, task_key=None, future=None):
+        with self._lock:
+            if self._tasks.get(task_key) is future:
+                del self._tasks[task_key]
+
+    def invalidate(self, name=None, arguments=None):
+        """
+        Drop kept results, results of calls running now are not kept.
+
+        :param name: first item of the keys, all names if None
+        :param arguments: normalized arguments of the key, all keys of the name if None
+        :return:
+        """
+        with self._lock:
+            if name is None:
+                names = set(key[0] for key in list(self._results) + list(self._calls))
+                self._results.clear()
+            else:
+                names = [name]
+                if arguments is None:
+                    for key in [key for key in self._results if key[0] == name]:
+                        del self._results[key]
+                else:
+                    self._results.pop((name, arguments), None)
+            for one_name in names:
+                self._generations[one_name] = self._generations.get(one_name, 0) + 1
+
+    def get_stats(self):
+        """
+        Get number of calls of the worker
+
+        :return: data_dict: dictionary with following keys:
+                 'calls': number of calls
+                 'executed': number of calls which ran the function
+                 'coalesced': number of calls which waited for a running call
+                 'cached': number of calls served from kept results
+                 'in_flight': number of running calls
+        """
+        with self._lock:
+            output = dict(self._stats)
+            output['in_flight'] = len(self._calls)
+            return output
+
+
+def coalesced(name=None, get_key=None):
+    """
+    Decorator of model read method for coalescing identical concurrent calls by the app single flight object.
+
+    :param name: name of the call, used for invalidation
+    :param get_key: function returning hashable normalized arguments of the method, all arguments if None
+    :return: decorator
+    """
+    def decorator(method):
+        def get_call_key(*args, **kwargs):
+            if get_key is None:
+                return name, args, tuple(sorted(kwargs.items()))
+            return name, get_key(*args, **kwargs)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            single_flight = get_single_flight()
+            if single_flight is None:
+                return method(self, *args, **kwargs)
+            return single_flight.do(get_call_key(*args, **kwargs), method, self, *args, **kwargs)
+
+        async def run_async(self, *args, **kwargs):
+            single_flight = get_single_flight()
+            if single_flight is None:
+                return method(self, *args, **kwargs)
+            return await single_flight.do_async(get_call_key(*args, **kwargs), method, self, *args, **kwargs)
+
+        # Coroutine version for async views, e.g. await Song.search_by.run_async(Song(), key_search='...')
+        wrapper.run_async = run_async
+        return wrapper
+    return decorator
@@ -6,15 +6,27 @@ __author__ = 'Porntip Chaibamrung'
 
 import bson
 from flask import json, current_app
+from instance.suggest import get_suggest_index
+from instance.similar import get_similar_index
+from instance.count_cache import get_count_cache
+from instance.song_stats import get_song_stats
+from instance.single_flight import coalesced, get_single_flight
+from instance.song_ids import get_song_id_index
+from instance.storage import get_storage
+from instance.catalog import SNAPSHOT_FIELDS
 
 app = current_app
 
 
-def create_from_file(file_path=None):
+def create_from_file(file_path=None, upsert=False, batch_size=None, update_indexes=True):
     """
     Import song data from JSON file.
 
     :param file_path: full file path to JSON file
+    :param upsert: if True, songs are upserted by natural key in batches so importing the same file again is safe
+    :param batch_size: number of upsert operations per bulk write. Default is IMPORT_BATCH_SIZE config value
+    :param update_indexes: if False, in-memory indexes are not updated, e.g. by a command line process which
+                           does not serve requests or before the indexes are built at startup
     :return: status: True if creation is done successfully
     """
     if file_path is None:
@@ -24,9 +36,12 @@ def create_from_file(file_path=None):
     with open(file_path) as json_file:
         data = json.load(json_file)
         app.logger.debug('== JSON data: %s', data)
-        for one_row in data:
-            app.logger.debug('one_row: %s', one_row)
-            Song().create(**one_row)
+        if upsert:
+            Song().upsert_many(data, batch_size=batch_size, update_indexes=update_indexes)
+        else:
+            for one_row in data:
+                app.logger.debug('one_row: %s', one_row)
+                Song().create(**one_row)
 
         status = True
     return status
@@ -70,14 +85,14 @@ class Song(object):
     Class object for song management
 
     """
-    _mongo = None
+    _storage = None
 
     def __init__(self):
         """
-        Initiate PyMongo object for the class
+        Initiate storage object for the class (see STORAGE_BACKEND config)
         """
 
-        self._mongo = app.config['mongodb']
+        self._storage = get_storage()
 
     def get_dbnames(self):
         """
@@ -86,7 +101,7 @@ class Song(object):
         :return: dbnames_list: list of collection names
         """
 
-        dbnames_list = self._mongo.db.list_collection_names()
+        dbnames_list = self._storage.list_collection_names()
         app.logger.debug('== dbnames_list: %s', dbnames_list)
         app.logger.debug('== dbnames_list: %s', len(dbnames_list))
         return dbnames_list
@@ -97,21 +112,213 @@ class Song(object):
 
         :return:
         """
-        self._mongo.db.command("dropDatabase")
+        self._storage.drop_database()
+
+    def create_indexes(self):
+        """
+        Create unique index of song natural key (see SONG_NATURAL_KEY config).
+        Index is not created if the collection already contains duplicated songs.
+
+        :return: status: True if the index exists
+        """
+        return self._storage.create_song_indexes(natural_key=app.config['SONG_NATURAL_KEY'])
+
+    def get_natural_key_filter(self, data_dict=None):
+        """
+        Get query filter of song natural key from song data.
 
-    def create(self, **kwargs):
+        :param data_dict: dictionary of song data
+        :return: filter_dict: dictionary of natural key fields and values
+        """
+        return {key: data_dict.get(key) for key in app.config['SONG_NATURAL_KEY']}
+
+    def create(self, upsert=False, **kwargs):
         """
         Add row to songs collection.
 
+        :param upsert: if True, update existing song with the same natural key instead of adding a duplicated row.
+                       If False, adding existing song raises DuplicateKeyError
         :param kwargs: dictionary of data
-        :return: created_id: string of created object id
+        :return: created_id: string of created (or updated) object id
         """
         app.logger.debug('CREATE args: %s', kwargs)
-        created_id = self._mongo.db.songs.insert_one(kwargs).inserted_id
+        if upsert:
+            created_id = self._storage.upsert_song(key_filter=self.get_natural_key_filter(kwargs), data=kwargs)
+        else:
+            created_id = self._storage.insert_song(data=kwargs)
         created_id = str(created_id)
         app.logger.debug('created_id: %s', created_id)
+
+        self.after_create([(created_id, kwargs)])
         return created_id
 
+    def after_create(self, created=None):
+        """
+        Update in-memory structures of the app after songs are created or updated.
+
+        :param created: list of tuple of created id string and dictionary of song data
+        :return:
+        """
+        single_flight = get_single_flight()
+        if single_flight is not None:
+            single_flight.invalidate(name='song_search')
+
+        count_cache = get_count_cache()
+        if count_cache is not None:
+            count_cache.invalidate()
+
+        suggest_index = get_suggest_index()
+        if suggest_index is not None:
+            for created_id, one_row in created:
+                suggest_index.add(song_id=created_id, artist=one_row.get('artist'), title=one_row.get('title'))
+
+        similar_index = get_similar_index()
+        if similar_index is not None:
+            for created_id, one_row in created:
+                similar_index.add(song_id=created_id, data=one_row)
+
+        song_stats = get_song_stats()
+        if song_stats is not None:
+            for created_id, one_row in created:
+                song_stats.add(song_id=created_id, data=one_row)
+
+        song_id_index = get_song_id_index()
+        if song_id_index is not None:
+            for created_id, one_row in created:
+                song_id_index.add(song_id=created_id)
+
+    def build_indexes(self, songs=None, rating_counts=None, snapshot=None):
+        """
+        Rebuild in-memory indexes of the app at once, which is faster than adding many songs one by one.
+
+        :param songs: list of song documents with SNAPSHOT_FIELDS fields, all songs are read from the database if None
+                      and there is no snapshot. Songs are added to the songs of the snapshot if it is given
+        :param rating_counts: dictionary of number of ratings with song id string as key.
+                              Current counts of suggestion index are kept if None
+        :param snapshot: CatalogSnapshot object, its songs are indexed from its built index entries
+        :return:
+        """
+        if songs is None and snapshot is None:
+            songs = []
+            for batch in self._storage.iter_batches(collection='songs', fields=list(SNAPSHOT_FIELDS),
+                                                    batch_size=app.config['EXPORT_BATCH_SIZE']):
+                songs.extend(batch)
+        songs = songs or []
+        base_songs = list(snapshot.iter_documents()) if snapshot is not None else songs
+
+        suggest_index = get_suggest_index()
+        if suggest_index is not None:
+            if rating_counts is None:
+                rating_counts = suggest_index.get_rating_counts()
+            if snapshot is None:
+                suggest_index.build(songs=songs, rating_counts=rating_counts)
+            else:
+                suggest_index.build(songs=base_songs, rating_counts=rating_counts,
+                                    entries=snapshot.get_suggest_entries())
+
+        similar_index = get_similar_index()
+        if similar_index is not None:
+            similar_index.build(songs=base_songs, levels=snapshot.get_similar_levels() if snapshot else None)
+
+        song_id_index = get_song_id_index()
+        if song_id_index is not None:
+            song_ids = [document['_id'] for document in songs]
+            song_id_index.build(song_ids=snapshot.get_song_ids() + song_ids if snapshot is not None else song_ids)
+
+        song_stats = get_song_stats()
+        if song_stats is not None:
+            if snapshot is None:
+                song_stats.build(batches=[songs])
+            else:
+                song_stats.build(ids=snapshot.get_song_ids(), columns=snapshot.get_stats_columns())
+
+        if snapshot is not None:
+            # Songs created after the snapshot
+            for document in songs:
+                if suggest_index is not None:
+                    suggest_index.add(song_id=document['_id'], artist=document.get('artist'),
+                                      title=document.get('title'))
+                if similar_index is not None:
+                    similar_index.add(song_id=document['_id'], data=document)
+                if song_stats is not None:
+                    song_stats.add(song_id=document['_id'], data=document)
+
+    def after_delete(self, song_id=None):
+        """
+        Update in-memory structures of the app after a song is deleted.
+
+        :param song_id: string of deleted song object id
+        :return:
+        """
+        single_flight = get_single_flight()
+        if single_flight is not None:
+            single_flight.invalidate(name='song_search')
+
+        count_cache = get_count_cache()
+        if count_cache is not None:
+            count_cache.invalidate()
+
+        suggest_index = get_suggest_index()
+        if suggest_index is not None:
+            suggest_index.remove(song_id=song_id)
+
+        similar_index = get_similar_index()
+        if similar_index is not None:
+            similar_index.remove(song_id=song_id)
+
+        song_stats = get_song_stats()
+        if song_stats is not None:
+            song_stats.remove(song_id=song_id)
+
+        song_id_index = get_song_id_index()
+        if song_id_index is not None:
+            song_id_index.remove(song_id=song_id)
+
+    def upsert_many(self, data=None, batch_size=None, update_indexes=True):
+        """
+        Upsert songs by natural key with batched bulk writes.
+        In-memory indexes are rebuilt once after all batches if any song is inserted or modified.
+
+        :param data: iterable of dictionary of song data
+        :param batch_size: number of operations per bulk write. Default is IMPORT_BATCH_SIZE config value
+        :param update_indexes: if False, in-memory indexes are not rebuilt
+        :return: data_dict: dictionary with 'inserted', 'modified' and 'matched' number of rows
+        """
+        if batch_size is None:
+            batch_size = app.config['IMPORT_BATCH_SIZE']
+
+        result = {'inserted': 0, 'modified': 0, 'matched': 0}
+        operations = []
+
+        def flush():
+            bulk_result = self._storage.upsert_songs(operations=operations)
+            result['inserted'] += bulk_result['inserted']
+            result['modified'] += bulk_result['modified']
+            result['matched'] += bulk_result['matched']
+            del operations[:]
+
+        for one_row in data or []:
+            operations.append((self.get_natural_key_filter(one_row), one_row))
+            if len(operations) >= batch_size:
+                flush()
+        if operations:
+            flush()
+
+        if result['inserted'] or result['modified']:
+            single_flight = get_single_flight()
+            if single_flight is not None:
+                single_flight.invalidate(name='song_search')
+
+            count_cache = get_count_cache()
+            if count_cache is not None:
+                count_cache.invalidate()
+
+            if update_indexes:
+                self.build_indexes()
+
+        app.logger.debug('UPSERT result: %s', result)
+        return result
+
     def get_doc_from_cursor(self, cursor=None):
         """
         Get document from cursor object.
@@ -123,38 +330,75 @@ class Song(object):
             # app.logger.debug('== document: %s', document)
             return document
 
-    def list_all(self):
+    def get_filter(self, level_value=None, key_search=None):
+        """
+        Get query of songs by level value and/or artist name or title string.
+
+        :param level_value: integer value of level for searching
+        :param key_search: string for searching in artist name or title
+        :return: query_dict: dictionary of song query, see BaseStorage class
+        """
+        query_filter = {}
+        if level_value is not None:
+            query_filter['level'] = int(level_value)
+        if key_search is not None:
+            query_filter['key_search'] = key_search
+        return query_filter
+
+    def count(self, query_filter=None):
+        """
+        Count songs matching query filter.
+        Without filter the count comes from collection metadata, filtered counts are cached (see SONG_COUNT_CACHE_TTL).
+
+        :param query_filter: dictionary of song query
+        :return: count: number of songs
+        """
+        if not query_filter:
+            return self._storage.count_songs()
+
+        count_cache = get_count_cache()
+        if count_cache is not None:
+            count = count_cache.get(query_filter)
+            if count is not None:
+                return count
+
+        count = self._storage.count_songs(query=query_filter)
+        if count_cache is not None:
+            count_cache.set(query_filter, count)
+        return count
+
+    def list_all(self, query_filter=None):
         """
         List all rows in songs collection
 
+        :param query_filter: dictionary of song query
         :return: list: list of dictionary data of a song
         """
 
-        songs = self._mongo.db.songs
-        # app.logger.debug('songs: %s', songs)
-        output = convert_to_list(songs.find())
+        output = convert_to_list(self._storage.find_songs(query=query_filter))
         return output
 
-    def list(self, page_size=1, page_number=None):
+    def list(self, page_size=1, page_number=None, query_filter=None):
         """
         List data rows from songs collection or certain set of data with pagination.
 
         :param page_size: number of row per page
         :param page_number: page number for displaying
-        :param skip_value: number of row for jumping
+        :param query_filter: dictionary of song query
         :return: list: list of dictionary data of a song
         """
-        songs = None
+        songs = []
         if page_number == 1:
-            songs = self._mongo.db.songs.find().limit(int(page_size))
+            songs = self._storage.find_songs(query=query_filter, limit=int(page_size))
         else:
             if page_number > 1:
-                next_skip = (int(page_size) * int(page_number)) - 1
-                songs = self._mongo.db.songs.find().skip(next_skip).limit(int(page_size))
+                next_skip = int(page_size) * (int(page_number) - 1)
+                songs = self._storage.find_songs(query=query_filter, skip=next_skip, limit=int(page_size))
 
         output = convert_to_list(songs)
         return output
 
+    @coalesced(name='song_search', get_key=lambda key_search=None: key_search)
     def search_by(self, key_search=None):
         """
         Search songs by given artist name or title string.
@@ -163,9 +407,7 @@ class Song(object):
         :return: list: list of dictionary data of a song
         """
         app.logger.debug('key_search: %s', key_search)
-        songs = self._mongo.db.songs.find({'$or': [
-            {'artist': {'$regex': key_search, '$options': 'i'}},
-            {'title': {'$regex': key_search, '$options': 'i'}}]})
+        songs = self._storage.find_songs(query=self.get_filter(key_search=key_search))
 
         output = convert_to_list(songs)
         return output
@@ -177,7 +419,7 @@ class Song(object):
         :param level_value: integer value of level for searching
         :return: list: list of dictionary data of a song
         """
-        songs = self._mongo.db.songs.find({"level": int(level_value)})
+        songs = self._storage.find_songs(query=self.get_filter(level_value=level_value))
 
         output = convert_to_list(songs)
         return output
@@ -188,21 +430,7 @@ class Song(object):
 
         :return: float value of average level value
         """
-        cursor = self._mongo.db.songs.aggregate([
-            {
-                '$group': {
-                    '_id': "$id",
-                    "avg_level": {'$avg': '$level'}
-                }
-            }
-        ])
-        # app.logger.debug('== get_average_level cursor: %s', cursor)
-
-        avg_value = None
-        for document in cursor:
-            # app.logger.debug('== get_average_level document: %s', document)
-            avg_value = document["avg_level"]
-
+        avg_value = self._storage.get_song_average(field='level')
         return float(avg_value)
 
     def get_average_difficulty(self):
@@ -211,21 +439,7 @@ class Song(object):
 
         :return: float value of average difficulty value
         """
-        cursor = self._mongo.db.songs.aggregate([
-            {
-                '$group': {
-                    '_id': "$id",
-                    "avg_level": {'$avg': '$difficulty'}
-                }
-            }
-        ])
-        # app.logger.debug('== get_average_difficulty cursor: %s', cursor)
-
-        avg_value = None
-        for document in cursor:
-            # app.logger.debug('== get_average_difficulty document: %s', document)
-            avg_value = document["avg_level"]
-
+        avg_value = self._storage.get_song_average(field='difficulty')
         return float(avg_value)
 
     def delete(self, song_id=None):
@@ -240,11 +454,8 @@ class Song(object):
 
         song_id = bson.ObjectId(str(song_id))
 
-        # db_response contains DeleteResult object
-        db_response = self._mongo.db.songs.delete_one({'_id': song_id})
-
-        app.logger.debug('DELETE - db_response count: %s', db_response.deleted_count)
-        if db_response.deleted_count == 1:
+        if self._storage.delete_song(song_id=song_id):
+            self.after_delete(str(song_id))
             return True
         else:
             return False
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import datetime
+import hashlib
+import math
+import threading
+import time
+
+import bson
+from flask import current_app
+
+from instance.storage import get_storage
+
+app = current_app
+
+# Ids generated this number of seconds before the Bloom filter was built are checked with a point lookup
+# when the filter does not match them, to allow for the clocks of other processes and songs read late
+NEW_ID_MARGIN = 300
+
+
+def get_song_id_index():
+    """
+    Get song id index object of the current app
+
+    :return: SongIdIndex object or None if the app does not have one
+    """
+    return app.config.get('song_id_index', None)
+
+
+class BloomFilter(object):
+    """
+    Class object of Bloom filter of byte strings. Values can not be removed.
+
+    """
+
+    def __init__(self, capacity=1000, error_rate=0.001):
+        """
+        Initiate empty filter
+
+        :param capacity: expected number of values
+        :param error_rate: false positive rate at the expected number of values
+        """
+        self._size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self._hash_count = max(1, int(round(self._size / capacity * math.log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def get_positions(self, value=None):
+        digest = hashlib.blake2b(value, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + index * second) % self._size for index in range(self._hash_count)]
+
+    def add(self, value=None):
+        for position in self.get_positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(value))
+
+    def get_memory_size(self):
+        return len(self._bits)
+
+
+class SongIdIndex(object):
+    """
+    Class object for checking existence of song ids without database query.
+
+    Ids are kept in an exact set up to exact_max songs. Ids missing from the set are checked with a point
+    lookup, so songs created by other worker processes are found and added to the index.
+    Larger catalogs switch to a Bloom filter, which has no false negatives but matches unknown ids with
+    error_rate probability. Matched ids are accepted without query, so a rating of an unknown id is accepted
+    with error_rate probability. Ids not matched by the filter are rejected without query, except ids generated
+    after the filter was built (less NEW_ID_MARGIN seconds), which may be songs created by other worker
+    processes: they are checked with a point lookup and added.
+    Songs deleted by other worker processes are removed from the index every refresh_interval seconds,
+    see find_deleted_song_ids() function of storage. Removed ids are checked with a point lookup.
+    """
+
+    def __init__(self, exact_max=100000, error_rate=0.001, refresh_interval=5):
+        """
+        Initiate empty index
+
+        :param exact_max: maximum number of songs kept in exact set
+        :param error_rate: false positive rate of Bloom filter
+        :param refresh_interval: seconds between reads of songs deleted by other worker processes
+        """
+        self._exact_max = exact_max
+        self._error_rate = error_rate
+        self._refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._ids = set()
+        self._bloom = None
+        self._removed = set()
+        self._count = 0
+        self._built = datetime.datetime.utcnow()
+        self._refreshed = self._built
+        self._next_refresh = time.monotonic() + refresh_interval
+        self._stats = {'hits': 0, 'lookups': 0, 'rejected': 0}
+
+    @staticmethod
+    def get_key(song_id=None):
+        return bson.ObjectId(str(song_id)).binary
+
+    def build(self, song_ids=None):
+        """
+        Rebuild index from song ids.
+
+        :param song_ids: iterable of song object id
+        :return: count: number of songs in the index
+        """
+        built = datetime.datetime.utcnow()
+        keys = set(self.get_key(song_id) for song_id in song_ids or [])
+        with self._lock:
+            self._removed = set()
+            self._count = len(keys)
+            self._built = built
+            # Songs deleted while the ids were read are removed by the next refresh
+            self._refreshed = built - datetime.timedelta(seconds=NEW_ID_MARGIN)
+            if len(keys) <= self._exact_max:
+                self._ids = keys
+                self._bloom = None
+            else:
+                self._ids = set()
+                self._bloom = self.get_bloom(keys)
+
+        app.logger.debug('Song id index built with %s songs', len(keys))
+        return len(keys)
+
+    def get_bloom(self, keys=None):
+        bloom = BloomFilter(capacity=max(self._exact_max, len(keys) * 2), error_rate=self._error_rate)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def add(self, song_id=None):
+        """
+        Add song id to the index.
+
+        :param song_id: song object id or its string
+        :return:
+        """
+        key = self.get_key(song_id)
+        with self._lock:
+            if self._bloom is None:
+                if key in self._ids:
+                    return
+                self._ids.add(key)
+                self._count += 1
+                if len(self._ids) > self._exact_max:
+                    self._bloom = self.get_bloom(self._ids)
+                    self._ids = set()
+            else:
+                self._removed.discard(key)
+                self._bloom.add(key)
+                self._count += 1
+
+    def remove(self, song_id=None):
+        """
+        Remove song id from the index.
+
+        :param song_id: song object id or its string
+        :return:
+        """
+        key = self.get_key(song_id)
+        with self._lock:
+            if self._bloom is None:
+                if key in self._ids:
+                    self._ids.discard(key)
+                    self._count -= 1
+            elif key not in self._removed and key in self._bloom:
+                self._removed.add(key)
+                self._count -= 1
+
+    def refresh(self):
+        """
+        Remove songs deleted by other worker processes since the last refresh.
+
+        :return: count: number of deleted songs
+        """
+        with self._lock:
+            since = self._refreshed
+            # The next refresh reads again deletions of the last interval, which may be committed late
+            self._refreshed = datetime.datetime.utcnow() - datetime.timedelta(seconds=self._refresh_interval)
+
+        song_ids = get_storage().find_deleted_song_ids(since=since)
+        for song_id in song_ids:
+            self.remove(song_id)
+        return len(song_ids)
+
+    def is_new(self, key=None):
+        generation_time = bson.ObjectId(key).generation_time.replace(tzinfo=None)
+        return generation_time >= self._built - datetime.timedelta(seconds=NEW_ID_MARGIN)
+
+    def contains(self, song_id=None):
+        """
+        Check if a song exists.
+
+        :param song_id: song object id or its string
+        :return: status: True if the song exists
+        """
+        key = self.get_key(song_id)
+        with self._lock:
+            is_refresh = time.monotonic() >= self._next_refresh
+            if is_refresh:
+                self._next_refresh = time.monotonic() + self._refresh_interval
+        if is_refresh:
+            self.refresh()
+
+        with self._lock:
+            if key not in self._removed:
+                if (key in self._ids) if self._bloom is None else (key in self._bloom):
+                    self._stats['hits'] += 1
+                    return True
+                if self._bloom is not None and not self.is_new(key):
+                    self._stats['rejected'] += 1
+                    return False
+            self._stats['lookups'] += 1
+
+        if get_storage().has_song(song_id=bson.ObjectId(key)):
+            self.add(song_id)
+            return True
+
+        with self._lock:
+            self._stats['rejected'] += 1
+        return False
+
+    def get_stats(self):
+        """
+        Get statistic data of the index
+
+        :return: data_dict: dictionary with following keys:
+                 'mode': 'exact' or 'bloom'
+                 'total': number of songs
+                 'hits': number of ids found in the index without database query
+                 'lookups': number of ids checked in the database
+                 'rejected': number of unknown ids
+        """
+        with self._lock:
+            output = dict(self._stats)
+            output['mode'] = 'exact' if self._bloom is None else 'bloom'
+            output['total'] = self._count
+            return output
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import threading
+
+from flask import current_app
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+app = current_app
+
+DEFAULT_PERCENTILES = (25, 50, 75, 90)
+
+
+def get_song_stats():
+    """
+    Get song statistic snapshot object of the current app
+
+    :return: SongStatsSnapshot object or None if numpy is not installed
+    """
+    return app.config.get('song_stats', None)
+
+
+def parse_released(value=None):
+    """
+    Parse released date of a song.
+
+    :param value: string of released date in 'YYYY-MM-DD' format
+    :return: numpy.datetime64 object, NaT if the value is not a valid date
+    """
+    try:
+        return numpy.datetime64(value, 'D')
+    except (TypeError, ValueError):
+        return numpy.datetime64('NaT', 'D')
+
+
+class SongStatsSnapshot(object):
+    """
+    Class object of columnar snapshot of song level, difficulty and released date for analytics.
+
+    Columns are NumPy arrays with spare capacity, so adding a song is an append and deleting
+    a song moves the last row into its place. Statistic data is computed with vectorized operations.
+    """
+
+    def __init__(self, capacity=1024):
+        """
+        Initiate empty snapshot
+
+        :param capacity: initial number of rows
+        """
+        self._lock = threading.Lock()
+        self._size = 0
+        self._ids = []
+        self._positions = {}
+        self._level = numpy.zeros(capacity, dtype=numpy.float64)
+        self._difficulty = numpy.zeros(capacity, dtype=numpy.float64)
+        self._released = numpy.full(capacity, numpy.datetime64('NaT', 'D'), dtype='datetime64[D]')
+
+    def _grow(self):
+        capacity = max(1024, len(self._level) * 2)
+        for name in ('_level', '_difficulty', '_released'):
+            column = getattr(self, name)
+            new_column = numpy.empty(capacity, dtype=column.dtype)
+            new_column[:self._size] = column[:self._size]
+            setattr(self, name, new_column)
+
+    @staticmethod
+    def get_number(value=None):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return numpy.nan
+        return float(value)
+
+    def build(self, batches=None, ids=None, columns=None):
+        """
+        Rebuild snapshot from song documents or from columns.
+
+        :param batches: iterable of list of song documents with 'level', 'difficulty' and 'released' fields
+        :param ids: list of song id string of the columns, batches are used if None
+        :param columns: tuple of level (float64), difficulty (float64) and released days since 1970-01-01 (int64)
+                        buffers of the songs, e.g. read from catalog snapshot. The buffers are copied
+        :return: total: number of songs in the snapshot
+        """
+        if ids is None:
+            ids = []
+            levels = []
+            difficulties = []
+            released = []
+            for batch in batches or []:
+                for document in batch:
+                    ids.append(str(document['_id']))
+                    levels.append(self.get_number(document.get('level')))
+                    difficulties.append(self.get_number(document.get('difficulty')))
+                    released.append(parse_released(document.get('released')))
+            released = numpy.array(released, dtype='datetime64[D]')
+        else:
+            levels, difficulties, released = [numpy.frombuffer(column, dtype=dtype) for column, dtype
+                                              in zip(columns, (numpy.float64, numpy.float64, numpy.int64))]
+            released = released.view('datetime64[D]')
+
+        capacity = max(1024, len(ids) * 2)
+        with self._lock:
+            self._size = len(ids)
+            self._ids = list(ids)
+            self._positions = {song_id: position for position, song_id in enumerate(ids)}
+            self._level = numpy.zeros(capacity, dtype=numpy.float64)
+            self._difficulty = numpy.zeros(capacity, dtype=numpy.float64)
+            self._released = numpy.full(capacity, numpy.datetime64('NaT', 'D'), dtype='datetime64[D]')
+            self._level[:self._size] = levels
+            self._difficulty[:self._size] = difficulties
+            self._released[:self._size] = released
+
+        app.logger.debug('Song stats snapshot built with %s songs', len(ids))
+        return len(ids)
+
+    def add(self, song_id=None, data=None):
+        """
+        Add song to the snapshot or update it if exists.
+
+        :param song_id: string of song object id
+        :param data: dictionary of song data
+        :return:
+        """
+        song_id = str(song_id)
+        with self._lock:
+            position = self._positions.get(song_id)
+            if position is None:
+                if self._size == len(self._level):
+                    self._grow()
+                position = self._size
+                self._size += 1
+                self._ids.append(song_id)
+                self._positions[song_id] = position
+
+            self._level[position] = self.get_number(data.get('level'))
+            self._difficulty[position] = self.get_number(data.get('difficulty'))
+            self._released[position] = parse_released(data.get('released'))
+
+    def remove(self, song_id=None):
+        """
+        Remove song from the snapshot.
+
+        :param song_id: string of song object id
+        :return: status: True if the song was found in the snapshot
+        """
+        song_id = str(song_id)
+        with self._lock:
+            position = self._positions.pop(song_id, None)
+            if position is None:
+                return False
+
+            last = self._size - 1
+            last_id = self._ids.pop()
+            if position != last:
+                self._ids[position] = last_id
+                self._positions[last_id] = position
+                for column in (self._level, self._difficulty, self._released):
+                    column[position] = column[last]
+            self._size = last
+        return True
+
+    def get_columns(self):
+        """
+        Get copy of columns of all songs
+
+        :return: tuple of level, difficulty and released arrays
+        """
+        with self._lock:
+            size = self._size
+            return self._level[:size].copy(), self._difficulty[:size].copy(), self._released[:size].copy()
+
+    @staticmethod
+    def get_group_percentiles(sorted_values=None, starts=None, counts=None, percentiles=None):
+        """
+        Get percentiles of every group of values with linear interpolation.
+
+        :param sorted_values: array of values sorted inside each group
+        :param starts: array of start position of each group
+        :param counts: array of number of values of each group
+        :param percentiles: list of percentiles between 0 and 100
+        :return: array of shape (number of groups, number of percentiles)
+        """
+        fractions = numpy.asarray(percentiles, dtype=numpy.float64) / 100.0
+        ranks = (counts[:, None] - 1) * fractions[None, :]
+        lower = numpy.floor(ranks).astype(numpy.int64)
+        upper = numpy.minimum(lower + 1, counts[:, None] - 1)
+        weights = ranks - lower
+        lower_values = sorted_values[starts[:, None] + lower]
+        upper_values = sorted_values[starts[:, None] + upper]
+        return lower_values + (upper_values - lower_values) * weights
+
+    def get_stats(self, percentiles=DEFAULT_PERCENTILES, bins=10):
+        """
+        Get difficulty distribution of all songs and of every level, correlation between level and
+        difficulty, and number of songs released per year.
+
+        :param percentiles: list of percentiles between 0 and 100
+        :param bins: number of difficulty histogram bins
+        :return: data_dict: dictionary with following keys:
+                 'total': number of songs with level and difficulty
+                 'correlation': Pearson correlation between level and difficulty, None if undefined
+                 'difficulty': dictionary with 'avg_value', 'min_value', 'max_value' and 'percentiles'
+                 'histogram_edges': list of difficulty histogram bin edges
+                 'levels': list of dictionary of statistic data of each level with 'histogram' counts
+                 'released': list of dictionary with 'year' and 'total' number of released songs
+        """
+        levels, difficulties, released = self.get_columns()
+        percentile_keys = ['{:g}'.format(p) for p in percentiles]
+
+        valid = ~numpy.isnan(levels) & ~numpy.isnan(difficulties)
+        levels = levels[valid]
+        difficulties = difficulties[valid]
+        total = int(levels.size)
+
+        years, year_counts = numpy.unique(released[~numpy.isnat(released)].astype('datetime64[Y]'),
+                                          return_counts=True)
+        released_output = [{'year': int(str(year)), 'total': int(count)} for year, count in zip(years, year_counts)]
+
+        if total == 0:
+            return {'total': 0, 'correlation': None, 'difficulty': None, 'histogram_edges': [], 'levels': [],
+                    'released': released_output}
+
+        correlation = None
+        if total > 1 and levels.std() > 0 and difficulties.std() > 0:
+            correlation = float(numpy.corrcoef(levels, difficulties)[0, 1])
+
+        overall = numpy.percentile(difficulties, percentiles)
+
+        order = numpy.lexsort((difficulties, levels))
+        sorted_levels = levels[order]
+        sorted_difficulties = difficulties[order]
+        level_values, starts, counts = numpy.unique(sorted_levels, return_index=True, return_counts=True)
+        group_percentiles = self.get_group_percentiles(sorted_difficulties, starts, counts, percentiles)
+        sums = numpy.add.reduceat(sorted_difficulties, starts)
+        minimums = sorted_difficulties[starts]
+        maximums = sorted_difficulties[starts + counts - 1]
+
+        edges = numpy.histogram_bin_edges(difficulties, bins=bins)
+        positions = numpy.clip(numpy.searchsorted(edges, sorted_difficulties, side='right') - 1, 0, len(edges) - 2)
+        group_index = numpy.repeat(numpy.arange(len(level_values)), counts)
+        histograms = numpy.zeros((len(level_values), len(edges) - 1), dtype=numpy.int64)
+        numpy.add.at(histograms, (group_index, positions), 1)
+
+        levels_output = []
+        for index, level in enumerate(level_values):
+            levels_output.append({
+                'level': int(level) if float(level).is_integer() else float(level),
+                'total': int(counts[index]),
+                'avg_value': float(sums[index] / counts[index]),
+                'min_value': float(minimums[index]),
+                'max_value': float(maximums[index]),
+                'percentiles': dict(zip(percentile_keys, group_percentiles[index].tolist())),
+                'histogram': histograms[index].tolist()
+            })
+
+        return {
+            'total': total,
+            'correlation': correlation,
+            'difficulty': {
+                'avg_value': float(difficulties.mean()),
+                'min_value': float(difficulties.min()),
+                'max_value': float(difficulties.max()),
+                'percentiles': dict(zip(percentile_keys, overall.tolist()))
+            },
+            'histogram_edges': edges.tolist(),
+            'levels': levels_output,
+            'released': released_output
+        }
@@ -0,0 +1,1412 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import abc
+import concurrent.futures
+import datetime
+import hashlib
+import heapq
+import itertools
+import re
+import threading
+
+import bson
+from flask import current_app
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+app = current_app
+
+# Number of retries of upserts which failed on unique index when the same song is upserted concurrently
+UPSERT_RETRIES = 3
+# Seconds for which ids of deleted songs are kept for other worker processes, see find_deleted_song_ids()
+DELETED_SONGS_TTL = 86400
+
+
+def get_storage():
+    """
+    Get storage object of the current app
+
+    :return: storage object, see BaseStorage class
+    """
+    return app.config['storage']
+
+
+def create_storage(app=None):
+    """
+    Create storage object selected by STORAGE_BACKEND config.
+    Ratings are routed to shards by ShardedStorage if RATING_SHARD_URIS config is not empty.
+
+    :param app: app object. PyMongo object must be in 'mongodb' config for 'mongo' backend, and
+                PyMongo objects of RATING_SHARD_URIS in 'rating_shard_mongodbs' config
+    :return: storage object, see BaseStorage class
+    """
+    backend = app.config['STORAGE_BACKEND']
+    shard_uris = app.config.get('RATING_SHARD_URIS') or []
+    if backend == 'mongo':
+        storage = MongoStorage(mongo=app.config['mongodb'])
+        rating_shards = [MongoStorage(mongo=mongo) for mongo in app.config.get('rating_shard_mongodbs', [])]
+    elif backend == 'memory':
+        storage = MemoryStorage()
+        # In-memory stand-in of every shard deployment
+        rating_shards = [MemoryStorage() for uri in shard_uris]
+    else:
+        raise ValueError("Unknown storage backend: {}".format(backend))
+
+    if rating_shards:
+        return ShardedStorage(song_storage=storage, rating_shards=rating_shards)
+    return storage
+
+
+def get_creation_range(collection=None, start=None, end=None):
+    """
+    Get field and values for filtering documents by creation date.
+    Songs have no creation date field so object ids generated at start and end date are used.
+
+    :param collection: 'songs' or 'ratings'
+    :param start: datetime object of first creation date
+    :param end: datetime object of end of creation date (excluded)
+    :return: tuple of field name, start value and end value
+    """
+    if collection == 'ratings':
+        return 'creation_date', start, end
+    if collection == 'songs':
+        return ('_id',
+                bson.ObjectId.from_datetime(start) if start is not None else None,
+                bson.ObjectId.from_datetime(end) if end is not None else None)
+    raise ValueError("Unknown collection: {}".format(collection))
+
+
+def get_rating_summary(values=None):
+    """
+    Get summary of rating values.
+
+    :param values: list of rating values
+    :return: data_dict: dictionary with 'count', 'sum', 'min' and 'max' keys and 'values' dictionary of
+             number of ratings with rating value string as key
+    """
+    counts = {}
+    for value in values:
+        counts[str(value)] = counts.get(str(value), 0) + 1
+    return {'count': len(values), 'sum': sum(values), 'min': min(values), 'max': max(values), 'values': counts}
+
+
+def merge_rating_summaries(summaries=None):
+    """
+    Merge summaries of ratings of one song, e.g. summary of ratings in the database and of archived ratings.
+
+    :param summaries: list of summary dictionary, see get_rating_summary() function. None items are skipped
+    :return: data_dict: merged summary or None if there is no rating
+    """
+    summaries = [summary for summary in summaries if summary is not None and summary['count']]
+    if not summaries:
+        return None
+    counts = {}
+    for summary in summaries:
+        for value, count in (summary.get('values') or {}).items():
+            counts[value] = counts.get(value, 0) + count
+    return {
+        'count': sum(summary['count'] for summary in summaries),
+        'sum': sum(summary['sum'] for summary in summaries),
+        'min': min(summary['min'] for summary in summaries),
+        'max': max(summary['max'] for summary in summaries),
+        'values': counts
+    }
+
+
+def subtract_rating_summary(summary=None, restored=None):
+    """
+    Subtract summary of restored ratings from summary of archived ratings of one song.
+    Minimum and maximum are taken from the remaining number of ratings of every value.
+
+    :param summary: summary dictionary of archived ratings, see get_rating_summary() function
+    :param restored: summary dictionary of restored ratings
+    :return: data_dict: remaining summary or None if there is no rating left
+    """
+    count = summary['count'] - restored['count']
+    if count <= 0:
+        return None
+
+    counts = dict(summary.get('values') or {})
+    for value, value_count in (restored.get('values') or {}).items():
+        counts[value] = counts.get(value, 0) - value_count
+    counts = {value: value_count for value, value_count in counts.items() if value_count > 0}
+
+    output = {'count': count, 'sum': summary['sum'] - restored['sum'], 'min': summary['min'],
+              'max': summary['max'], 'values': counts}
+    if counts:
+        numbers = [float(value) for value in counts]
+        output['min'], output['max'] = [int(number) if number.is_integer() else number
+                                        for number in (min(numbers), max(numbers))]
+    return output
+
+
+def get_summary_stat(summary=None):
+    """
+    Get statistic data of rating summary.
+
+    :param summary: summary dictionary, see get_rating_summary() function
+    :return: data_dict: dictionary with 'avg_value', 'min_value' and 'max_value' keys
+    """
+    return {
+        "avg_value": summary['sum'] / float(summary['count']),
+        "min_value": summary['min'],
+        "max_value": summary['max']
+    }
+
+
+class BaseStorage(abc.ABC):
+    """
+    Class object of storage interface used by Song and Rating class.
+
+    Song queries are dictionaries with optional 'level' (integer) and 'key_search'
+    (case insensitive regular expression on artist or title) keys.
+    Object ids are bson.ObjectId objects.
+    """
+
+    @abc.abstractmethod
+    def list_collection_names(self):
+        """
+        Get all collection names
+
+        :return: list: list of collection names
+        """
+
+    @abc.abstractmethod
+    def drop_database(self):
+        """
+        Remove all data
+
+        :return:
+        """
+
+    @abc.abstractmethod
+    def create_song_indexes(self, natural_key=None):
+        """
+        Create unique index of song natural key.
+
+        :param natural_key: tuple of field names
+        :return: status: True if the index exists
+        """
+
+    @abc.abstractmethod
+    def insert_song(self, data=None):
+        """
+        Insert a song.
+
+        :param data: dictionary of song data
+        :return: object id of inserted song
+        """
+
+    @abc.abstractmethod
+    def upsert_song(self, key_filter=None, data=None):
+        """
+        Update song matching natural key filter or insert it if not found.
+
+        :param key_filter: dictionary of natural key fields and values
+        :param data: dictionary of song data
+        :return: object id of updated or inserted song
+        """
+
+    @abc.abstractmethod
+    def upsert_songs(self, operations=None):
+        """
+        Upsert many songs in one batch.
+
+        :param operations: list of tuple of natural key filter and song data, see upsert_song() function
+        :return: data_dict: dictionary with 'inserted', 'modified' and 'matched' number of rows and
+                 'upserted_ids' dictionary of inserted object id with operation index as key
+        """
+
+    @abc.abstractmethod
+    def find_songs(self, query=None, skip=0, limit=0, fields=None):
+        """
+        Find songs matching query.
+
+        :param query: dictionary of song query
+        :param skip: number of skipped songs
+        :param limit: maximum number of songs, 0 means no limit
+        :param fields: list of returned field names, all fields if None. '_id' is always returned
+        :return: iterable of song documents
+        """
+
+    @abc.abstractmethod
+    def count_songs(self, query=None):
+        """
+        Count songs matching query. Count of all songs may be estimated.
+
+        :param query: dictionary of song query
+        :return: count: number of songs
+        """
+
+    @abc.abstractmethod
+    def get_song_average(self, field=None):
+        """
+        Get average value of a song field of all songs.
+
+        :param field: string of field name
+        :return: average value or None if there is no song
+        """
+
+    @abc.abstractmethod
+    def has_song(self, song_id=None):
+        """
+        Check if a song exists with point lookup by id.
+
+        :param song_id: object id of song
+        :return: status: True if the song exists
+        """
+
+    @abc.abstractmethod
+    def delete_song(self, song_id=None):
+        """
+        Delete a song.
+
+        :param song_id: object id of song
+        :return: status: True if the song is deleted
+        """
+
+    @abc.abstractmethod
+    def find_deleted_song_ids(self, since=None):
+        """
+        Find songs deleted since given date. Deleted songs are kept for DELETED_SONGS_TTL seconds.
+
+        :param since: datetime object of first deletion date
+        :return: list: list of object id of deleted songs
+        """
+
+    @abc.abstractmethod
+    def get_songs_version(self):
+        """
+        Get change counter of songs, which is increased by every update and delete of existing songs.
+        Inserted songs do not change it, they are found by creation time of their object id.
+
+        :return: version: number of changes of songs
+        """
+
+    @abc.abstractmethod
+    def insert_rating(self, data=None):
+        """
+        Insert a rating.
+
+        :param data: dictionary of rating data
+        :return: object id of inserted rating
+        """
+
+    @abc.abstractmethod
+    def find_ratings(self):
+        """
+        Find all ratings
+
+        :return: iterable of rating documents
+        """
+
+    @abc.abstractmethod
+    def create_rating_indexes(self):
+        """
+        Create indexes of ratings on 'song_id' and 'creation_date' fields
+
+        :return:
+        """
+
+    @abc.abstractmethod
+    def find_old_ratings(self, before=None, limit=None):
+        """
+        Find ratings created before given date, ordered by creation date and object id.
+
+        :param before: datetime object
+        :param limit: maximum number of ratings
+        :return: list: list of rating documents
+        """
+
+    @abc.abstractmethod
+    def find_song_rating_ids(self, song_id=None, limit=None):
+        """
+        Find ids of ratings of a song using index of song id.
+
+        :param song_id: object id of song
+        :param limit: maximum number of ids
+        :return: list: list of rating object id
+        """
+
+    @abc.abstractmethod
+    def delete_ratings(self, rating_ids=None, song_ids=None):
+        """
+        Delete ratings.
+
+        :param rating_ids: list of rating object id
+        :param song_ids: list of song object id of every rating in order of rating_ids, used for routing
+                         to rating shards. Ratings are looked up in all shards if None
+        :return: deleted_count: number of deleted ratings
+        """
+
+    @abc.abstractmethod
+    def iter_batches(self, collection=None, fields=None, start=None, end=None, batch_size=1000):
+        """
+        Scan songs or ratings in batches, keeping only one batch in memory.
+        Ratings are filtered by 'creation_date', songs by creation time of their object id.
+
+        :param collection: 'songs' or 'ratings'
+        :param fields: list of returned field names, all fields if None. '_id' is always returned
+        :param start: datetime object of first creation date, no limit if None
+        :param end: datetime object of end of creation date (excluded), no limit if None
+        :param batch_size: number of documents per batch
+        :return: generator of list of documents
+        """
+
+    @abc.abstractmethod
+    def find_rating(self, rating_id=None, song_id=None):
+        """
+        Find a rating.
+
+        :param rating_id: object id of rating
+        :param song_id: object id of song of the rating, used for routing to rating shards.
+                        The rating is looked up in all shards if None
+        :return: rating document or None if not found
+        """
+
+    @abc.abstractmethod
+    def update_rating(self, rating_id=None, rating=None, song_id=None):
+        """
+        Set rating value of a rating and update its 'lastModified' date.
+
+        :param rating_id: object id of rating
+        :param rating: rating value
+        :param song_id: object id of song of the rating, used for routing to rating shards.
+                        The rating is looked up in all shards if None
+        :return: modified_count: number of modified ratings
+        """
+
+    @abc.abstractmethod
+    def count_ratings_by_song(self, start=None, end=None):
+        """
+        Count ratings of every rated song, archived ratings included (see add_rating_summaries() function)
+        unless start is given.
+
+        :param start: datetime object of first creation date of counted ratings, no limit if None
+        :param end: datetime object of end of creation date (excluded), no limit if None
+        :return: data_dict: dictionary of number of ratings with song object id as key
+        """
+
+    @abc.abstractmethod
+    def get_rating_stats(self, song_ids=None):
+        """
+        Get average, minimum and maximum rating of songs, archived ratings included.
+
+        :param song_ids: list of song object id
+        :return: data_dict: dictionary with song object id as key and dictionary with 'avg_value',
+                 'min_value' and 'max_value' keys as value. Songs without rating are not included.
+        """
+
+    @abc.abstractmethod
+    def add_rating_summaries(self, summaries=None, batch_key=None):
+        """
+        Add summaries of a batch of archived ratings to rating summaries of their songs.
+        Batch keys must increase from batch to batch, a batch which is already added to the summary of a song
+        (its key is not greater than the last added key) is skipped, so a failed archive run can be repeated.
+
+        :param summaries: dictionary of summary with song object id as key, see get_rating_summary() function
+        :param batch_key: string of batch key
+        :return:
+        """
+
+    @abc.abstractmethod
+    def subtract_rating_summaries(self, summaries=None):
+        """
+        Subtract summaries of restored archived ratings from rating summaries of their songs, see
+        subtract_rating_summary() function. Last added batch key of the songs is removed, so the restored
+        ratings can be archived again.
+
+        :param summaries: dictionary of summary with song object id as key, see get_rating_summary() function
+        :return:
+        """
+
+    @abc.abstractmethod
+    def delete_rating_summary(self, song_id=None):
+        """
+        Delete rating summary of a song.
+
+        :param song_id: object id of song
+        :return:
+        """
+
+    @abc.abstractmethod
+    def insert_job(self, data=None):
+        """
+        Insert a background job.
+
+        :param data: dictionary of job data with 'status' key
+        :return: object id of inserted job
+        """
+
+    @abc.abstractmethod
+    def claim_job(self, job_id=None, expired_before=None):
+        """
+        Set status of a job to 'running' and its 'heartbeat_date' to now if the job is queued, or if it is
+        running and its heartbeat date is older than expired_before (the process running it has stopped).
+
+        :param job_id: object id of job
+        :param expired_before: datetime object of expired heartbeat date
+        :return: claimed job document or None if the job is not found, finished or running in other process
+        """
+
+    @abc.abstractmethod
+    def update_job(self, job_id=None, data=None, increments=None):
+        """
+        Update a job.
+
+        :param job_id: object id of job
+        :param data: dictionary of set values
+        :param increments: dictionary of values added to numeric fields
+        :return:
+        """
+
+    @abc.abstractmethod
+    def find_job(self, job_id=None):
+        """
+        Find a job.
+
+        :param job_id: object id of job
+        :return: job document or None if not found
+        """
+
+    @abc.abstractmethod
+    def find_jobs(self, statuses=None, limit=0):
+        """
+        Find jobs, newest first.
+
+        :param statuses: list of job status for filtering, all jobs if None
+        :param limit: maximum number of jobs, 0 means no limit
+        :return: list: list of job documents
+        """
+
+
+class MongoStorage(BaseStorage):
+    """
+    Class object of storage in Mongo database
+
+    """
+
+    def __init__(self, mongo=None):
+        """
+        Initiate storage
+
+        :param mongo: PyMongo object
+        """
+        self._mongo = mongo
+
+    @staticmethod
+    def get_song_filter(query=None):
+        """
+        Get Mongo query filter of song query.
+
+        :param query: dictionary of song query
+        :return: filter_dict: dictionary of Mongo query filter
+        """
+        query = query or {}
+        query_filter = {}
+        if query.get('level') is not None:
+            query_filter['level'] = query['level']
+        if query.get('key_search') is not None:
+            query_filter['$or'] = [
+                {'artist': {'$regex': query['key_search'], '$options': 'i'}},
+                {'title': {'$regex': query['key_search'], '$options': 'i'}}]
+        return query_filter
+
+    def list_collection_names(self):
+        return self._mongo.db.list_collection_names()
+
+    def drop_database(self):
+        self._mongo.db.command("dropDatabase")
+
+    def create_song_indexes(self, natural_key=None):
+        self._mongo.db.deleted_songs.create_index([('deletion_date', 1)], name='deletion_date',
+                                                  expireAfterSeconds=DELETED_SONGS_TTL)
+        try:
+            self._mongo.db.songs.create_index([(key, 1) for key in natural_key], unique=True, name='natural_key')
+        except OperationFailure as e:
+            app.logger.warning('Cannot create unique index on songs %s: %s', natural_key, e)
+            return False
+        return True
+
+    def insert_song(self, data=None):
+        return self._mongo.db.songs.insert_one(dict(data)).inserted_id
+
+    def upsert_song(self, key_filter=None, data=None):
+        for attempt in range(UPSERT_RETRIES + 1):
+            try:
+                song_id = bson.ObjectId()
+                document = self._mongo.db.songs.find_one_and_update(
+                    key_filter,
+                    {'$set': data, '$setOnInsert': {'_id': song_id}},
+                    projection={field: 1 for field in data},
+                    upsert=True,
+                    return_document=ReturnDocument.BEFORE
+                )
+                if document is None:
+                    return song_id
+                if any(document.get(field) != value for field, value in data.items()):
+                    self.increase_songs_version()
+                return document['_id']
+            except DuplicateKeyError:
+                # Song was inserted by a concurrent upsert, the next attempt updates it
+                if attempt == UPSERT_RETRIES:
+                    raise
+
+    def upsert_songs(self, operations=None):
+        result = {'inserted': 0, 'modified': 0, 'matched': 0, 'upserted_ids': {}}
+        indexes = list(range(len(operations)))
+        for attempt in range(UPSERT_RETRIES + 1):
+            requests = [UpdateOne(operations[index][0], {'$set': operations[index][1]}, upsert=True)
+                        for index in indexes]
+            try:
+                bulk_api_result = self._mongo.db.songs.bulk_write(requests, ordered=False).bulk_api_result
+                retry_indexes = []
+            except BulkWriteError as e:
+                # Operations which lost a race of inserting the same song are run again, other errors are raised
+                bulk_api_result = e.details
+                write_errors = bulk_api_result['writeErrors']
+                if attempt == UPSERT_RETRIES or any(error['code'] != 11000 for error in write_errors):
+                    raise
+                retry_indexes = [indexes[error['index']] for error in write_errors]
+
+            result['inserted'] += bulk_api_result['nUpserted']
+            result['modified'] += bulk_api_result['nModified']
+            result['matched'] += bulk_api_result['nMatched']
+            for upserted in bulk_api_result['upserted']:
+                result['upserted_ids'][indexes[upserted['index']]] = upserted['_id']
+            indexes = retry_indexes
+            if not indexes:
+                break
+
+        if result['modified']:
+            self.increase_songs_version()
+        return result
+
+    def find_songs(self, query=None, skip=0, limit=0, fields=None):
+        projection = None
+        if fields is not None:
+            projection = {field: 1 for field in fields}
+        return self._mongo.db.songs.find(self.get_song_filter(query), projection).skip(skip).limit(limit)
+
+    def count_songs(self, query=None):
+        query_filter = self.get_song_filter(query)
+        if not query_filter:
+            return self._mongo.db.songs.estimated_document_count()
+        return self._mongo.db.songs.count_documents(query_filter)
+
+    def get_song_average(self, field=None):
+        cursor = self._mongo.db.songs.aggregate([
+            {
+                '$group': {
+                    '_id': None,
+                    "avg_value": {'$avg': '${}'.format(field)}
+                }
+            }
+        ])
+
+        avg_value = None
+        for document in cursor:
+            avg_value = document["avg_value"]
+        return avg_value
+
+    def has_song(self, song_id=None):
+        return self._mongo.db.songs.find_one({'_id': song_id}, {'_id': 1}) is not None
+
+    def delete_song(self, song_id=None):
+        # db_response contains DeleteResult object
+        db_response = self._mongo.db.songs.delete_one({'_id': song_id})
+        app.logger.debug('DELETE - db_response count: %s', db_response.deleted_count)
+        if db_response.deleted_count:
+            self._mongo.db.deleted_songs.replace_one(
+                {'_id': song_id}, {'deletion_date': datetime.datetime.utcnow()}, upsert=True)
+            self.increase_songs_version()
+        return db_response.deleted_count == 1
+
+    def find_deleted_song_ids(self, since=None):
+        cursor = self._mongo.db.deleted_songs.find({'deletion_date': {'$gte': since}}, {'_id': 1})
+        return [document['_id'] for document in cursor]
+
+    def increase_songs_version(self):
+        self._mongo.db.counters.update_one({'_id': 'songs'}, {'$inc': {'version': 1}}, upsert=True)
+
+    def get_songs_version(self):
+        document = self._mongo.db.counters.find_one({'_id': 'songs'})
+        return document['version'] if document is not None else 0
+
+    def insert_rating(self, data=None):
+        return self._mongo.db.ratings.insert_one(dict(data)).inserted_id
+
+    def find_ratings(self):
+        return self._mongo.db.ratings.find()
+
+    def create_rating_indexes(self):
+        self._mongo.db.ratings.create_index([('song_id', 1)], name='song_id')
+        self._mongo.db.ratings.create_index([('creation_date', 1), ('_id', 1)], name='creation_date')
+
+    def find_old_ratings(self, before=None, limit=None):
+        cursor = self._mongo.db.ratings.find({'creation_date': {'$lt': before}})
+        cursor = cursor.sort([('creation_date', 1), ('_id', 1)]).limit(limit or 0)
+        return list(cursor)
+
+    def find_song_rating_ids(self, song_id=None, limit=None):
+        cursor = self._mongo.db.ratings.find({'song_id': song_id}, {'_id': 1}).limit(limit or 0)
+        return [document['_id'] for document in cursor]
+
+    def delete_ratings(self, rating_ids=None, song_ids=None):
+        return self._mongo.db.ratings.delete_many({'_id': {'$in': list(rating_ids)}}).deleted_count
+
+    def iter_batches(self, collection=None, fields=None, start=None, end=None, batch_size=1000):
+        field, start, end = get_creation_range(collection, start, end)
+        query_filter = {}
+        if start is not None or end is not None:
+            query_filter[field] = {}
+            if start is not None:
+                query_filter[field]['$gte'] = start
+            if end is not None:
+                query_filter[field]['$lt'] = end
+
+        projection = None
+        if fields is not None:
+            projection = {one_field: 1 for one_field in fields}
+
+        cursor = self._mongo.db[collection].find(query_filter, projection).batch_size(batch_size)
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def find_rating(self, rating_id=None, song_id=None):
+        return self._mongo.db.ratings.find_one({"_id": rating_id})
+
+    def update_rating(self, rating_id=None, rating=None, song_id=None):
+        updated = self._mongo.db.ratings.update_one(
+            {'_id': rating_id},
+            {
+                '$set': {'rating': rating},
+                '$currentDate': {'lastModified': True}
+            }
+        )
+        return updated.modified_count
+
+    def count_ratings_by_song(self, start=None, end=None):
+        pipeline = [{'$group': {'_id': '$song_id', 'total': {'$sum': 1}}}]
+        if start is not None or end is not None:
+            query_filter = {'creation_date': {}}
+            if start is not None:
+                query_filter['creation_date']['$gte'] = start
+            if end is not None:
+                query_filter['creation_date']['$lt'] = end
+            pipeline.insert(0, {'$match': query_filter})
+
+        output = {document['_id']: document['total'] for document in self._mongo.db.ratings.aggregate(pipeline)}
+        if start is not None:
+            return output
+        for document in self._mongo.db.rating_summaries.find({}, {'count': 1}):
+            output[document['_id']] = output.get(document['_id'], 0) + document['count']
+        return output
+
+    def get_rating_stats(self, song_ids=None):
+        song_ids = list(song_ids)
+        cursor = self._mongo.db.ratings.aggregate([
+            {'$match': {"song_id": {'$in': song_ids}}},
+            {
+                '$group': {
+                    '_id': '$song_id',
+                    "count": {'$sum': 1},
+                    "sum": {'$sum': '$rating'},
+                    "min": {'$min': '$rating'},
+                    "max": {'$max': '$rating'}
+                }
+            }
+        ])
+        summaries = {}
+        for document in cursor:
+            summaries[document.pop('_id')] = [document]
+        for document in self._mongo.db.rating_summaries.find({'_id': {'$in': song_ids}}):
+            summaries.setdefault(document.pop('_id'), []).append(document)
+
+        output = {}
+        for song_id, song_summaries in summaries.items():
+            summary = merge_rating_summaries(song_summaries)
+            if summary is not None:
+                output[song_id] = get_summary_stat(summary)
+        return output
+
+    def add_rating_summaries(self, summaries=None, batch_key=None):
+        requests = []
+        for song_id, summary in summaries.items():
+            requests.append(UpdateOne(
+                {'_id': song_id, 'archived_until': {'$not': {'$gte': batch_key}}},
+                {
+                    '$inc': dict({'count': summary['count'], 'sum': summary['sum']},
+                                 **{'values.{}'.format(value): count
+                                    for value, count in (summary.get('values') or {}).items()}),
+                    '$min': {'min': summary['min']},
+                    '$max': {'max': summary['max']},
+                    '$set': {'archived_until': batch_key}
+                },
+                upsert=True
+            ))
+        if not requests:
+            return
+        try:
+            self._mongo.db.rating_summaries.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            # Summary of a song which already contains the batch is not matched and its upsert fails on _id
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+
+    def subtract_rating_summaries(self, summaries=None):
+        requests = []
+        for document in self._mongo.db.rating_summaries.find({'_id': {'$in': list(summaries)}}):
+            song_id = document.pop('_id')
+            summary = subtract_rating_summary(document, summaries[song_id])
+            if summary is None:
+                requests.append(DeleteOne({'_id': song_id}))
+            else:
+                requests.append(ReplaceOne({'_id': song_id}, summary))
+        if requests:
+            self._mongo.db.rating_summaries.bulk_write(requests, ordered=False)
+
+    def delete_rating_summary(self, song_id=None):
+        self._mongo.db.rating_summaries.delete_one({'_id': song_id})
+
+    def insert_job(self, data=None):
+        return self._mongo.db.jobs.insert_one(dict(data)).inserted_id
+
+    def claim_job(self, job_id=None, expired_before=None):
+        return self._mongo.db.jobs.find_one_and_update(
+            {
+                '_id': job_id,
+                '$or': [{'status': 'queued'}, {'status': 'running', 'heartbeat_date': {'$lt': expired_before}}]
+            },
+            {'$set': {'status': 'running', 'heartbeat_date': datetime.datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def update_job(self, job_id=None, data=None, increments=None):
+        update = {}
+        if data:
+            update['$set'] = data
+        if increments:
+            update['$inc'] = increments
+        if update:
+            self._mongo.db.jobs.update_one({'_id': job_id}, update)
+
+    def find_job(self, job_id=None):
+        return self._mongo.db.jobs.find_one({'_id': job_id})
+
+    def find_jobs(self, statuses=None, limit=0):
+        query_filter = {}
+        if statuses is not None:
+            query_filter['status'] = {'$in': list(statuses)}
+        return list(self._mongo.db.jobs.find(query_filter).sort([('_id', -1)]).limit(limit))
+
+
+class MemoryStorage(BaseStorage):
+    """
+    Class object of storage in process memory for tests and benchmarks.
+
+    Songs are indexed by level and natural key, ratings are indexed by song id.
+    Data is lost when the process exits.
+    """
+
+    def __init__(self):
+        """
+        Initiate empty storage
+        """
+        self._lock = threading.RLock()
+        self.drop_database()
+
+    def list_collection_names(self):
+        with self._lock:
+            return list(self._collections)
+
+    def drop_database(self):
+        with self._lock:
+            self._collections = set()
+            self._songs = {}
+            self._songs_by_level = {}
+            self._natural_key = None
+            self._songs_by_key = {}
+            self._ratings = {}
+            self._ratings_by_song = {}
+            self._rating_summaries = {}
+            self._jobs = {}
+            self._songs_version = 0
+            self._deleted_songs = {}
+
+    def get_key(self, data=None):
+        return tuple(repr(data.get(field)) for field in self._natural_key)
+
+    def create_song_indexes(self, natural_key=None):
+        with self._lock:
+            songs_by_key = {}
+            for song_id, document in self._songs.items():
+                key = tuple(repr(document.get(field)) for field in natural_key)
+                if key in songs_by_key:
+                    app.logger.warning('Cannot create unique index on songs %s: duplicated %s', natural_key, key)
+                    return False
+                songs_by_key[key] = song_id
+
+            self._collections.add('songs')
+            self._natural_key = tuple(natural_key)
+            self._songs_by_key = songs_by_key
+        return True
+
+    def add_song(self, document=None):
+        song_id = document['_id']
+        self._collections.add('songs')
+        self._songs[song_id] = document
+        self._songs_by_level.setdefault(document.get('level'), {})[song_id] = True
+        if self._natural_key is not None:
+            self._songs_by_key[self.get_key(document)] = song_id
+
+    def remove_song(self, song_id=None):
+        document = self._songs.pop(song_id, None)
+        if document is None:
+            return None
+        self._songs_by_level.get(document.get('level'), {}).pop(song_id, None)
+        if self._natural_key is not None:
+            self._songs_by_key.pop(self.get_key(document), None)
+        return document
+
+    def insert_song(self, data=None):
+        document = dict(data)
+        document.setdefault('_id', bson.ObjectId())
+        with self._lock:
+            if self._natural_key is not None and self.get_key(document) in self._songs_by_key:
+                raise DuplicateKeyError('Duplicated natural key of song: {}'.format(self.get_key(document)))
+            if document['_id'] in self._songs:
+                raise DuplicateKeyError('Duplicated song id: {}'.format(document['_id']))
+            self.add_song(document)
+        return document['_id']
+
+    def upsert_song(self, key_filter=None, data=None):
+        return self.upsert_one(key_filter, data)[0]
+
+    def upsert_one(self, key_filter=None, data=None):
+        """
+        Update song matching natural key filter or insert it if not found.
+
+        :param key_filter: dictionary of natural key fields and values
+        :param data: dictionary of song data
+        :return: tuple of song object id and one of 'inserted', 'modified' or 'matched' string
+        """
+        with self._lock:
+            song_id = None
+            if self._natural_key is not None and set(key_filter) == set(self._natural_key):
+                song_id = self._songs_by_key.get(self.get_key(key_filter))
+            else:
+                for one_id, document in self._songs.items():
+                    if all(document.get(field) == value for field, value in key_filter.items()):
+                        song_id = one_id
+                        break
+
+            if song_id is None:
+                document = dict(key_filter)
+                document.update(data)
+                document['_id'] = bson.ObjectId()
+                self.add_song(document)
+                return document['_id'], 'inserted'
+
+            document = dict(self.remove_song(song_id))
+            is_modified = any(document.get(field) != value for field, value in data.items())
+            document.update(data)
+            self.add_song(document)
+            if is_modified:
+                self._songs_version += 1
+            return song_id, 'modified' if is_modified else 'matched'
+
+    def upsert_songs(self, operations=None):
+        result = {'inserted': 0, 'modified': 0, 'matched': 0, 'upserted_ids': {}}
+        for index, (key_filter, data) in enumerate(operations):
+            song_id, status = self.upsert_one(key_filter, data)
+            if status == 'inserted':
+                result['inserted'] += 1
+                result['upserted_ids'][index] = song_id
+            else:
+                result['matched'] += 1
+                if status == 'modified':
+                    result['modified'] += 1
+        return result
+
+    def match_song(self, document=None, pattern=None):
+        for field in ('artist', 'title'):
+            value = document.get(field)
+            if isinstance(value, str) and pattern.search(value):
+                return True
+        return False
+
+    def find_songs(self, query=None, skip=0, limit=0, fields=None):
+        query = query or {}
+        with self._lock:
+            if query.get('level') is not None:
+                documents = [self._songs[s_id] for s_id in self._songs_by_level.get(query['level'], {})]
+            else:
+                documents = list(self._songs.values())
+
+        if query.get('key_search') is not None:
+            pattern = re.compile(query['key_search'], re.IGNORECASE)
+            documents = [document for document in documents if self.match_song(document, pattern)]
+
+        documents = itertools.islice(documents, skip, skip + limit if limit else None)
+        if fields is None:
+            return [dict(document) for document in documents]
+
+        output = []
+        for document in documents:
+            item_dict = {'_id': document['_id']}
+            for field in fields:
+                if field in document:
+                    item_dict[field] = document[field]
+            output.append(item_dict)
+        return output
+
+    def count_songs(self, query=None):
+        query = query or {}
+        if query.get('key_search') is None:
+            with self._lock:
+                if query.get('level') is not None:
+                    return len(self._songs_by_level.get(query['level'], {}))
+                return len(self._songs)
+        return len(self.find_songs(query=query, fields=()))
+
+    def get_song_average(self, field=None):
+        with self._lock:
+            values = [document[field] for document in self._songs.values()
+                      if isinstance(document.get(field), (int, float))]
+        if not values:
+            return None
+        return sum(values) / len(values)
+
+    def has_song(self, song_id=None):
+        with self._lock:
+            return song_id in self._songs
+
+    def delete_song(self, song_id=None):
+        with self._lock:
+            if self.remove_song(song_id) is None:
+                return False
+            self._deleted_songs[song_id] = datetime.datetime.utcnow()
+            self._songs_version += 1
+            return True
+
+    def find_deleted_song_ids(self, since=None):
+        expired_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=DELETED_SONGS_TTL)
+        with self._lock:
+            self._deleted_songs = {song_id: deletion_date for song_id, deletion_date in self._deleted_songs.items()
+                                   if deletion_date >= expired_before}
+            return [song_id for song_id, deletion_date in self._deleted_songs.items() if deletion_date >= since]
+
+    def get_songs_version(self):
+        with self._lock:
+            return self._songs_version
+
+    def insert_rating(self, data=None):
+        document = dict(data)
+        document.setdefault('_id', bson.ObjectId())
+        with self._lock:
+            if document['_id'] in self._ratings:
+                raise DuplicateKeyError('Duplicated rating id: {}'.format(document['_id']))
+            self._collections.add('ratings')
+            self._ratings[document['_id']] = document
+            self._ratings_by_song.setdefault(document.get('song_id'), {})[document['_id']] = True
+        return document['_id']
+
+    def find_ratings(self):
+        with self._lock:
+            return [dict(document) for document in self._ratings.values()]
+
+    def create_rating_indexes(self):
+        # Ratings are always indexed by song id in memory
+        with self._lock:
+            self._collections.add('ratings')
+
+    def find_old_ratings(self, before=None, limit=None):
+        with self._lock:
+            documents = [dict(document) for document in self._ratings.values()
+                         if document.get('creation_date') is not None and document['creation_date'] < before]
+        documents.sort(key=lambda document: (document['creation_date'], document['_id']))
+        return documents[:limit] if limit else documents
+
+    def find_song_rating_ids(self, song_id=None, limit=None):
+        with self._lock:
+            return list(itertools.islice(self._ratings_by_song.get(song_id, {}), limit or None))
+
+    def delete_ratings(self, rating_ids=None, song_ids=None):
+        deleted_count = 0
+        with self._lock:
+            for rating_id in rating_ids:
+                document = self._ratings.pop(rating_id, None)
+                if document is None:
+                    continue
+                self._ratings_by_song.get(document.get('song_id'), {}).pop(rating_id, None)
+                deleted_count += 1
+        return deleted_count
+
+    def iter_batches(self, collection=None, fields=None, start=None, end=None, batch_size=1000):
+        field, start, end = get_creation_range(collection, start, end)
+        with self._lock:
+            documents = list((self._songs if collection == 'songs' else self._ratings).values())
+
+        batch = []
+        for document in documents:
+            value = document.get(field)
+            if start is not None and (value is None or value < start):
+                continue
+            if end is not None and (value is None or value >= end):
+                continue
+
+            if fields is None:
+                batch.append(dict(document))
+            else:
+                item_dict = {'_id': document['_id']}
+                for one_field in fields:
+                    if one_field in document:
+                        item_dict[one_field] = document[one_field]
+                batch.append(item_dict)
+
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def find_rating(self, rating_id=None, song_id=None):
+        with self._lock:
+            document = self._ratings.get(rating_id)
+            return dict(document) if document is not None else None
+
+    def update_rating(self, rating_id=None, rating=None, song_id=None):
+        with self._lock:
+            document = self._ratings.get(rating_id)
+            if document is None:
+                return 0
+            document['rating'] = rating
+            document['lastModified'] = datetime.datetime.utcnow()
+            return 1
+
+    def count_ratings_by_song(self, start=None, end=None):
+        with self._lock:
+            if start is None and end is None:
+                output = {song_id: len(rating_ids) for song_id, rating_ids in self._ratings_by_song.items()
+                          if rating_ids}
+            else:
+                output = {}
+                for document in self._ratings.values():
+                    value = document.get('creation_date')
+                    if value is None or (start is not None and value < start) or (end is not None and value >= end):
+                        continue
+                    output[document.get('song_id')] = output.get(document.get('song_id'), 0) + 1
+            if start is not None:
+                return output
+            for song_id, summary in self._rating_summaries.items():
+                output[song_id] = output.get(song_id, 0) + summary['count']
+            return output
+
+    def get_rating_stats(self, song_ids=None):
+        output = {}
+        with self._lock:
+            for song_id in song_ids:
+                values = [self._ratings[r_id]['rating'] for r_id in self._ratings_by_song.get(song_id, {})]
+                summary = merge_rating_summaries([get_rating_summary(values) if values else None,
+                                                  self._rating_summaries.get(song_id)])
+                if summary is not None:
+                    output[song_id] = get_summary_stat(summary)
+        return output
+
+    def add_rating_summaries(self, summaries=None, batch_key=None):
+        with self._lock:
+            for song_id, summary in summaries.items():
+                current = self._rating_summaries.get(song_id)
+                if current is not None and current.get('archived_until') is not None \
+                        and current['archived_until'] >= batch_key:
+                    continue
+                summary = merge_rating_summaries([current, summary])
+                summary['archived_until'] = batch_key
+                self._rating_summaries[song_id] = summary
+
+    def subtract_rating_summaries(self, summaries=None):
+        with self._lock:
+            for song_id, restored in summaries.items():
+                current = self._rating_summaries.get(song_id)
+                if current is None:
+                    continue
+                summary = subtract_rating_summary(current, restored)
+                if summary is None:
+                    del self._rating_summaries[song_id]
+                else:
+                    self._rating_summaries[song_id] = summary
+
+    def delete_rating_summary(self, song_id=None):
+        with self._lock:
+            self._rating_summaries.pop(song_id, None)
+
+    def insert_job(self, data=None):
+        document = dict(data)
+        document.setdefault('_id', bson.ObjectId())
+        with self._lock:
+            self._collections.add('jobs')
+            self._jobs[document['_id']] = document
+        return document['_id']
+
+    def claim_job(self, job_id=None, expired_before=None):
+        with self._lock:
+            document = self._jobs.get(job_id)
+            if document is None:
+                return None
+            is_expired = document['status'] == 'running' and document.get('heartbeat_date') is not None \
+                and document['heartbeat_date'] < expired_before
+            if document['status'] != 'queued' and not is_expired:
+                return None
+            document['status'] = 'running'
+            document['heartbeat_date'] = datetime.datetime.utcnow()
+            return dict(document)
+
+    def update_job(self, job_id=None, data=None, increments=None):
+        with self._lock:
+            document = self._jobs.get(job_id)
+            if document is None:
+                return
+            document.update(data or {})
+            for field, value in (increments or {}).items():
+                document[field] = document.get(field, 0) + value
+
+    def find_job(self, job_id=None):
+        with self._lock:
+            document = self._jobs.get(job_id)
+            return dict(document) if document is not None else None
+
+    def find_jobs(self, statuses=None, limit=0):
+        with self._lock:
+            documents = [dict(document) for document in self._jobs.values()
+                         if statuses is None or document['status'] in statuses]
+        documents.sort(key=lambda document: document['_id'], reverse=True)
+        return documents[:limit] if limit else documents
+
+
+def get_shard_index(song_id=None, shard_count=None):
+    """
+    Get shard of a song. The hash of object id bytes is the same in every process.
+
+    :param song_id: song object id or its string
+    :param shard_count: number of shards
+    :return: index: shard index from 0 to shard_count - 1
+    """
+    digest = hashlib.sha1(bson.ObjectId(str(song_id)).binary).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+
+class ShardedStorage(BaseStorage):
+    """
+    Class object of storage routing ratings to shards by hash of song id.
+
+    Songs are kept in one storage. Ratings of a song are always in the same shard, so statistic data
+    of a song is read from one shard, while queries over all ratings run on every shard in parallel
+    and their results are merged. Shards are storage objects, e.g. MongoStorage of separate deployments.
+    """
+
+    def __init__(self, song_storage=None, rating_shards=None):
+        """
+        Initiate storage
+
+        :param song_storage: storage object of songs
+        :param rating_shards: list of storage objects of ratings
+        """
+        self._song_storage = song_storage
+        self._rating_shards = list(rating_shards)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self._rating_shards) * 2,
+                                                               thread_name_prefix='rating-shard')
+
+    def get_shard(self, song_id=None):
+        return self._rating_shards[get_shard_index(song_id, len(self._rating_shards))]
+
+    def map_shards(self, func=None):
+        """
+        Run function with every rating shard in parallel.
+
+        :param func: function taking storage object
+        :return: list: list of results in order of shards
+        """
+        return list(self._executor.map(func, self._rating_shards))
+
+    def iter_parallel(self, iterators=None):
+        """
+        Read items of iterators in parallel, items are yielded in order of arrival.
+
+        :param iterators: list of iterators
+        :return: generator of items
+        """
+        pending = {self._executor.submit(next, iterator, None): iterator for iterator in iterators}
+        while pending:
+            done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                iterator = pending.pop(future)
+                item = future.result()
+                if item is None:
+                    continue
+                yield item
+                pending[self._executor.submit(next, iterator, None)] = iterator
+
+    def list_collection_names(self):
+        names = set(self._song_storage.list_collection_names())
+        for shard_names in self.map_shards(lambda shard: shard.list_collection_names()):
+            names.update(shard_names)
+        return list(names)
+
+    def drop_database(self):
+        self._song_storage.drop_database()
+        self.map_shards(lambda shard: shard.drop_database())
+
+    def create_song_indexes(self, natural_key=None):
+        return self._song_storage.create_song_indexes(natural_key=natural_key)
+
+    def insert_song(self, data=None):
+        return self._song_storage.insert_song(data=data)
+
+    def upsert_song(self, key_filter=None, data=None):
+        return self._song_storage.upsert_song(key_filter=key_filter, data=data)
+
+    def upsert_songs(self, operations=None):
+        return self._song_storage.upsert_songs(operations=operations)
+
+    def find_songs(self, query=None, skip=0, limit=0, fields=None):
+        return self._song_storage.find_songs(query=query, skip=skip, limit=limit, fields=fields)
+
+    def count_songs(self, query=None):
+        return self._song_storage.count_songs(query=query)
+
+    def get_song_average(self, field=None):
+        return self._song_storage.get_song_average(field=field)
+
+    def has_song(self, song_id=None):
+        return self._song_storage.has_song(song_id=song_id)
+
+    def delete_song(self, song_id=None):
+        return self._song_storage.delete_song(song_id=song_id)
+
+    def find_deleted_song_ids(self, since=None):
+        return self._song_storage.find_deleted_song_ids(since=since)
+
+    def get_songs_version(self):
+        return self._song_storage.get_songs_version()
+
+    def insert_rating(self, data=None):
+        return self.get_shard(data['song_id']).insert_rating(data=data)
+
+    def find_ratings(self):
+        return list(itertools.chain.from_iterable(self.map_shards(lambda shard: list(shard.find_ratings()))))
+
+    def create_rating_indexes(self):
+        self.map_shards(lambda shard: shard.create_rating_indexes())
+
+    def find_old_ratings(self, before=None, limit=None):
+        results = self.map_shards(lambda shard: shard.find_old_ratings(before=before, limit=limit))
+        documents = heapq.merge(*results, key=lambda document: (document['creation_date'], document['_id']))
+        return list(itertools.islice(documents, limit or None))
+
+    def find_song_rating_ids(self, song_id=None, limit=None):
+        return self.get_shard(song_id).find_song_rating_ids(song_id=song_id, limit=limit)
+
+    def delete_ratings(self, rating_ids=None, song_ids=None):
+        rating_ids = list(rating_ids)
+        if song_ids is None:
+            return sum(self.map_shards(lambda shard: shard.delete_ratings(rating_ids=rating_ids)))
+
+        shard_rating_ids = {}
+        for rating_id, song_id in zip(rating_ids, song_ids):
+            shard_rating_ids.setdefault(get_shard_index(song_id, len(self._rating_shards)), []).append(rating_id)
+        futures = [self._executor.submit(self._rating_shards[index].delete_ratings, rating_ids=shard_ids)
+                   for index, shard_ids in shard_rating_ids.items()]
+        return sum(future.result() for future in futures)
+
+    def iter_batches(self, collection=None, fields=None, start=None, end=None, batch_size=1000):
+        if collection != 'ratings':
+            return self._song_storage.iter_batches(collection=collection, fields=fields, start=start, end=end,
+                                                   batch_size=batch_size)
+        return self.iter_parallel([shard.iter_batches(collection=collection, fields=fields, start=start, end=end,
+                                                      batch_size=batch_size) for shard in self._rating_shards])
+
+    def find_rating(self, rating_id=None, song_id=None):
+        if song_id is not None:
+            return self.get_shard(song_id).find_rating(rating_id=rating_id)
+        for document in self.map_shards(lambda shard: shard.find_rating(rating_id=rating_id)):
+            if document is not None:
+                return document
+        return None
+
+    def update_rating(self, rating_id=None, rating=None, song_id=None):
+        if song_id is not None:
+            return self.get_shard(song_id).update_rating(rating_id=rating_id, rating=rating)
+        return sum(self.map_shards(lambda shard: shard.update_rating(rating_id=rating_id, rating=rating)))
+
+    def count_ratings_by_song(self, start=None, end=None):
+        output = {}
+        for counts in self.map_shards(lambda shard: shard.count_ratings_by_song(start=start, end=end)):
+            output.update(counts)
+        return output
+
+    def get_shard_items(self, data_dict=None):
+        """
+        Split dictionary with song id keys by shard.
+
+        :param data_dict: dictionary with song object id as key
+        :return: list: list of dictionary of every shard, in order of shards
+        """
+        shard_items = [{} for shard in self._rating_shards]
+        for song_id, value in data_dict.items():
+            shard_items[get_shard_index(song_id, len(self._rating_shards))][song_id] = value
+        return shard_items
+
+    def add_rating_summaries(self, summaries=None, batch_key=None):
+        shard_summaries = self.get_shard_items(summaries)
+        futures = [self._executor.submit(shard.add_rating_summaries, summaries=shard_summaries[index],
+                                         batch_key=batch_key)
+                   for index, shard in enumerate(self._rating_shards) if shard_summaries[index]]
+        for future in futures:
+            future.result()
+
+    def subtract_rating_summaries(self, summaries=None):
+        shard_summaries = self.get_shard_items(summaries)
+        futures = [self._executor.submit(shard.subtract_rating_summaries, summaries=shard_summaries[index])
+                   for index, shard in enumerate(self._rating_shards) if shard_summaries[index]]
+        for future in futures:
+            future.result()
+
+    def delete_rating_summary(self, song_id=None):
+        self.get_shard(song_id).delete_rating_summary(song_id=song_id)
+
+    def insert_job(self, data=None):
+        return self._song_storage.insert_job(data=data)
+
+    def claim_job(self, job_id=None, expired_before=None):
+        return self._song_storage.claim_job(job_id=job_id, expired_before=expired_before)
+
+    def update_job(self, job_id=None, data=None, increments=None):
+        self._song_storage.update_job(job_id=job_id, data=data, increments=increments)
+
+    def find_job(self, job_id=None):
+        return self._song_storage.find_job(job_id=job_id)
+
+    def find_jobs(self, statuses=None, limit=0):
+        return self._song_storage.find_jobs(statuses=statuses, limit=limit)
+
+    def get_rating_stats(self, song_ids=None):
+        shard_song_ids = {}
+        for song_id in song_ids:
+            shard_song_ids.setdefault(get_shard_index(song_id, len(self._rating_shards)), []).append(song_id)
+
+        futures = [self._executor.submit(self._rating_shards[index].get_rating_stats, song_ids=shard_ids)
+                   for index, shard_ids in shard_song_ids.items()]
+        output = {}
+        for future in futures:
+            output.update(future.result())
+        return output
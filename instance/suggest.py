@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+__version__ = '0.1.0'
+__author__ = 'Porntip Chaibamrung'
+
+import bisect
+import heapq
+import re
+import threading
+
+from flask import current_app
+
+app = current_app
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def get_suggest_index():
+    """
+    Get suggestion index object of the current app
+
+    :return: SuggestIndex object or None if the app does not have one
+    """
+    return app.config.get('suggest_index', None)
+
+
+class SuggestIndex(object):
+    """
+    Class object for in-memory prefix lookup over song artist and title.
+
+    Keys are case-folded tokens and full artist/title strings kept in a sorted list,
+    so a prefix lookup is a bisect plus a scan of matching keys and never touches the database.
+    Short prefixes match a large share of the index, so their top_size best ranked songs are kept
+    after the first lookup and updated when songs are added or rated. Cached songs including a
+    removed song are looked up again.
+    """
+
+    def __init__(self, short_prefix_length=2, top_size=50):
+        """
+        Initiate empty index
+
+        :param short_prefix_length: maximum length of prefixes with cached top ranked songs
+        :param top_size: number of cached top ranked songs of a short prefix
+        """
+        self._short_prefix_length = short_prefix_length
+        self._top_size = top_size
+        self._keys = []
+        self._songs = {}
+        self._rating_counts = {}
+        self._top = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_keys(artist=None, title=None):
+        """
+        Get case-folded lookup keys of a song.
+
+        :param artist: string of artist name
+        :param title: string of song title
+        :return: set: set of lookup keys
+        """
+        keys = set()
+        for text in (artist, title):
+            if not text:
+                continue
+            text = str(text).casefold()
+            keys.add(text)
+            keys.update(_TOKEN_PATTERN.findall(text))
+        return keys
+
+    def build(self, songs=None, rating_counts=None, entries=None):
+        """
+        Rebuild index from song documents.
+
+        :param songs: iterable of song documents
+        :param rating_counts: dictionary of number of ratings with song id string as key
+        :param entries: list of tuple of lookup key and song id string of the songs sorted by key and song id,
+                        e.g. read from catalog snapshot. Keys are computed from artist and title if None
+        :return: total: number of indexed songs
+        """
+        song_dict = {}
+        for document in songs or []:
+            song_id = str(document['_id'])
+            artist = document.get('artist')
+            title = document.get('title')
+            keys = self.get_keys(artist=artist, title=title) if entries is None else set()
+            song_dict[song_id] = {'artist': artist, 'title': title, 'keys': keys}
+
+        if entries is None:
+            entries = sorted((key, song_id) for song_id, song in song_dict.items() for key in song['keys'])
+        else:
+            for key, song_id in entries:
+                song_dict[song_id]['keys'].add(key)
+        with self._lock:
+            self._keys = entries
+            self._songs = song_dict
+            self._rating_counts = dict(rating_counts or {})
+            self._top = {}
+
+        app.logger.debug('Suggest index built with %s songs', len(song_dict))
+        return len(song_dict)
+
+    def get_rating_counts(self):
+        """
+        Get number of ratings of indexed songs.
+
+        :return: data_dict: dictionary of number of ratings with song id string as key
+        """
+        with self._lock:
+            return dict(self._rating_counts)
+
+    def add(self, song_id=None, artist=None, title=None):
+        """
+        Add a song to the index.
+
+        :param song_id: string of song object id
+        :param artist: string of artist name
+        :param title: string of song title
+        :return:
+        """
+        song_id = str(song_id)
+        keys = self.get_keys(artist=artist, title=title)
+        with self._lock:
+            # Updated song keeps its number of ratings
+            self.remove_keys(song_id=song_id)
+            self._songs[song_id] = {'artist': artist, 'title': title, 'keys': keys}
+            for key in keys:
+                bisect.insort(self._keys, (key, song_id))
+            self.update_top(song_id=song_id)
+
+    def remove(self, song_id=None):
+        """
+        Remove a song from the index.
+
+        :param song_id: string of song object id
+        :return: status: True if the song was found in the index
+        """
+        song_id = str(song_id)
+        with self._lock:
+            self._rating_counts.pop(song_id, None)
+            return self.remove_keys(song_id=song_id)
+
+    def remove_keys(self, song_id=None):
+        """
+        Remove lookup keys of a song and cached top songs which include it. The lock must be held by the caller.
+
+        :param song_id: string of song object id
+        :return: status: True if the song was found in the index
+        """
+        song = self._songs.pop(song_id, None)
+        if song is None:
+            return False
+
+        for prefix in self.get_short_prefixes(song['keys']):
+            if song_id in self._top.get(prefix, ()):
+                del self._top[prefix]
+        for key in song['keys']:
+            position = bisect.bisect_left(self._keys, (key, song_id))
+            if position < len(self._keys) and self._keys[position] == (key, song_id):
+                del self._keys[position]
+        return True
+
+    def add_rating(self, song_id=None):
+        """
+        Increase number of ratings used for ranking suggestions.
+
+        :param song_id: string of song object id
+        :return:
+        """
+        song_id = str(song_id)
+        with self._lock:
+            self._rating_counts[song_id] = self._rating_counts.get(song_id, 0) + 1
+            if song_id in self._songs:
+                self.update_top(song_id=song_id)
+
+    def get_short_prefixes(self, keys=None):
+        return set(key[:length] for key in keys for length in range(1, min(len(key), self._short_prefix_length) + 1))
+
+    def get_rank(self, song_id=None):
+        return -self._rating_counts.get(song_id, 0), self._songs[song_id]['title'] or '', song_id
+
+    def update_top(self, song_id=None):
+        """
+        Update cached top songs of short prefixes of an added or rated song. The lock must be held by the caller.
+
+        :param song_id: string of song object id
+        :return:
+        """
+        rank = self.get_rank(song_id)
+        for prefix in self.get_short_prefixes(self._songs[song_id]['keys']):
+            top = self._top.get(prefix)
+            if top is None:
+                continue
+            # A list shorter than top_size has all songs of the prefix
+            if song_id in top or len(top) < self._top_size or rank < self.get_rank(top[-1]):
+                if song_id not in top:
+                    top.append(song_id)
+                top.sort(key=self.get_rank)
+                del top[self._top_size:]
+
+    def find_ranked(self, prefix=None, limit=10):
+        """
+        Scan songs matching a prefix and get the best ranked ones. The lock must be held by the caller.
+
+        :param prefix: case-folded string of prefix
+        :param limit: maximum number of returned songs
+        :return: list: list of song id string ranked by number of ratings
+        """
+        found = set()
+        position = bisect.bisect_left(self._keys, (prefix,))
+        while position < len(self._keys):
+            key, song_id = self._keys[position]
+            if not key.startswith(prefix):
+                break
+            found.add(song_id)
+            position += 1
+        return heapq.nsmallest(limit, found, key=self.get_rank)
+
+    def suggest(self, prefix=None, limit=10):
+        """
+        Get songs whose artist or title starts with given prefix.
+
+        :param prefix: string of prefix for searching
+        :param limit: maximum number of returned songs
+        :return: list: list of dictionary data of a song ranked by number of ratings
+        """
+        if prefix is None:
+            return []
+
+        prefix = prefix.strip().casefold()
+        if prefix == '':
+            return []
+
+        with self._lock:
+            if len(prefix) <= self._short_prefix_length and limit <= self._top_size:
+                top = self._top.get(prefix)
+                if top is None:
+                    top = self._top[prefix] = self.find_ranked(prefix=prefix, limit=self._top_size)
+                ranked = top[:limit]
+            else:
+                ranked = self.find_ranked(prefix=prefix, limit=limit)
+
+            counts = self._rating_counts
+            output = []
+            for song_id in ranked:
+                song = self._songs[song_id]
+                output.append({
+                    '_id': song_id,
+                    'artist': song['artist'],
+                    'title': song['title'],
+                    'total_rating': counts.get(song_id, 0)
+                })
+
+        return output
@@ -0,0 +1,112 @@
+import threading
+import time
+import unittest
+
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from api import create_app
+from instance.admission import AdmissionController, get_admission_controller
+
+
+class TestAdmissionController(unittest.TestCase):
+    def test_rate_limit(self):
+        """
+        Test request over the rate limit is shed with 429 and Retry-After header
+        """
+        controller = AdmissionController(limits={'rate_songs': {'rate': 0.5, 'burst': 2}})
+        for index in range(2):
+            controller.release(controller.admit('rate_songs'))
+
+        with self.assertRaises(TooManyRequests) as context:
+            controller.admit('rate_songs')
+        self.assertEqual(context.exception.code, 429)
+        self.assertEqual(context.exception.get_response().headers['Retry-After'], '2')
+        self.assertEqual(controller.get_stats()['endpoints']['rate_songs']['shed_rate_limit'], 1)
+
+    def test_max_wait(self):
+        """
+        Test request waiting for a slot longer than max_wait is shed with 503
+        """
+        controller = AdmissionController(limits={'songs': {'max_in_flight': 1, 'max_wait': 0.05}})
+        endpoint = controller.admit('songs')
+
+        started = time.monotonic()
+        with self.assertRaises(ServiceUnavailable) as context:
+            controller.admit('songs')
+        self.assertTrue(time.monotonic() - started >= 0.05)
+        self.assertEqual(context.exception.code, 503)
+        self.assertEqual(context.exception.get_response().headers['Retry-After'], '1')
+
+        controller.release(endpoint)
+        controller.release(controller.admit('songs'))
+        stat = controller.get_stats()['endpoints']['songs']
+        self.assertEqual((stat['admitted'], stat['shed_overload'], stat['in_flight']), (2, 1, 0))
+
+    def test_wait_for_released_slot(self):
+        controller = AdmissionController(limits={'songs': {'max_in_flight': 1, 'max_wait': 1}})
+        endpoint = controller.admit('songs')
+        threading.Timer(0.05, controller.release, args=(endpoint,)).start()
+
+        controller.release(controller.admit('songs'))
+        self.assertEqual(controller.get_stats()['endpoints']['songs']['admitted'], 2)
+
+    def test_low_priority_shed_first(self):
+        """
+        Test low priority end point is shed while high priority one is still admitted
+        """
+        controller = AdmissionController(limits={'songs_add': {'priority': 'low', 'max_wait': 0.01}},
+                                         max_in_flight=4, low_priority_share=0.5, default_max_wait=0.01)
+        admitted = [controller.admit('songs_add'), controller.admit('songs_add')]
+
+        with self.assertRaises(ServiceUnavailable):
+            controller.admit('songs_add')
+        admitted.append(controller.admit('songs'))
+        admitted.append(controller.admit('songs'))
+        with self.assertRaises(ServiceUnavailable):
+            controller.admit('songs')
+
+        stats = controller.get_stats()
+        self.assertEqual(stats['in_flight'], 4)
+        self.assertEqual(stats['endpoints']['songs_add']['priority'], 'low')
+        self.assertEqual(stats['endpoints']['songs']['priority'], 'high')
+        for endpoint in admitted:
+            controller.release(endpoint)
+        self.assertEqual(controller.get_stats()['in_flight'], 0)
+
+
+class TestAdmissionApi(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_name="testing")
+        cls.client = cls.app.test_client()
+
+    def test_rate_limited_response(self):
+        app_controller = self.app.config['admission_controller']
+        self.app.config['admission_controller'] = AdmissionController(limits={'songs': {'rate': 0.1, 'burst': 1}})
+        try:
+            self.assertEqual(self.client.get('/songs?limit=1&page=1').status_code, 200)
+            response = self.client.get('/songs?limit=1&page=1')
+        finally:
+            self.app.config['admission_controller'] = app_controller
+        # print("Response test_rate_limited_response: ", response.get_json())
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '10')
+        self.assertEqual(response.get_json()['error_message'], 'Too many requests')
+
+    def test_streamed_response_holds_slot(self):
+        """
+        Test slot of streamed export is released when the response is closed, not when the handler returns
+        """
+        with self.app.app_context():
+            controller = get_admission_controller()
+        response = self.client.get('/export/songs?format=csv', buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(controller.get_stats()['endpoints']['export_data']['in_flight'], 1)
+
+        self.assertTrue(len(response.get_data()) > 0)
+        response.close()
+        self.assertEqual(controller.get_stats()['endpoints']['export_data']['in_flight'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -1,10 +1,19 @@
 import unittest
+import gzip
 import json
 import os
 
+import bson
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from api import create_app
 from instance.song import Song, create_from_file
 from instance.rating import create_from_file as create_ratings_from_file
+from instance.storage import get_storage
 
 
 class TestSongApi(unittest.TestCase):
@@ -47,7 +56,7 @@ class TestSongApi(unittest.TestCase):
     def test_add_song(self):
         params_dict = {
             "artist": "Vanu Muru",
-            "title": "Wishing In The Night",
+            "title": "Wishing In The Night (Live)",
             "difficulty": 10.98,
             "level": 9,
             "released": "2016-01-01"
@@ -64,6 +73,29 @@ class TestSongApi(unittest.TestCase):
             created_ok = True
         self.assertTrue(created_ok)
 
+    def test_add_song_twice(self):
+        params_dict = {
+            "artist": "Vanu Muru",
+            "title": "A New Kennel (Acoustic)",
+            "difficulty": 9.1,
+            "level": 9,
+            "released": "2010-02-03"
+        }
+        first_response = self.client.post('/songs/add',
+                                          data=json.dumps(params_dict),
+                                          content_type='application/json')
+        second_response = self.client.post('/songs/add',
+                                           data=json.dumps(dict(params_dict, level=10)),
+                                           content_type='application/json')
+        # print("Response test_add_song_twice: ", first_response.get_json(), second_response.get_json())
+        self.assertEqual(first_response.status_code, 200)
+        self.assertEqual(second_response.status_code, 409)
+        self.assertEqual(second_response.get_json()['error_message'], "Song already exists")
+
+        with self.app.app_context():
+            songs = Song().search_by(key_search=r'A New Kennel \(Acoustic\)')
+        self.assertEqual([song['level'] for song in songs], [9])
+
     def test_list_all_songs(self):
         response = self.client.get('/songs')
         # print("Response test_list_all_songs", response.data)
@@ -72,6 +104,13 @@ class TestSongApi(unittest.TestCase):
         total = json_data['total']
         self.assertTrue(total > 0)
 
+    def test_list_all_songs_compressed(self):
+        response = self.client.get('/songs', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        json_data = json.loads(gzip.decompress(response.data))
+        self.assertTrue(json_data['total'] > 0)
+
     def test_list_songs_pagination(self):
         response = self.client.get('/songs?limit=1&page=1')
         status_code = response.status_code
@@ -79,6 +118,25 @@ class TestSongApi(unittest.TestCase):
         # print("Response test_list_songs_pagination", response.data)
         self.assertEqual(status_code, 200)
 
+    def test_list_songs_pagination_total(self):
+        response = self.client.get('/songs?limit=1&page=1')
+        json_data = response.get_json()
+        # print("Response test_list_songs_pagination_total: ", json_data)
+        self.assertEqual(len(json_data['result']), 1)
+        self.assertTrue(json_data['total'] > 1)
+
+        response = self.client.get('/songs?limit=1&page=1&level=9&count=false')
+        json_data = response.get_json()
+        self.assertEqual(json_data['result'][0]['level'], 9)
+        self.assertIsNone(json_data['total'])
+
+    def test_list_songs_invalid_level(self):
+        response = self.client.get('/songs?limit=1&page=1&level=9abc')
+        json_data = response.get_json()
+        # print("Response test_list_songs_invalid_level: ", json_data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json_data['error_message'], "Except numeric value for level parameter")
+
     def test_search_by_level_missing_params(self):
         response = self.client.get('/songs/avg/difficulty')
         # print("Response test_search_by_level_missing_params: ", response)
@@ -95,6 +153,10 @@ class TestSongApi(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(json_data['error_message'], "Except numeric value for level parameter")
 
+        response = self.client.get('/songs/avg/difficulty?level=9abc')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()['error_message'], "Except numeric value for level parameter")
+
     def test_search_by_level(self):
         response = self.client.get('/songs/avg/difficulty?level=9')
         json_data = response.get_json()
@@ -116,6 +178,128 @@ class TestSongApi(unittest.TestCase):
         json_data = response.get_json()
         # print("Response test_search_song: ", json_data)
 
+    def test_suggest_song_missing_params(self):
+        response = self.client.get('/songs/suggest')
+        self.assertEqual(response.status_code, 404)
+        json_data = response.get_json(response.data)
+        self.assertEqual(json_data['error_message'], "Missing prefix parameter")
+
+    def test_suggest_song(self):
+        response = self.client.get('/songs/suggest?prefix=VANU&limit=2')
+        json_data = response.get_json()
+        # print("Response test_suggest_song: ", json_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(0 < json_data['total'] <= 2)
+        self.assertEqual(json_data['result'][0]['artist'], "Vanu Muru")
+
+    def test_delete_song(self):
+        params_dict = {
+            "artist": "Vanu Muru",
+            "title": "Deleted Song",
+            "difficulty": 4,
+            "level": 5,
+            "released": "2016-03-01"
+        }
+        res_create = self.client.post('/songs/add',
+                                      data=json.dumps(params_dict),
+                                      content_type='application/json')
+        created_id = res_create.get_json()['created_id']
+        for rating in (2, 4):
+            self.client.post('/songs/rating',
+                             data=json.dumps({"song_id": created_id, "rating": rating}),
+                             content_type='application/json')
+
+        response = self.client.delete('/songs/{}'.format(created_id))
+        json_data = response.get_json()
+        # print("Response test_delete_song: ", json_data)
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(json_data['deleted'])
+
+        self.app.config['delete_jobs'].join()
+        response = self.client.get('/admin/jobs/{}'.format(json_data['job']['job_id']))
+        json_job = response.get_json()
+        self.assertEqual(json_job['status'], "done")
+        self.assertEqual(json_job['deleted'], 2)
+
+        response = self.client.get('/songs/avg/rating/{}'.format(created_id))
+        self.assertIsNone(response.get_json()['avg_value'])
+        response = self.client.delete('/songs/{}'.format(created_id))
+        self.assertEqual(response.status_code, 404)
+
+    def test_delete_song_again_with_ratings(self):
+        params_dict = {
+            "artist": "Vanu Muru",
+            "title": "Deleted Song Twice",
+            "difficulty": 4,
+            "level": 5,
+            "released": "2016-03-01"
+        }
+        res_create = self.client.post('/songs/add',
+                                      data=json.dumps(params_dict),
+                                      content_type='application/json')
+        created_id = res_create.get_json()['created_id']
+        response = self.client.delete('/songs/{}'.format(created_id))
+        self.assertEqual(response.status_code, 202)
+        self.app.config['delete_jobs'].join()
+
+        # Ratings left by a delete job which did not finish
+        with self.app.app_context():
+            get_storage().insert_rating(data={'song_id': bson.ObjectId(created_id), 'rating': 3})
+        response = self.client.delete('/songs/{}'.format(created_id))
+        json_data = response.get_json()
+        # print("Response test_delete_song_again_with_ratings: ", json_data)
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(json_data['deleted'])
+
+        self.app.config['delete_jobs'].join()
+        response = self.client.get('/admin/jobs/{}'.format(json_data['job']['job_id']))
+        self.assertEqual(response.get_json()['deleted'], 1)
+        response = self.client.delete('/songs/{}'.format(created_id))
+        self.assertEqual(response.status_code, 404)
+
+    def test_similar_songs(self):
+        response = self.client.get('/songs/search?message=Vanu')
+        song = response.get_json()['result'][0]
+        response = self.client.get('/songs/{}/similar?k=3'.format(song['_id']))
+        json_data = response.get_json()
+        # print("Response test_similar_songs: ", json_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(0 < json_data['total'] <= 3)
+        distances = [one_song['distance'] for one_song in json_data['result']]
+        self.assertEqual(distances, sorted(distances))
+        self.assertNotIn(song['_id'], [one_song['_id'] for one_song in json_data['result']])
+
+    def test_similar_unknown_song(self):
+        response = self.client.get('/songs/5c6c4b562e48ae1c0f1a6d8f/similar')
+        json_data = response.get_json(response.data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json_data['error_message'], "Song not found: 5c6c4b562e48ae1c0f1a6d8f")
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_song_stats(self):
+        response = self.client.get('/songs/stats?percentiles=50,90&bins=5')
+        json_data = response.get_json()
+        # print("Response test_song_stats: ", json_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json_data['total'] > 0)
+        self.assertEqual(len(json_data['histogram_edges']), 6)
+        self.assertEqual(sum(one_level['total'] for one_level in json_data['levels']), json_data['total'])
+        for one_level in json_data['levels']:
+            self.assertEqual(sum(one_level['histogram']), one_level['total'])
+            self.assertTrue(one_level['min_value'] <= one_level['percentiles']['50'] <= one_level['max_value'])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_song_stats_invalid_percentiles(self):
+        for percentiles in ('nan', '50,inf', '-Infinity'):
+            response = self.client.get('/songs/stats?percentiles={}'.format(percentiles))
+            json_data = response.get_json()
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(json_data['error_message'], "Except finite values for percentiles parameter")
+
+    def test_song_stats_invalid_bins(self):
+        response = self.client.get('/songs/stats?bins=abc')
+        self.assertEqual(response.status_code, 404)
+
     def test_rate_song_missing_song_id_params(self):
         params_dict = {
             "artist": "Vanu Muru",
@@ -155,7 +339,7 @@ class TestSongApi(unittest.TestCase):
     def test_rate_song(self):
         params_dict = {
             "artist": "Vanu Muru",
-            "title": "Greasy Fingers - boss level",
+            "title": "Greasy Fingers - bonus level",
             "difficulty": 2,
             "level": 3,
             "released": "2016-03-01"
@@ -170,7 +354,7 @@ class TestSongApi(unittest.TestCase):
         json_data_rate = None
         if created_id is not None and created_id != '':
             rate_params_dict = {
-                "song_id": "5c6c4b562e48ae1c0f1a6d8a",
+                "song_id": created_id,
                 "rating": 3
             }
             res_rate = self.client.post('/songs/rating',
@@ -184,6 +368,18 @@ class TestSongApi(unittest.TestCase):
         created_rate_id = json_data_rate['created_id']
         self.assertIsNotNone(created_rate_id)
 
+    def test_rate_unknown_song(self):
+        params_dict = {
+            "song_id": "5c6c4b562e48ae1c0f1a6d8f",
+            "rating": 3
+        }
+        response = self.client.post('/songs/rating',
+                                    data=json.dumps(params_dict),
+                                    content_type='application/json')
+        json_data = response.get_json(response.data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json_data['error_message'], "Song not found: 5c6c4b562e48ae1c0f1a6d8f")
+
     def test_get_stat_rating(self):
         with self.app.app_context():
             SITE_ROOT = os.path.realpath(os.path.dirname(__file__))
@@ -199,6 +395,102 @@ class TestSongApi(unittest.TestCase):
         self.assertIsNotNone(json_data['min_value'])
         self.assertIsNotNone(json_data['max_value'])
 
+    def test_get_stat_rating_uppercase_id(self):
+        with self.app.app_context():
+            SITE_ROOT = os.path.realpath(os.path.dirname(__file__))
+            json_url = os.path.join(SITE_ROOT, "test_stat_rating_songs.json")
+            create_ratings_from_file(file_path=json_url)
+
+        response = self.client.get('/songs/avg/rating/5C6C4B562E48AE1C0F1A6D8A')
+        json_data = response.get_json()
+        # print("Response test_get_stat_rating_uppercase_id: ", json_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(json_data['avg_value'])
+
+        response = self.client.get('/songs/avg/rating?ids=5C6C4B562E48AE1C0F1A6D8A,5c6c4b562e48ae1c0f1a6d8a')
+        json_data = response.get_json()
+        self.assertEqual(json_data['total'], 1)
+        self.assertIsNotNone(json_data['result']['5c6c4b562e48ae1c0f1a6d8a']['avg_value'])
+
+    def test_get_stat_ratings(self):
+        with self.app.app_context():
+            SITE_ROOT = os.path.realpath(os.path.dirname(__file__))
+            json_url = os.path.join(SITE_ROOT, "test_stat_rating_songs.json")
+            create_ratings_from_file(file_path=json_url)
+
+        response = self.client.get('/songs/avg/rating?ids=5c6c4b562e48ae1c0f1a6d8a,5c6c4b562e48ae1c0f1a6d8b')
+        json_data = response.get_json()
+        # print("Response test_get_stat_ratings: ", json_data)
+        self.assertEqual(json_data['total'], 2)
+        self.assertIsNotNone(json_data['result']['5c6c4b562e48ae1c0f1a6d8a']['avg_value'])
+        self.assertIsNone(json_data['result']['5c6c4b562e48ae1c0f1a6d8b']['avg_value'])
+
+    def test_get_stat_ratings_missing_params(self):
+        response = self.client.get('/songs/avg/rating')
+        json_data = response.get_json(response.data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json_data['error_message'], "Missing ids parameter")
+
+    def test_export_songs(self):
+        response = self.client.get('/export/songs?format=csv&fields=title,level')
+        self.assertEqual(response.status_code, 200)
+        lines = response.data.decode('utf-8').splitlines()
+        # print("Response test_export_songs: ", lines)
+        self.assertEqual(lines[0], "title,level")
+        self.assertTrue(len(lines) > 1)
+
+    def test_export_ratings_time_zone(self):
+        with self.app.app_context():
+            SITE_ROOT = os.path.realpath(os.path.dirname(__file__))
+            json_url = os.path.join(SITE_ROOT, "test_stat_rating_songs.json")
+            create_ratings_from_file(file_path=json_url)
+
+        response = self.client.get('/export/ratings?fields=rating&start=2000-01-01T00:00:00%2B00:00')
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(lines[0], "rating")
+        self.assertTrue(len(lines) > 1)
+
+        # Start is the same time as end in UTC, no rating is exported
+        response = self.client.get('/export/ratings?fields=rating&start=2000-01-01T07:00:00%2B07:00&end=2000-01-01')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode('utf-8').splitlines()[1:], [])
+
+    def test_export_invalid_date(self):
+        response = self.client.get('/export/ratings?start=2000-13-01')
+        json_data = response.get_json()
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json_data['error_message'], "Invalid date: 2000-13-01")
+
+    def test_export_invalid_collection(self):
+        response = self.client.get('/export/users')
+        json_data = response.get_json(response.data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json_data['error_message'], "Unknown collection: users")
+
+    def test_admission_stats(self):
+        self.client.get('/songs?limit=1&page=1')
+        response = self.client.get('/admin/admission')
+        json_data = response.get_json()
+        # print("Response test_admission_stats: ", json_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json_data['endpoints']['songs']['admitted'] > 0)
+
+    def test_slow_query_stats(self):
+        response = self.client.get('/admin/slow_queries?explain=false')
+        json_data = response.get_json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json_data['total'], len(json_data['result']))
+
+    def test_coalescing_stats(self):
+        self.client.get('/songs/search?message=Vanu')
+        response = self.client.get('/admin/coalescing')
+        json_data = response.get_json()
+        # print("Response test_coalescing_stats: ", json_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json_data['executed'] > 0)
+        self.assertEqual(json_data['calls'], json_data['executed'] + json_data['coalesced'] + json_data['cached'])
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
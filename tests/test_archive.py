@@ -0,0 +1,112 @@
+import datetime
+import shutil
+import tempfile
+import unittest
+
+import bson
+
+from api import create_app
+from instance.archive import RatingArchive, get_batch_key, get_batch_summaries
+from instance.rating import Rating
+from instance.storage import get_storage
+
+
+class TestRatingArchive(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_name="testing")
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.song_id = bson.ObjectId()
+        self.now = datetime.datetime.utcnow()
+        with self.app.app_context():
+            storage = get_storage()
+            storage.insert_song(data={'_id': self.song_id, 'artist': 'Archive', 'title': 'Song'})
+            for days, rating in ((400, 1), (400, 2), (401, 5), (0, 3)):
+                storage.insert_rating(data={
+                    'song_id': self.song_id,
+                    'rating': rating,
+                    'creation_date': self.now - datetime.timedelta(days=days)
+                })
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+        with self.app.app_context():
+            get_storage().drop_database()
+
+    def test_archive_and_restore(self):
+        archive = RatingArchive(archive_dir=self.archive_dir)
+        with self.app.app_context():
+            stats = get_storage().get_rating_stats(song_ids=[self.song_id])
+            self.assertEqual(stats[self.song_id], {'avg_value': 2.75, 'min_value': 1, 'max_value': 5})
+
+            result = archive.archive(before=self.now - datetime.timedelta(days=365), batch_size=2)
+            self.assertEqual(result['archived'], 3)
+            self.assertEqual(len(get_storage().find_ratings()), 1)
+
+            # Statistic data includes archived ratings
+            self.assertEqual(get_storage().get_rating_stats(song_ids=[self.song_id]), stats)
+            self.assertEqual(get_storage().count_ratings_by_song(), {self.song_id: 4})
+            self.assertEqual(Rating().get_stat(str(self.song_id)), stats[self.song_id])
+
+            archived = list(archive.iter_ratings(song_ids=[self.song_id]))
+            self.assertEqual(len(archived), 3)
+            self.assertEqual(archived[0]['song_id'], self.song_id)
+
+            self.assertEqual(archive.restore(), 3)
+            self.assertEqual(len(get_storage().find_ratings()), 4)
+            self.assertEqual(archive.list_files(), [])
+            self.assertEqual(get_storage().get_rating_stats(song_ids=[self.song_id]), stats)
+            self.assertEqual(get_storage().count_ratings_by_song(), {self.song_id: 4})
+
+    def test_restore_partition(self):
+        """
+        Test restored partition is subtracted from rating summary, minimum and maximum included
+        """
+        archive = RatingArchive(archive_dir=self.archive_dir)
+        with self.app.app_context():
+            storage = get_storage()
+            archive.archive(before=self.now - datetime.timedelta(days=365))
+            date = (self.now - datetime.timedelta(days=401)).date()
+            self.assertEqual(archive.restore(start=date, end=date), 1)
+            self.assertEqual(len(archive.list_files()), 1)
+            self.assertEqual(storage.count_ratings_by_song(), {self.song_id: 4})
+
+            restored = [r for r in storage.find_ratings() if r['rating'] == 5]
+            storage.delete_ratings(rating_ids=[r['_id'] for r in restored], song_ids=[self.song_id])
+            stats = storage.get_rating_stats(song_ids=[self.song_id])
+            self.assertEqual(stats[self.song_id], {'avg_value': 2, 'min_value': 1, 'max_value': 3})
+
+    def test_restore_deleted_song(self):
+        archive = RatingArchive(archive_dir=self.archive_dir)
+        with self.app.app_context():
+            storage = get_storage()
+            deleted_id = bson.ObjectId()
+            storage.insert_rating(data={'song_id': deleted_id, 'rating': 4,
+                                        'creation_date': self.now - datetime.timedelta(days=400)})
+            self.assertEqual(archive.archive(before=self.now - datetime.timedelta(days=365))['archived'], 4)
+
+            self.assertEqual(archive.restore(), 3)
+            self.assertEqual([r for r in storage.find_ratings() if r['song_id'] == deleted_id], [])
+            self.assertEqual(storage.count_ratings_by_song(), {self.song_id: 4})
+
+    def test_repeated_batch(self):
+        """
+        Test batch archived again after a failed run is not added twice to rating summary
+        """
+        with self.app.app_context():
+            storage = get_storage()
+            documents = storage.find_old_ratings(before=self.now - datetime.timedelta(days=365), limit=2)
+            for index in range(2):
+                storage.add_rating_summaries(summaries=get_batch_summaries(documents),
+                                             batch_key=get_batch_key(documents[-1]))
+            storage.delete_ratings(rating_ids=[document['_id'] for document in documents])
+
+            self.assertEqual(storage.count_ratings_by_song(), {self.song_id: 4})
+            stats = storage.get_rating_stats(song_ids=[self.song_id])
+            self.assertEqual(stats[self.song_id], {'avg_value': 2.75, 'min_value': 1, 'max_value': 5})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,162 @@
+import datetime
+import fcntl
+import os
+import shutil
+import tempfile
+import unittest
+
+from api import create_app
+from instance.catalog import CatalogSnapshot, CatalogWriter, load_catalog, save_catalog
+from instance.similar import get_similar_index
+from instance.song import Song
+from instance.song_stats import get_song_stats
+from instance.storage import get_storage
+from instance.suggest import get_suggest_index
+
+
+class TestCatalogSnapshot(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_name="testing")
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.snapshot_dir, 'songs.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def get_songs(self):
+        songs = {}
+        fields = ['artist', 'title', 'level', 'difficulty', 'released']
+        for batch in get_storage().iter_batches(collection='songs', fields=fields):
+            for document in batch:
+                songs[document['_id']] = document
+        return songs
+
+    def test_write_and_read(self):
+        with self.app.app_context():
+            storage = get_storage()
+            songs = self.get_songs()
+            song_id = min(songs)
+            rating_id = storage.insert_rating(data={'song_id': song_id, 'rating': 4,
+                                                    'creation_date': datetime.datetime.utcnow()})
+            try:
+                count = save_catalog(file_path=self.file_path)
+            finally:
+                storage.delete_ratings(rating_ids=[rating_id], song_ids=[song_id])
+            self.assertEqual(count, len(songs))
+
+            snapshot = CatalogSnapshot(self.file_path)
+            try:
+                self.assertEqual(len(snapshot), count)
+                self.assertEqual(snapshot.songs_version, storage.get_songs_version())
+                self.assertEqual(snapshot.get_rating_counts()[song_id],
+                                 storage.count_ratings_by_song().get(song_id, 0) + 1)
+                for document in snapshot.iter_documents():
+                    song = songs[document['_id']]
+                    for field in ('artist', 'title', 'level', 'released'):
+                        self.assertEqual(document[field], song.get(field))
+                    self.assertEqual(document['difficulty'], float(song['difficulty']))
+            finally:
+                snapshot.close()
+
+    def test_load_with_delta(self):
+        with self.app.app_context():
+            storage = get_storage()
+            save_catalog(file_path=self.file_path)
+            song_id = storage.insert_song(data={'artist': 'Delta', 'title': 'New Song', 'level': 3,
+                                                'difficulty': 2.5, 'released': '2019-01-01'})
+            rating_id = storage.insert_rating(data={'song_id': song_id, 'rating': 3,
+                                                    'creation_date': datetime.datetime.utcnow()})
+            try:
+                snapshot, songs, rating_counts, source = load_catalog(file_path=self.file_path)
+                self.assertEqual(source, 'snapshot')
+                self.assertEqual([document['_id'] for document in songs], [song_id])
+                self.assertEqual(len(snapshot) + len(songs), len(self.get_songs()))
+                snapshot.close()
+                self.assertEqual(rating_counts, {str(key): value
+                                                 for key, value in storage.count_ratings_by_song().items()})
+                self.assertEqual(rating_counts[str(song_id)], 1)
+            finally:
+                storage.delete_ratings(rating_ids=[rating_id], song_ids=[song_id])
+                storage.delete_song(song_id=song_id)
+
+    def test_changed_songs(self):
+        with self.app.app_context():
+            storage = get_storage()
+            save_catalog(file_path=self.file_path)
+            song = self.get_songs()[min(self.get_songs())]
+            key_filter = {'artist': song['artist'], 'title': song['title']}
+
+            # Updated songs are not seen by the delta, so the snapshot is not used
+            storage.upsert_song(key_filter=key_filter, data={'level': song['level'] + 1})
+            snapshot, songs, rating_counts, source = load_catalog(file_path=self.file_path)
+            self.assertIsNone(snapshot)
+            self.assertEqual(source, 'database')
+            storage.upsert_song(key_filter=key_filter, data={'level': song['level']})
+
+            # Deleted song replaced by a new one keeps the number of songs
+            save_catalog(file_path=self.file_path)
+            storage.delete_song(song_id=song['_id'])
+            storage.insert_song(data=song)
+            snapshot, songs, rating_counts, source = load_catalog(file_path=self.file_path)
+            self.assertIsNone(snapshot)
+            self.assertEqual(source, 'database')
+            self.assertEqual(len(songs), len(self.get_songs()))
+
+    def test_invalid_file(self):
+        with open(self.file_path, 'wb') as snapshot_file:
+            snapshot_file.write(b'not a snapshot file')
+        with self.app.app_context():
+            snapshot, songs, rating_counts, source = load_catalog(file_path=self.file_path)
+            self.assertIsNone(snapshot)
+            self.assertEqual(source, 'database')
+            self.assertEqual(len(songs), len(self.get_songs()))
+
+    def get_index_results(self, song_id=None):
+        song_stats = get_song_stats()
+        return (get_suggest_index().suggest(prefix='a', limit=50), get_suggest_index().suggest(prefix='the'),
+                get_similar_index().get_similar(song_id=song_id, k=50),
+                song_stats.get_stats() if song_stats is not None else None)
+
+    def test_build_indexes(self):
+        """
+        Test indexes filled from built index arrays of snapshot and delta songs are the same as built from songs
+        """
+        with self.app.app_context():
+            storage = get_storage()
+            save_catalog(file_path=self.file_path)
+            song_id = storage.insert_song(data={'artist': 'Another Artist', 'title': 'The Delta', 'level': 9,
+                                                'difficulty': 10.5, 'released': '2019-01-01'})
+            try:
+                Song().build_indexes()
+                expected = self.get_index_results(song_id=song_id)
+
+                snapshot, songs, rating_counts, source = load_catalog(file_path=self.file_path)
+                self.assertEqual(source, 'snapshot')
+                try:
+                    Song().build_indexes(songs=songs, rating_counts=rating_counts, snapshot=snapshot)
+                finally:
+                    snapshot.close()
+                self.assertEqual(self.get_index_results(song_id=song_id), expected)
+            finally:
+                storage.delete_song(song_id=song_id)
+                Song().build_indexes()
+
+    def test_writer(self):
+        with self.app.app_context():
+            writer = CatalogWriter(flask_app=self.app, file_path=self.file_path, interval=600)
+            self.assertEqual(writer.write(), len(self.get_songs()))
+            # Snapshot is not older than the interval
+            self.assertIsNone(writer.write())
+
+            os.utime(self.file_path, (0, 0))
+            with open(self.file_path + '.lock', 'a') as lock_file:
+                # Other process is writing
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.assertIsNone(CatalogWriter(flask_app=self.app, file_path=self.file_path).write())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import gzip
+import unittest
+from unittest import mock
+
+from flask import Flask, Response
+
+from instance.compression import ResponseCompressor, get_compressors
+
+
+class TestResponseCompressor(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.compressor = ResponseCompressor(min_size=100, cache_size=2)
+        self.compressor.init_app(self.app)
+        self.client = self.app.test_client()
+
+        @self.app.route('/small')
+        def small():
+            return 'x' * 99
+
+        @self.app.route('/large', methods=['GET', 'POST'])
+        def large():
+            return 'x' * 100
+
+        @self.app.route('/text/<int:number>')
+        def text(number):
+            return '{} '.format(number) * 100
+
+        @self.app.route('/stream')
+        def stream():
+            return Response((chunk for chunk in ('a' * 10, 'b' * 10)), mimetype='text/plain')
+
+    def test_min_size(self):
+        response = self.client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.data, b'x' * 99)
+
+        response = self.client.get('/large', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), b'x' * 100)
+        self.assertEqual(int(response.headers['Content-Length']), len(response.data))
+
+    def test_streamed_response(self):
+        """
+        Test streamed body is compressed whatever its size
+        """
+        response = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(gzip.decompress(response.data), b'a' * 10 + b'b' * 10)
+
+    def test_accept_encoding(self):
+        for accept_encoding in (None, 'identity', 'deflate', 'gzip;q=0'):
+            headers = {} if accept_encoding is None else {'Accept-Encoding': accept_encoding}
+            response = self.client.get('/large', headers=headers)
+            self.assertNotIn('Content-Encoding', response.headers, accept_encoding)
+            self.assertEqual(response.data, b'x' * 100)
+
+        response = self.client.get('/large', headers={'Accept-Encoding': 'deflate, gzip;q=0.5'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+        # Encoding with highest quality of the client, gzip if other encodings are not installed
+        response = self.client.get('/large', headers={'Accept-Encoding': 'gzip;q=0.5, br;q=0.8, zstd'})
+        expected = [encoding for encoding in ('zstd', 'br', 'gzip') if encoding in get_compressors()][0]
+        self.assertEqual(response.headers['Content-Encoding'], expected)
+
+    def test_cache(self):
+        """
+        Test body of GET response is compressed once and cached, bodies of other methods are not cached
+        """
+        with mock.patch.object(self.compressor, 'get_compressor', wraps=self.compressor.get_compressor) as method:
+            first = self.client.get('/large', headers={'Accept-Encoding': 'gzip'})
+            second = self.client.get('/large', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(method.call_count, 1)
+            self.assertEqual(first.data, second.data)
+
+            self.client.post('/large', headers={'Accept-Encoding': 'gzip'})
+            self.client.post('/large', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(method.call_count, 3)
+
+            # Least recently used body is dropped when the cache is full
+            self.client.get('/text/1', headers={'Accept-Encoding': 'gzip'})
+            self.client.get('/text/2', headers={'Accept-Encoding': 'gzip'})
+            self.client.get('/large', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(method.call_count, 6)
+            self.client.get('/text/2', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(method.call_count, 6)
+
+    def test_cache_disabled(self):
+        compressor = ResponseCompressor(min_size=100, cache_size=0)
+        with self.app.test_request_context('/large', headers={'Accept-Encoding': 'gzip'}):
+            with mock.patch.object(compressor, 'get_compressor', wraps=compressor.get_compressor) as method:
+                for index in range(2):
+                    self.assertEqual(gzip.decompress(compressor.compress_data(b'x' * 100, 'gzip')), b'x' * 100)
+                self.assertEqual(method.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
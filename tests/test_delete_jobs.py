@@ -0,0 +1,107 @@
+import datetime
+import unittest
+from unittest import mock
+
+import bson
+
+from api import create_app
+from instance.delete_jobs import RatingDeleteJobs
+from instance.storage import get_storage
+
+
+class TestRatingDeleteJobs(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_name="testing")
+
+    def test_delete_in_batches(self):
+        song_id = bson.ObjectId()
+        other_song_id = bson.ObjectId()
+        with self.app.app_context():
+            storage = get_storage()
+            for index in range(5):
+                storage.insert_rating(data={'song_id': song_id, 'rating': 3})
+            storage.insert_rating(data={'song_id': other_song_id, 'rating': 3})
+            storage.add_rating_summaries(summaries={song_id: {'count': 2, 'sum': 6, 'min': 1, 'max': 5}},
+                                         batch_key='2018-01-01T00:00:00.000000')
+
+            jobs = RatingDeleteJobs(flask_app=self.app, batch_size=2, pause=0)
+            job = jobs.submit(song_id=str(song_id))
+            self.assertEqual(job['status'], 'queued')
+            jobs.join()
+
+            job = jobs.get_job(job_id=job['job_id'])
+            self.assertEqual(job['status'], 'done')
+            self.assertEqual(job['deleted'], 5)
+            self.assertEqual(job['batches'], 3)
+            self.assertEqual(storage.find_song_rating_ids(song_id=song_id), [])
+            self.assertEqual(storage.get_rating_stats(song_ids=[song_id]), {})
+            self.assertEqual(len(storage.find_song_rating_ids(song_id=other_song_id)), 1)
+            self.assertEqual(jobs.list_jobs()[-1]['job_id'], job['job_id'])
+            self.assertIsNone(jobs.get_job(job_id='unknown'))
+
+    def test_rescan_ratings(self):
+        song_id = bson.ObjectId()
+        with self.app.app_context():
+            storage = get_storage()
+            storage.insert_rating(data={'song_id': song_id, 'rating': 3})
+
+            def insert_late_rating(seconds):
+                # Rating accepted by other worker process before it refreshed its song id index
+                storage.insert_rating(data={'song_id': song_id, 'rating': 4})
+
+            jobs = RatingDeleteJobs(flask_app=self.app, batch_size=2, pause=0, rescan_delay=30)
+            with mock.patch('instance.delete_jobs.time.sleep', side_effect=insert_late_rating) as sleep:
+                job = jobs.submit(song_id=str(song_id))
+                jobs.join()
+                self.assertEqual(sleep.call_count, 1)
+            self.assertTrue(0 < sleep.call_args[0][0] <= 30)
+
+            job = jobs.get_job(job_id=job['job_id'])
+            self.assertEqual((job['status'], job['deleted'], job['batches']), ('done', 2, 2))
+            self.assertEqual(storage.find_song_rating_ids(song_id=song_id), [])
+
+    def test_job_seen_by_other_process(self):
+        song_id = bson.ObjectId()
+        with self.app.app_context():
+            storage = get_storage()
+            storage.insert_rating(data={'song_id': song_id, 'rating': 3})
+
+            jobs = RatingDeleteJobs(flask_app=self.app, batch_size=2, pause=0)
+            job = jobs.submit(song_id=str(song_id))
+            jobs.join()
+
+            other_jobs = RatingDeleteJobs(flask_app=self.app, batch_size=2, pause=0)
+            other_job = other_jobs.get_job(job_id=job['job_id'])
+            self.assertEqual(other_job['status'], 'done')
+            self.assertEqual(other_job['deleted'], 1)
+
+    def test_resume_stopped_job(self):
+        song_id = bson.ObjectId()
+        with self.app.app_context():
+            storage = get_storage()
+            for index in range(3):
+                storage.insert_rating(data={'song_id': song_id, 'rating': 3})
+            # Job claimed by a process which stopped before its lease expired
+            job_id = storage.insert_job(data={'song_id': song_id, 'status': 'running', 'deleted': 0, 'batches': 0,
+                                              'creation_date': datetime.datetime.utcnow(),
+                                              'heartbeat_date': datetime.datetime.utcnow()})
+
+            jobs = RatingDeleteJobs(flask_app=self.app, batch_size=2, pause=0, lease=60)
+            jobs.resume()
+            jobs.join()
+            self.assertEqual(jobs.get_job(job_id=str(job_id))['status'], 'running')
+            self.assertEqual(len(storage.find_song_rating_ids(song_id=song_id)), 3)
+
+            storage.update_job(job_id=job_id, data={
+                'heartbeat_date': datetime.datetime.utcnow() - datetime.timedelta(seconds=120)})
+            jobs.resume()
+            jobs.join()
+            job = jobs.get_job(job_id=str(job_id))
+            self.assertEqual(job['status'], 'done')
+            self.assertEqual(job['deleted'], 3)
+            self.assertEqual(storage.find_song_rating_ids(song_id=song_id), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
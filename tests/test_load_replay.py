@@ -0,0 +1,52 @@
+import json
+import random
+import unittest
+
+from benchmarks.load_replay import load_collection, load_fixtures, parse_weights, get_percentile, LoadReplay, \
+    DEFAULT_COLLECTION, DEFAULT_DATA_DIR
+
+
+class TestLoadReplay(unittest.TestCase):
+    def test_load_collection(self):
+        requests_list = load_collection(DEFAULT_COLLECTION)
+        # print("test_load_collection: ", requests_list)
+        self.assertTrue(len(requests_list) > 0)
+
+        rate_request = [r for r in requests_list if r['name'] == 'Rate song'][0]
+        self.assertEqual(rate_request['method'], 'POST')
+        self.assertEqual(rate_request['headers']['Content-Type'], 'application/json')
+        self.assertIsNotNone(rate_request['body'])
+
+    def test_parse_weights(self):
+        weights = parse_weights("Rate song=5, Songs=0.5")
+        self.assertEqual(weights, {'Rate song': 5.0, 'Songs': 0.5})
+
+    def test_get_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(get_percentile(values, 50), 50)
+        self.assertEqual(get_percentile(values, 99), 99)
+        self.assertIsNone(get_percentile([], 50))
+
+    def test_prepare_unique_songs(self):
+        requests_list = [{'name': 'Add song', 'method': 'POST', 'url': 'http://localhost:5000/songs',
+                          'headers': {}, 'body': json.dumps({'artist': 'A', 'title': 'B'})}]
+        replay = LoadReplay(base_url='http://127.0.0.1:5000', requests_list=requests_list,
+                            fixtures=load_fixtures(DEFAULT_DATA_DIR), seed=0, run_tag='run1')
+        rand = random.Random(0)
+        bodies = [json.loads(replay.prepare(requests_list[0], rand)[3]) for _ in range(20)]
+        # print("test_prepare_unique_songs: ", bodies[:2])
+        self.assertEqual(len(set((b['artist'], b['title']) for b in bodies)), 20)
+        self.assertTrue(bodies[0]['title'].endswith(' #run1-1'))
+
+    def test_report_client_errors(self):
+        replay = LoadReplay(base_url='http://127.0.0.1:5000', requests_list=[], seed=0)
+        for status_code in (201, 201, 409, 500):
+            replay.record('Add song', 0.01, status_code)
+        report = replay.get_report(elapsed=1)
+        self.assertEqual(report['Add song']['error_rate'], 0.25)
+        self.assertEqual(report['Add song']['client_error_rate'], 0.25)
+        self.assertEqual(report['ALL']['client_error_rate'], 0.25)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
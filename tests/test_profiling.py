@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+
+from api import create_app
+from instance.profiling import SlowQueryRecorder
+
+
+class TestSlowQueryRecorder(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_name="testing")
+
+    @staticmethod
+    def get_mongo(address=None):
+        mongo = mock.Mock()
+        mongo.cx.nodes = frozenset([address])
+        mongo.cx.__getitem__ = mock.Mock()
+        mongo.cx.__getitem__.return_value.command.return_value = {
+            'executionStats': {'executionTimeMillis': 12, 'totalKeysExamined': 3, 'totalDocsExamined': 3,
+                               'nReturned': 3, 'executionStages': {'stage': 'FETCH'}}
+        }
+        return mongo
+
+    def test_explain_on_server_of_query(self):
+        recorder = SlowQueryRecorder(threshold_ms=0)
+        shard_addresses = [('shard0', 27017), ('shard1', 27017)]
+        for request_id, address in enumerate(shard_addresses):
+            command = {'find': 'ratings', 'filter': {'song_id': 1}, 'lsid': 'session'}
+            recorder.started(mock.Mock(command_name='find', command=command, database_name='ratings_db',
+                                       connection_id=address, request_id=request_id))
+            recorder.succeeded(mock.Mock(command_name='find', duration_micros=5000, connection_id=address,
+                                         request_id=request_id))
+
+        mongos = [self.get_mongo(('main', 27017))] + [self.get_mongo(address) for address in shard_addresses]
+        with self.app.app_context():
+            records = recorder.get_records(mongos=mongos)
+
+        self.assertEqual(sorted(record['server'] for record in records), ['shard0:27017', 'shard1:27017'])
+        self.assertEqual(records[0]['explain']['winning_stage'], 'FETCH')
+        self.assertNotIn('lsid', records[0]['command'])
+        mongos[0].cx.__getitem__.assert_not_called()
+        for mongo in mongos[1:]:
+            mongo.cx.__getitem__.assert_called_once_with('ratings_db')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import math
+import random
+import unittest
+
+from api import create_app
+from instance.similar import SimilarIndex
+
+
+class TestSimilarIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_name="testing")
+
+    def setUp(self):
+        rand = random.Random(7)
+        self.songs = [{'_id': 'song{}'.format(index), 'artist': 'Artist', 'title': 'Title {}'.format(index),
+                       'level': rand.randint(1, 15), 'difficulty': round(rand.uniform(1, 16), 1)}
+                      for index in range(200)]
+        self.index = SimilarIndex()
+        with self.app.app_context():
+            self.index.build(songs=self.songs)
+
+    def get_expected(self, song=None, songs=None, k=None):
+        distances = sorted(math.hypot(one_song['level'] - song['level'], one_song['difficulty'] - song['difficulty'])
+                           for one_song in songs if one_song['_id'] != song['_id'])
+        return distances[:k]
+
+    def test_get_similar(self):
+        for song in self.songs[:20]:
+            output = self.index.get_similar(song_id=song['_id'], k=5)
+            self.assertEqual([one_song['distance'] for one_song in output], self.get_expected(song, self.songs, 5))
+
+    def test_add_and_remove(self):
+        song = self.songs[0]
+        self.index.add(song_id='new', data={'artist': 'New', 'title': 'Twin', 'level': song['level'],
+                                            'difficulty': song['difficulty']})
+        output = self.index.get_similar(song_id=song['_id'], k=1)
+        self.assertEqual(output[0]['_id'], 'new')
+        self.assertEqual(output[0]['distance'], 0.0)
+
+        self.assertTrue(self.index.remove(song_id='new'))
+        self.assertFalse(self.index.remove(song_id='new'))
+        output = self.index.get_similar(song_id=song['_id'], k=3)
+        self.assertEqual([one_song['distance'] for one_song in output], self.get_expected(song, self.songs, 3))
+
+    def test_unknown_song(self):
+        self.assertIsNone(self.index.get_similar(song_id='unknown'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from instance.single_flight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def slow_read(self, value=None):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if value is None:
+            raise ValueError("Missing value")
+        return value * 2
+
+    def test_coalesce_threads(self):
+        single_flight = SingleFlight()
+        results = []
+
+        def run():
+            results.append(single_flight.do(('read', 1), self.slow_read, 1))
+
+        threads = [threading.Thread(target=run) for index in range(5)]
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while single_flight.get_stats()['calls'] < 5:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [2] * 5)
+        self.assertEqual(self.calls, 1)
+        stats = single_flight.get_stats()
+        self.assertEqual(stats['executed'], 1)
+        self.assertEqual(stats['coalesced'], 4)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_error_is_not_kept(self):
+        single_flight = SingleFlight(ttl=60)
+        self.release.set()
+        for index in range(2):
+            with self.assertRaises(ValueError):
+                single_flight.do(('read', None), self.slow_read, None)
+        self.assertEqual(self.calls, 2)
+
+    def test_ttl_and_invalidate(self):
+        single_flight = SingleFlight(ttl=60)
+        self.release.set()
+        self.assertEqual(single_flight.do(('read', 1), self.slow_read, 1), 2)
+        self.assertEqual(single_flight.do(('read', 1), self.slow_read, 1), 2)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(single_flight.get_stats()['cached'], 1)
+
+        single_flight.invalidate(name='read', arguments=1)
+        single_flight.do(('read', 1), self.slow_read, 1)
+        self.assertEqual(self.calls, 2)
+
+    def test_coalesce_async(self):
+        single_flight = SingleFlight()
+
+        async def run():
+            tasks = [asyncio.ensure_future(single_flight.do_async(('read', 3), self.slow_read, 3))
+                     for index in range(3)]
+            await asyncio.sleep(0.05)
+            self.release.set()
+            return await asyncio.gather(*tasks)
+
+        self.assertEqual(asyncio.run(run()), [6, 6, 6])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(single_flight.get_stats()['coalesced'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
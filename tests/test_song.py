@@ -1,6 +1,8 @@
 import unittest
+from unittest import mock
 
 from api import create_app
+from instance.similar import SimilarIndex, get_similar_index
 from instance.song import Song
 
 
@@ -17,7 +19,7 @@ class TestSong(unittest.TestCase):
         """ Drop database after executed all test cases """
 
         with cls.app.app_context():
-            Song(is_test_mode=1).drop_database()
+            Song().drop_database()
             print('DROPPED database')
 
     def test_create(self):
@@ -27,7 +29,7 @@ class TestSong(unittest.TestCase):
         """
         params = {
             "artist": "Mr Fastfinger",
-            "title": "Awaki-Waki",
+            "title": "Awaki-Waki (Radio Edit)",
             "difficulty": 15,
             "level": 13,
             "released": "2012-05-11"
@@ -46,7 +48,7 @@ class TestSong(unittest.TestCase):
         """
         params = {
             "artist": "Mr Fastfinger",
-            "title": "Awaki-Waki",
+            "title": "Awaki-Waki Remix",
             "difficulty": 15,
             "level": 13,
             "released": "2012-05-11"
@@ -54,7 +56,7 @@ class TestSong(unittest.TestCase):
         created_id = None
         status = False
         with self.app.app_context():
-            created_id = Song(is_test_mode=1).create(**params)
+            created_id = Song().create(**params)
 
             if created_id is not None:
                 print('== created_id: %s', created_id)
@@ -62,6 +64,38 @@ class TestSong(unittest.TestCase):
 
         self.assertTrue(status)
 
+    def test_upsert_many_updates_indexes(self):
+        """
+        Test importing changed song again updates in-memory indexes of the existing song
+
+        :return:
+        """
+        rows = [
+            {"artist": "Upsert Many", "title": "First", "difficulty": 3.5, "level": 4, "released": "2015-01-01"},
+            {"artist": "Upsert Many", "title": "Second", "difficulty": 4.5, "level": 4, "released": "2015-01-02"}
+        ]
+        with self.app.app_context():
+            result = Song().upsert_many(rows, batch_size=1)
+            self.assertEqual(result['inserted'], 2)
+            song_ids = {song['title']: song['_id'] for song in Song().search_by(key_search='Upsert Many')}
+
+            # Indexes are rebuilt once, songs are not added one by one
+            with mock.patch.object(SimilarIndex, 'add') as similar_add, \
+                    mock.patch.object(SimilarIndex, 'build', wraps=get_similar_index().build) as similar_build:
+                result = Song().upsert_many([dict(rows[0], level=7, difficulty=12.0)])
+                self.assertEqual(result, {'inserted': 0, 'modified': 1, 'matched': 1})
+                similar_add.assert_not_called()
+                self.assertEqual(similar_build.call_count, 1)
+
+                Song().upsert_many([dict(rows[0], level=7, difficulty=12.0)], update_indexes=False)
+                Song().upsert_many([dict(rows[0], level=8, difficulty=12.0)], update_indexes=False)
+                self.assertEqual(similar_build.call_count, 1)
+            Song().upsert_many([dict(rows[0], level=7, difficulty=12.0)])
+
+            similar = get_similar_index().get_similar(song_id=song_ids['Second'], k=1000)
+            first_song = [song for song in similar if song['_id'] == song_ids['First']][0]
+            self.assertEqual((first_song['level'], first_song['difficulty']), (7, 12.0))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,119 @@
+import datetime
+import os
+import unittest
+
+import bson
+
+from api import create_app
+from instance.song_ids import BloomFilter, SongIdIndex
+from instance.storage import get_storage
+
+
+class TestSongIdIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_name="testing")
+
+    def setUp(self):
+        self.song_ids = [bson.ObjectId() for index in range(20)]
+        with self.app.app_context():
+            for number, song_id in enumerate(self.song_ids[:11]):
+                get_storage().insert_song(data={'_id': song_id, 'artist': 'Song Id Index', 'title': str(number)})
+
+    def tearDown(self):
+        with self.app.app_context():
+            for song_id in self.song_ids:
+                get_storage().delete_song(song_id=song_id)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        values = [bson.ObjectId().binary for index in range(1000)]
+        for value in values:
+            bloom.add(value)
+        self.assertTrue(all(value in bloom for value in values))
+        false_positives = sum(bson.ObjectId().binary in bloom for index in range(2000))
+        self.assertTrue(false_positives < 100)
+
+    def test_exact_and_bloom_mode(self):
+        with self.app.app_context():
+            for exact_max, mode in ((100, 'exact'), (5, 'bloom')):
+                index = SongIdIndex(exact_max=exact_max)
+                index.build(song_ids=self.song_ids[:10])
+                self.assertEqual(index.get_stats()['mode'], mode)
+                self.assertTrue(index.contains(str(self.song_ids[0])))
+
+                index.add(self.song_ids[10])
+                self.assertTrue(index.contains(self.song_ids[10]))
+                index.remove(self.song_ids[0])
+                get_storage().delete_song(song_id=self.song_ids[0])
+                self.assertFalse(index.contains(self.song_ids[0]))
+                self.assertFalse(index.contains(self.song_ids[15]))
+
+                stats = index.get_stats()
+                self.assertEqual(stats['total'], 10)
+                self.assertEqual(stats['rejected'], 2)
+                get_storage().insert_song(data={'_id': self.song_ids[0], 'artist': 'Song Id Index', 'title': '0'})
+
+    @staticmethod
+    def get_old_id():
+        return bson.ObjectId(bson.ObjectId.from_datetime(datetime.datetime(2015, 1, 1)).binary[:4] + os.urandom(8))
+
+    def test_bloom_lookups(self):
+        """
+        Test ids matched by Bloom filter are accepted without point lookup, old ids not matched by the filter
+        are rejected without lookup and new ids not matched by the filter are looked up
+        """
+        with self.app.app_context():
+            index = SongIdIndex(exact_max=5, error_rate=0.01)
+            index.build(song_ids=self.song_ids[:10])
+            negative = next(song_id for song_id in (self.get_old_id() for number in range(200))
+                            if song_id.binary not in index._bloom)
+
+            self.assertTrue(index.contains(self.song_ids[3]))
+            self.assertFalse(index.contains(negative))
+            stats = index.get_stats()
+            self.assertEqual((stats['hits'], stats['lookups'], stats['rejected']), (1, 0, 1))
+
+            # Song created by other worker process after the filter was built
+            self.assertTrue(index.contains(self.song_ids[10]))
+            self.assertTrue(index.contains(self.song_ids[10]))
+            self.assertFalse(index.contains(self.song_ids[15]))
+            stats = index.get_stats()
+            self.assertEqual((stats['hits'], stats['lookups'], stats['rejected']), (2, 2, 2))
+
+    def test_song_deleted_by_other_worker(self):
+        with self.app.app_context():
+            for exact_max in (100, 5):
+                index = SongIdIndex(exact_max=exact_max, refresh_interval=0)
+                index.build(song_ids=self.song_ids[:10])
+                self.assertTrue(index.contains(self.song_ids[1]))
+
+                get_storage().delete_song(song_id=self.song_ids[1])
+                self.assertFalse(index.contains(self.song_ids[1]))
+                self.assertEqual(index.get_stats()['total'], 9)
+
+                get_storage().insert_song(data={'_id': self.song_ids[1], 'artist': 'Song Id Index', 'title': '1'})
+                self.assertTrue(index.contains(self.song_ids[1]))
+
+    def test_switch_to_bloom(self):
+        with self.app.app_context():
+            index = SongIdIndex(exact_max=3)
+            for song_id in self.song_ids[:4]:
+                index.add(song_id)
+            self.assertEqual(index.get_stats()['mode'], 'bloom')
+            self.assertTrue(all(index.contains(song_id) for song_id in self.song_ids[:4]))
+
+    def test_lookup_song_of_other_worker(self):
+        with self.app.app_context():
+            song_id = get_storage().insert_song(data={'artist': 'Other Worker', 'title': 'Missing', 'released': '2019'})
+            index = SongIdIndex()
+            index.build(song_ids=[])
+            self.assertTrue(index.contains(song_id))
+            self.assertEqual(index.get_stats()['lookups'], 1)
+            self.assertTrue(index.contains(song_id))
+            self.assertEqual(index.get_stats()['hits'], 1)
+            get_storage().delete_song(song_id=song_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from instance.song_stats import SongStatsSnapshot
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestSongStatsSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = SongStatsSnapshot(capacity=2)
+        self.songs = [
+            ('a', {'level': 3, 'difficulty': 2.0, 'released': '2016-10-26'}),
+            ('b', {'level': 3, 'difficulty': 4.0, 'released': '2017-01-01'}),
+            ('c', {'level': 3, 'difficulty': 9.0, 'released': '2017-05-05'}),
+            ('d', {'level': 9, 'difficulty': 10.5, 'released': 'unknown'}),
+            ('e', {'level': 9, 'difficulty': 13.5})
+        ]
+        for song_id, data in self.songs:
+            self.snapshot.add(song_id=song_id, data=data)
+
+    def test_get_stats(self):
+        stats = self.snapshot.get_stats(percentiles=[0, 50, 90], bins=4)
+        self.assertEqual(stats['total'], 5)
+        self.assertEqual([one_level['level'] for one_level in stats['levels']], [3, 9])
+
+        level_3 = stats['levels'][0]
+        for percentile in (0, 50, 90):
+            self.assertAlmostEqual(level_3['percentiles']['{:g}'.format(percentile)],
+                                   numpy.percentile([2.0, 4.0, 9.0], percentile))
+        self.assertAlmostEqual(level_3['avg_value'], 5.0)
+        self.assertEqual([sum(one_level['histogram']) for one_level in stats['levels']], [3, 2])
+        self.assertEqual(stats['released'], [{'year': 2016, 'total': 1}, {'year': 2017, 'total': 2}])
+
+        levels = [data['level'] for song_id, data in self.songs]
+        difficulties = [data['difficulty'] for song_id, data in self.songs]
+        self.assertAlmostEqual(stats['correlation'], numpy.corrcoef(levels, difficulties)[0, 1])
+
+    def test_update_and_remove(self):
+        self.snapshot.add(song_id='a', data={'level': 9, 'difficulty': 12.0})
+        self.assertTrue(self.snapshot.remove(song_id='b'))
+        self.assertFalse(self.snapshot.remove(song_id='b'))
+
+        stats = self.snapshot.get_stats(percentiles=[50], bins=2)
+        self.assertEqual(stats['total'], 4)
+        self.assertEqual([(one_level['level'], one_level['total']) for one_level in stats['levels']],
+                         [(3, 1), (9, 3)])
+        self.assertEqual(stats['levels'][1]['percentiles']['50'], 12.0)
+
+    def test_empty(self):
+        stats = SongStatsSnapshot().get_stats()
+        self.assertEqual(stats['total'], 0)
+        self.assertEqual(stats['levels'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
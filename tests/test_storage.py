@@ -0,0 +1,271 @@
+import datetime
+import unittest
+from unittest import mock
+
+import bson
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from api import create_app
+from instance.storage import MemoryStorage, MongoStorage, ShardedStorage, get_shard_index
+
+
+class TestMemoryStorage(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_name="testing")
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+        self.storage.create_song_indexes(natural_key=('artist', 'title', 'released'))
+        self.song = {
+            "artist": "Mr Fastfinger",
+            "title": "Awaki-Waki",
+            "difficulty": 15,
+            "level": 13,
+            "released": "2012-05-11"
+        }
+
+    def test_insert_duplicated_song(self):
+        with self.app.app_context():
+            self.storage.insert_song(data=self.song)
+            with self.assertRaises(DuplicateKeyError):
+                self.storage.insert_song(data=self.song)
+
+    def test_upsert_song(self):
+        key_filter = {"artist": "Mr Fastfinger", "title": "Awaki-Waki", "released": "2012-05-11"}
+        with self.app.app_context():
+            first_id = self.storage.upsert_song(key_filter=key_filter, data=self.song)
+            second_id = self.storage.upsert_song(key_filter=key_filter, data=dict(self.song, level=14))
+
+            self.assertEqual(first_id, second_id)
+            self.assertEqual(self.storage.count_songs(query={'level': 13}), 0)
+            self.assertEqual(self.storage.count_songs(query={'level': 14}), 1)
+            self.assertEqual(self.storage.get_songs_version(), 1)
+            self.storage.upsert_song(key_filter=key_filter, data=dict(self.song, level=14))
+            self.assertEqual(self.storage.get_songs_version(), 1)
+
+    def test_find_songs(self):
+        with self.app.app_context():
+            self.storage.insert_song(data=self.song)
+            self.storage.insert_song(data=dict(self.song, title="Another One", level=9))
+
+            songs = self.storage.find_songs(query={'key_search': 'awaki'})
+            self.assertEqual(len(songs), 1)
+            songs = self.storage.find_songs(query={'level': 9}, fields=('title',))
+            self.assertEqual(list(songs[0].keys()), ['_id', 'title'])
+            self.assertEqual(len(self.storage.find_songs(skip=1, limit=5)), 1)
+
+    def test_get_rating_stats(self):
+        song_id = bson.ObjectId()
+        with self.app.app_context():
+            for rating in (1, 3, 5):
+                self.storage.insert_rating(data={'song_id': song_id, 'rating': rating})
+
+            stats = self.storage.get_rating_stats(song_ids=[song_id, bson.ObjectId()])
+            self.assertEqual(list(stats.keys()), [song_id])
+            self.assertEqual(stats[song_id], {'avg_value': 3.0, 'min_value': 1, 'max_value': 5})
+
+
+@unittest.skipIf(mongomock is None, 'mongomock is not installed')
+class TestMongoStorage(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_name="testing")
+
+    def setUp(self):
+        self.storage = MongoStorage(mongo=mock.Mock(db=mongomock.MongoClient().db))
+        self.song = {
+            "artist": "Mr Fastfinger",
+            "title": "Awaki-Waki",
+            "difficulty": 15,
+            "level": 13,
+            "released": "2012-05-11"
+        }
+
+    def test_song_indexes(self):
+        with self.app.app_context():
+            self.storage.insert_song(data=self.song)
+            self.storage.insert_song(data=self.song)
+            self.assertFalse(self.storage.create_song_indexes(natural_key=('artist', 'title', 'released')))
+
+            storage = MongoStorage(mongo=mock.Mock(db=mongomock.MongoClient().db))
+            self.assertTrue(storage.create_song_indexes(natural_key=('artist', 'title', 'released')))
+            storage.insert_song(data=self.song)
+            with self.assertRaises(DuplicateKeyError):
+                storage.insert_song(data=self.song)
+
+    def test_upsert_song(self):
+        key_filter = {"artist": "Mr Fastfinger", "title": "Awaki-Waki", "released": "2012-05-11"}
+        with self.app.app_context():
+            self.storage.create_song_indexes(natural_key=('artist', 'title', 'released'))
+            first_id = self.storage.upsert_song(key_filter=key_filter, data=self.song)
+            self.assertEqual(self.storage.get_songs_version(), 0)
+            self.assertTrue(self.storage.has_song(song_id=first_id))
+            second_id = self.storage.upsert_song(key_filter=key_filter, data=dict(self.song, level=14))
+
+            self.assertEqual(first_id, second_id)
+            self.assertEqual(self.storage.count_songs(query={'level': 13}), 0)
+            self.assertEqual(self.storage.count_songs(query={'level': 14}), 1)
+
+    def test_find_songs(self):
+        with self.app.app_context():
+            song_id = self.storage.insert_song(data=self.song)
+            self.storage.insert_song(data=dict(self.song, title="Another One", level=9, difficulty=5))
+
+            self.assertEqual(len(list(self.storage.find_songs(query={'key_search': 'awaki'}))), 1)
+            songs = list(self.storage.find_songs(query={'level': 9}, fields=('title',)))
+            self.assertEqual(sorted(songs[0].keys()), ['_id', 'title'])
+            self.assertEqual(len(list(self.storage.find_songs(skip=1, limit=5))), 1)
+            self.assertEqual(self.storage.count_songs(), 2)
+            self.assertEqual(self.storage.count_songs(query={'key_search': 'one'}), 1)
+            self.assertEqual(self.storage.get_song_average(field='difficulty'), 10)
+
+            self.assertTrue(self.storage.has_song(song_id=song_id))
+            self.assertEqual(self.storage.get_songs_version(), 0)
+            self.assertTrue(self.storage.delete_song(song_id=song_id))
+            self.assertFalse(self.storage.has_song(song_id=song_id))
+            self.assertFalse(self.storage.delete_song(song_id=song_id))
+            self.assertEqual(self.storage.get_songs_version(), 1)
+
+    def test_ratings(self):
+        song_id = bson.ObjectId()
+        now = datetime.datetime.utcnow()
+        with self.app.app_context():
+            self.storage.create_rating_indexes()
+            rating_ids = [self.storage.insert_rating(data={'song_id': song_id, 'rating': rating,
+                                                           'creation_date': now - datetime.timedelta(days=rating)})
+                          for rating in (1, 3, 5)]
+            self.storage.insert_rating(data={'song_id': bson.ObjectId(), 'rating': 2, 'creation_date': now})
+
+            stats = self.storage.get_rating_stats(song_ids=[song_id, bson.ObjectId()])
+            self.assertEqual(stats, {song_id: {'avg_value': 3.0, 'min_value': 1, 'max_value': 5}})
+            self.assertEqual(self.storage.count_ratings_by_song()[song_id], 3)
+            self.assertEqual(self.storage.count_ratings_by_song(start=now - datetime.timedelta(days=4),
+                                                                end=now)[song_id], 2)
+            self.assertEqual(sorted(self.storage.find_song_rating_ids(song_id=song_id)), sorted(rating_ids))
+            self.assertEqual(len(self.storage.find_song_rating_ids(song_id=song_id, limit=2)), 2)
+
+            old_ratings = self.storage.find_old_ratings(before=now - datetime.timedelta(hours=1), limit=2)
+            self.assertEqual([document['rating'] for document in old_ratings], [5, 3])
+            batches = list(self.storage.iter_batches(collection='ratings', fields=['rating'], start=now, batch_size=1))
+            self.assertEqual([[document['rating'] for document in batch] for batch in batches], [[2]])
+
+            self.assertEqual(self.storage.update_rating(rating_id=rating_ids[0], rating=4), 1)
+            document = self.storage.find_rating(rating_id=rating_ids[0])
+            self.assertEqual(document['rating'], 4)
+            self.assertIn('lastModified', document)
+
+            self.assertEqual(self.storage.delete_ratings(rating_ids=rating_ids[1:]), 2)
+            self.assertEqual(len(list(self.storage.find_ratings())), 2)
+
+
+class TestMongoUpsert(unittest.TestCase):
+    def test_retry_duplicated_upsert(self):
+        """
+        Test operation which lost a race of inserting the same song is run again as update
+        """
+        first_id = bson.ObjectId()
+        second_id = bson.ObjectId()
+        operations = [({'artist': 'A', 'title': 'One'}, {'level': 1}), ({'artist': 'A', 'title': 'Two'}, {'level': 2})]
+        songs = mock.MagicMock()
+        songs.bulk_write.side_effect = [
+            BulkWriteError({'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'E11000 duplicate key'}],
+                            'nUpserted': 1, 'nModified': 0, 'nMatched': 0,
+                            'upserted': [{'index': 0, '_id': first_id}]}),
+            mock.MagicMock(bulk_api_result={'nUpserted': 0, 'nModified': 1, 'nMatched': 1, 'upserted': []})
+        ]
+        storage = MongoStorage(mongo=mock.MagicMock(db=mock.MagicMock(songs=songs)))
+
+        result = storage.upsert_songs(operations=operations)
+        self.assertEqual(songs.bulk_write.call_count, 2)
+        self.assertEqual(len(songs.bulk_write.call_args[0][0]), 1)
+        self.assertEqual(result, {'inserted': 1, 'modified': 1, 'matched': 1,
+                                  'upserted_ids': {0: first_id}})
+
+    def test_other_write_error(self):
+        songs = mock.MagicMock()
+        songs.bulk_write.side_effect = BulkWriteError({'writeErrors': [{'index': 0, 'code': 121, 'errmsg': ''}],
+                                                       'nUpserted': 0, 'nModified': 0, 'nMatched': 0, 'upserted': []})
+        storage = MongoStorage(mongo=mock.MagicMock(db=mock.MagicMock(songs=songs)))
+        with self.assertRaises(BulkWriteError):
+            storage.upsert_songs(operations=[({'artist': 'A', 'title': 'One'}, {'level': 1})])
+
+
+class TestShardedStorage(unittest.TestCase):
+    def setUp(self):
+        self.shards = [MemoryStorage() for index in range(3)]
+        self.storage = ShardedStorage(song_storage=MemoryStorage(), rating_shards=self.shards)
+        self.song_ids = [bson.ObjectId() for index in range(12)]
+        self.now = datetime.datetime.utcnow()
+        for index, song_id in enumerate(self.song_ids):
+            for rating in (1, 5):
+                self.storage.insert_rating(data={
+                    'song_id': song_id,
+                    'rating': rating,
+                    'creation_date': self.now - datetime.timedelta(days=index, minutes=rating)
+                })
+
+    def test_route_by_song_id(self):
+        for song_id in self.song_ids:
+            shard_index = get_shard_index(song_id, 3)
+            self.assertEqual(len(self.shards[shard_index].find_song_rating_ids(song_id=song_id)), 2)
+            self.assertEqual(get_shard_index(str(song_id), 3), shard_index)
+        self.assertTrue(sum(1 for shard in self.shards if shard.find_ratings()) > 1)
+
+    def test_route_rating_writes(self):
+        song_id = self.song_ids[0]
+        rating_id = self.storage.find_song_rating_ids(song_id=song_id)[0]
+        other_shard = [shard for index, shard in enumerate(self.shards) if index != get_shard_index(song_id, 3)][0]
+        with mock.patch.object(other_shard, 'find_rating') as find_rating, \
+                mock.patch.object(other_shard, 'update_rating') as update_rating:
+            self.assertEqual(self.storage.update_rating(rating_id=rating_id, rating=3, song_id=song_id), 1)
+            self.assertEqual(self.storage.find_rating(rating_id=rating_id, song_id=song_id)['rating'], 3)
+            find_rating.assert_not_called()
+            update_rating.assert_not_called()
+
+        documents = self.storage.find_old_ratings(before=self.now, limit=24)
+        shard_rating_ids = [set(document['_id'] for document in shard.find_ratings()) for shard in self.shards]
+        delete_mocks = [mock.patch.object(shard, 'delete_ratings', wraps=shard.delete_ratings).start()
+                        for shard in self.shards]
+        self.addCleanup(mock.patch.stopall)
+        deleted_count = self.storage.delete_ratings(rating_ids=[document['_id'] for document in documents],
+                                                    song_ids=[document['song_id'] for document in documents])
+        self.assertEqual(deleted_count, 24)
+        for index, delete_mock in enumerate(delete_mocks):
+            # Shards without songs are not called
+            if not shard_rating_ids[index]:
+                delete_mock.assert_not_called()
+                continue
+            delete_mock.assert_called_once_with(rating_ids=mock.ANY)
+            self.assertEqual(set(delete_mock.call_args[1]['rating_ids']), shard_rating_ids[index])
+        self.assertEqual(self.storage.find_ratings(), [])
+
+    def test_fan_out(self):
+        self.assertEqual(len(self.storage.find_ratings()), 24)
+        self.assertEqual(self.storage.count_ratings_by_song(), {song_id: 2 for song_id in self.song_ids})
+
+        stats = self.storage.get_rating_stats(song_ids=self.song_ids[:5])
+        self.assertEqual(sorted(stats), sorted(self.song_ids[:5]))
+        self.assertEqual(stats[self.song_ids[0]], {'avg_value': 3.0, 'min_value': 1, 'max_value': 5})
+
+        batches = list(self.storage.iter_batches(collection='ratings', fields=['song_id'], batch_size=5))
+        self.assertEqual(sum(len(batch) for batch in batches), 24)
+
+        old_ratings = self.storage.find_old_ratings(before=self.now - datetime.timedelta(days=3), limit=4)
+        dates = [document['creation_date'] for document in old_ratings]
+        self.assertEqual(len(dates), 4)
+        self.assertEqual(dates, sorted(dates))
+        self.assertEqual(dates[0], self.now - datetime.timedelta(days=11, minutes=5))
+
+        deleted_count = self.storage.delete_ratings(rating_ids=[document['_id'] for document in old_ratings])
+        self.assertEqual(deleted_count, 4)
+        self.assertEqual(len(self.storage.find_ratings()), 20)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
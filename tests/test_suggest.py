@@ -0,0 +1,48 @@
+import unittest
+
+from api import create_app
+from instance.suggest import SuggestIndex
+
+
+class TestSuggestIndex(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_name="testing")
+
+    def setUp(self):
+        self.songs = [{'_id': 'song{:02d}'.format(number), 'artist': 'Artist {}'.format(number % 3),
+                       'title': 'Title {:02d}'.format(number)} for number in range(30)]
+
+    def assert_same_as_scan(self, index=None, prefixes=None):
+        scan_index = SuggestIndex(top_size=0)
+        scan_index.build(songs=[{'_id': song_id, 'artist': song['artist'], 'title': song['title']}
+                                for song_id, song in index._songs.items()],
+                         rating_counts=index.get_rating_counts())
+        for prefix in prefixes:
+            for limit in (1, 3, 5):
+                self.assertEqual(index.suggest(prefix=prefix, limit=limit),
+                                 scan_index.suggest(prefix=prefix, limit=limit))
+
+    def test_cached_short_prefix(self):
+        with self.app.app_context():
+            index = SuggestIndex(short_prefix_length=2, top_size=5)
+            index.build(songs=self.songs, rating_counts={'song05': 3, 'song07': 1})
+            prefixes = ('a', 'ti', 't', 'title 0', 'artist 1')
+            self.assert_same_as_scan(index=index, prefixes=prefixes)
+            self.assertEqual(index.suggest(prefix='t', limit=2)[0]['_id'], 'song05')
+
+            # Rated song moves into cached top songs
+            for number in range(4):
+                index.add_rating(song_id='song20')
+            self.assertEqual(index.suggest(prefix='ti', limit=1)[0]['_id'], 'song20')
+            self.assert_same_as_scan(index=index, prefixes=prefixes)
+
+            index.add(song_id='song99', artist='New Artist', title='Another Title')
+            index.remove(song_id='song05')
+            index.add(song_id='song07', artist='Artist 1', title='Renamed')
+            self.assert_same_as_scan(index=index, prefixes=prefixes + ('ne', 'an', 're'))
+            self.assertEqual(len(index.suggest(prefix='t', limit=100)), 29)
+
+
+if __name__ == '__main__':
+    unittest.main()